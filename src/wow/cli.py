@@ -13,18 +13,82 @@ cli-demo action
 And this passes in an argument:
 cli-demo action goodbye
 
+This streams the results of a query on a sqlite database to a gzipped CSV file:
+cli-demo export "select * from test;" test.sqlite test.csv --compression gzip
+
+Any command can be profiled, writing run1.pstats, run1.collapsed and run1.txt:
+cli-demo --profile run1 export "select * from test;" test.sqlite test.csv
+
 """
 
 import click
 from wow.demo_one import print_something
+from wow.db_utils import db_config_template, export_query_to_csv
+from wow.utils import start_profiling, write_profile
 
 
 @click.group()
-def cli_group() -> None:
-    pass
+@click.option(
+    "--profile",
+    "profile_prefix",
+    default=None,
+    help="Run the command under cProfile and tracemalloc, writing files with this prefix",
+)
+@click.option("--profile-top", default=20, help="Number of entries in the profile summary")
+@click.pass_context
+def cli_group(ctx, profile_prefix, profile_top) -> None:
+    if profile_prefix is not None:
+        profiler = start_profiling()
+
+        def finish_profiling():
+            for filename in write_profile(profiler, profile_prefix, top=profile_top):
+                click.echo("Profile written to {}".format(filename), err=True)
+
+        ctx.call_on_close(finish_profiling)
 
 
 @cli_group.command()
 @click.argument("message", default="hello")
 def action(**kwargs):
     print_something(kwargs["message"])
+
+
+@cli_group.command()
+@click.argument("sql_query")
+@click.argument("database")
+@click.argument("filename")
+@click.option(
+    "--db-type",
+    type=click.Choice(["sqlite", "mysql", "mariadb"]),
+    default="sqlite",
+    help="For mysql/mariadb DATABASE is the database name, otherwise a sqlite file path",
+)
+@click.option("--db-host", default=db_config_template["db_host"])
+@click.option("--db-user", default=db_config_template["db_user"])
+@click.option("--db-pw-environ", default=db_config_template["db_pw_environ"])
+@click.option("--compression", type=click.Choice(["gzip", "bz2", "xz"]), default=None)
+@click.option("--max-rows", type=int, default=None, help="Split output every N rows")
+@click.option("--max-bytes", type=int, default=None, help="Split output every N characters")
+@click.option("--batch-size", type=int, default=10000)
+def export(**kwargs):
+    if kwargs["db_type"] == "sqlite":
+        db_config = kwargs["database"]
+    else:
+        db_config = db_config_template.copy()
+        db_config["db_type"] = kwargs["db_type"]
+        db_config["db_name"] = kwargs["database"]
+        db_config["db_host"] = kwargs["db_host"]
+        db_config["db_user"] = kwargs["db_user"]
+        db_config["db_pw_environ"] = kwargs["db_pw_environ"]
+
+    filenames = export_query_to_csv(
+        kwargs["sql_query"],
+        db_config,
+        kwargs["filename"],
+        compression=kwargs["compression"],
+        max_rows=kwargs["max_rows"],
+        max_bytes=kwargs["max_bytes"],
+        batch_size=kwargs["batch_size"],
+    )
+    for filename in filenames:
+        print(filename, flush=True)
@@ -10,18 +10,48 @@ It originally came from ihutilities with the Elasticsearch elements removed
 Ian Hopkinson
 """
 
+import concurrent.futures
+import atexit
+import base64
 import datetime
+import decimal
+import functools
+import hashlib
+import inspect
+import itertools
+import json
+import mmap
 import os
+import queue
+import random
+import re
+import threading
 import time
+import tracemalloc
 import sqlite3
+import struct
+import zlib
 import logging
+import operator
 import pymysql
 
-from pymysql.constants.CR import CR_CONN_HOST_ERROR
-from pymysql.constants.ER import BAD_DB_ERROR
+from pymysql.constants.CR import (
+    CR_CONN_HOST_ERROR,
+    CR_CONNECTION_ERROR,
+    CR_SERVER_GONE_ERROR,
+    CR_SERVER_LOST,
+)
+from pymysql.constants.ER import (
+    BAD_DB_ERROR,
+    CON_COUNT_ERROR,
+    LOCK_DEADLOCK,
+    LOCK_WAIT_TIMEOUT,
+)
 
 from collections import OrderedDict
 
+from wow.utils import file_fingerprint, write_dictionaries_streaming
+
 db_config_template = {
     "db_name": "test",
     "db_user": "root",
@@ -30,11 +60,588 @@ db_config_template = {
     "db_conn": None,
     "db_type": "mysql",
     "db_path": None,
+    "retry_policy": None,
+    "db_staging": False,
+    "db_staging_budget": 1024 * 1024 * 1024,
+    "db_shards": None,
+    "db_index_advisor": False,
+    "db_engine": "MyISAM",
+    "db_sqlite_table_options": None,
+}
+
+# db_config["db_engine"] is one of these, or a dictionary of table name to one of these with
+# an optional "default" entry
+MYSQL_ENGINES = ["InnoDB", "Aria", "MyISAM"]
+
+# db_config["db_sqlite_table_options"] is a list of these, or a dictionary of table name to a
+# list of these with an optional "default" entry
+SQLITE_TABLE_OPTIONS = ["WITHOUT ROWID", "STRICT", "FIXED WIDTH FIRST"]
+
+# Any of these keys can be overridden by supplying a partial dictionary as
+# db_config["retry_policy"]. max_attempts limits the attempts of one call, breaker_threshold
+# counts calls which exhausted their attempts, so the two are independent
+retry_policy_template = {
+    "max_attempts": 6,
+    "base_wait": 0.5,
+    "max_wait": 30.0,
+    "max_elapsed": 120.0,
+    "jitter": True,
+    "breaker_threshold": 5,
+    "breaker_reset": 60.0,
+}
+
+MYSQL_RETRYABLE_ERRORS = {
+    CR_CONN_HOST_ERROR,
+    CR_CONNECTION_ERROR,
+    CR_SERVER_GONE_ERROR,
+    CR_SERVER_LOST,
+    CON_COUNT_ERROR,
+    LOCK_DEADLOCK,
+    LOCK_WAIT_TIMEOUT,
 }
 
+# A write interrupted by one of these may have been partly applied
+MYSQL_LOST_CONNECTION_ERRORS = {CR_SERVER_GONE_ERROR, CR_SERVER_LOST}
+
+MYSQL_TRANSACTIONAL_ENGINES = {"INNODB"}
+
+GEOMETRY_TYPES = ["POINT", "POLYGON", "LINESTRING", "MULTIPOLYGON", "GEOMETRY"]
+
+WKB_TYPE_CODES = {"POINT": 1, "LINESTRING": 2, "POLYGON": 3, "MULTIPOLYGON": 6}
+
+# Types transfer_table copies from sqlite to MariaDB/MySQL as they are
+MYSQL_TYPE_NAMES = set(
+    """
+    TINYINT SMALLINT MEDIUMINT INT INTEGER BIGINT BIT BOOL BOOLEAN FLOAT DOUBLE REAL DECIMAL
+    NUMERIC DATE DATETIME TIMESTAMP TIME YEAR CHAR VARCHAR BINARY VARBINARY TINYTEXT TEXT
+    MEDIUMTEXT LONGTEXT TINYBLOB BLOB MEDIUMBLOB LONGBLOB JSON
+    """.split()
+)
+
+# finalise_db(spatial=True) on sqlite builds an R*Tree of bounding boxes with this name
+SQLITE_RTREE_NAME = "{table}_{column}_rtree"
+
+SQLITE_RETRYABLE_MESSAGES = ["database is locked", "database table is locked", "database is busy"]
+
+FILE_FINGERPRINT_TABLE = "wow_file_fingerprints"
+file_fingerprint_fields = OrderedDict(
+    [
+        ("filename", "VARCHAR(255) PRIMARY KEY"),
+        ("size", "BIGINT"),
+        ("mtime", "DOUBLE"),
+        ("sha256", "CHAR(64)"),
+        ("loaded_at", "VARCHAR(19)"),
+    ]
+)
+
+ROW_HASH_TABLE = "wow_row_hashes"
+row_hash_fields = OrderedDict(
+    [
+        ("table_name", "VARCHAR(64) PRIMARY KEY"),
+        ("row_key", "VARCHAR(255) PRIMARY KEY"),
+        ("row_hash", "CHAR(64)"),
+    ]
+)
+
+RESULT_CACHE_MAGIC = b"WOWRC001"
+RESULT_CACHE_SUFFIX = ".wowrc"
+
 logger = logging.getLogger(__name__)
 
+_retry_lock = threading.Lock()
+_retry_metrics = {
+    "calls": 0,
+    "retries": 0,
+    "wait_seconds": 0.0,
+    "giveups": 0,
+    "breaker_trips": 0,
+    "breaker_rejections": 0,
+}
+_breaker_state = {}
+_retry_local = threading.local()
+
+_metadata_lock = threading.Lock()
+_metadata_cache = {}
+
+_staging_lock = threading.RLock()
+_staging_databases = {}
+
+_key_index_lock = threading.Lock()
+_key_indexes = {}
+
+_batch_stats_lock = threading.Lock()
+_batch_stats = {}
+
+_query_log_lock = threading.Lock()
+_query_log = {}
+QUERY_LOG_LIMIT = 1000
+SQL_KEYWORDS = set(
+    """
+    where on join inner left right outer cross natural using group order limit having union
+    and or not as set values select from null is in like between exists case when then else
+    end asc desc offset
+    """.split()
+)
+
+
+class CircuitBreakerOpen(ConnectionError):
+    """
+    Raised without touching the database when recent calls to it have repeatedly failed
+    """
+
+
+def get_retry_metrics():
+    """
+    Returns a copy of the retry counters accumulated by the db_utils entry points
+
+    Returns:
+       dictionary with keys calls, retries, wait_seconds, giveups, breaker_trips and
+       breaker_rejections
+    """
+    with _retry_lock:
+        return dict(_retry_metrics)
+
+
+def reset_retry_metrics():
+    """
+    Zeroes the retry counters and closes all circuit breakers
+    """
+    with _retry_lock:
+        for k in _retry_metrics.keys():
+            _retry_metrics[k] = 0.0 if k == "wait_seconds" else 0
+        _breaker_state.clear()
+
+
+def get_batch_stats(db_config, table="property_data"):
+    """
+    Returns the batches used by the last write_to_db with batch_bytes to a table
+
+    Args:
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+
+    Keyword args:
+       table (str):
+            name of the table written
+
+    Returns:
+       dictionary with keys batches, batch_sizes (rows per batch), batch_rows (the size the
+       next batch would have been), max_batch_bytes (estimated size of the values in the
+       largest batch), rows_per_second and overhead, or None if there has been no such write
+    """
+    with _batch_stats_lock:
+        batch_stats = _batch_stats.get((_db_key(_normalise_config(db_config)), table))
+    if batch_stats is None:
+        return None
+    return dict(batch_stats, batch_sizes=list(batch_stats["batch_sizes"]))
+
+
+def _retry_policy(db_config):
+    policy = retry_policy_template.copy()
+    if db_config.get("retry_policy") is not None:
+        policy.update(db_config["retry_policy"])
+    return policy
+
+
+def _db_key(db_config):
+    if db_config["db_type"] == "sqlite":
+        return ("sqlite", db_config["db_path"])
+    return (db_config["db_type"], db_config["db_host"], db_config["db_name"])
+
+
+def _is_retryable(err):
+    """
+    This is a private function which classifies a database exception as transient or not
+    """
+    if isinstance(err, pymysql.err.OperationalError) or isinstance(err, pymysql.err.InternalError):
+        return len(err.args) > 0 and err.args[0] in MYSQL_RETRYABLE_ERRORS
+    if isinstance(err, sqlite3.OperationalError):
+        message = str(err).lower()
+        return any(x in message for x in SQLITE_RETRYABLE_MESSAGES)
+    return False
+
+
+def _backoff_wait(policy, attempt):
+    wait = min(policy["max_wait"], policy["base_wait"] * 2 ** (attempt - 1))
+    if policy["jitter"]:
+        wait = random.uniform(0, wait)
+    return wait
+
+
+def _is_write_retryable(db_config, table, err):
+    """
+    This is a private function which classifies an error from writing rows to a table as safe
+    to retry. A lost MariaDB/MySQL connection may have left an executemany partly applied, so
+    it is only retried for tables in a transactional engine, where the server rolls back the
+    uncommitted rows.
+    """
+    if not _is_retryable(err):
+        return False
+    if db_config["db_type"] == "sqlite" or err.args[0] not in MYSQL_LOST_CONNECTION_ERRORS:
+        return True
+    return _mysql_table_engine(db_config, table) in MYSQL_TRANSACTIONAL_ENGINES
+
+
+def _mysql_table_engine(db_config, table):
+    """
+    This is a private function which returns the upper case storage engine of a MariaDB/MySQL
+    table, or None if it cannot be found
+    """
+    try:
+        rows = list(
+            read_db(
+                "SELECT ENGINE FROM information_schema.TABLES "
+                "WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s",
+                db_config,
+                params=[db_config["db_name"], table],
+            )
+        )
+    except pymysql.Error:
+        return None
+    if len(rows) == 0 or rows[0]["ENGINE"] is None:
+        return None
+    return rows[0]["ENGINE"].upper()
+
+
+def _call_with_retry(db_config, operation, description="", retryable=_is_retryable):
+    """
+    This is a private function which calls operation(), retrying transient database errors
+    with exponential backoff and jitter, and failing fast if the circuit breaker for the
+    database is open. A call made while another is being retried on the same thread, such as
+    write_to_db recursing, is not retried itself since the outer call retries it. retryable
+    classifies the errors which may be retried.
+    """
+    if getattr(_retry_local, "active", False):
+        return operation()
+
+    policy = _retry_policy(db_config)
+    key = _db_key(db_config)
+    start = time.monotonic()
+    attempt = 0
+    with _retry_lock:
+        _retry_metrics["calls"] += 1
+
+    while True:
+        with _retry_lock:
+            state = _breaker_state.get(key)
+            if state is not None and state["open_until"] > time.monotonic():
+                _retry_metrics["breaker_rejections"] += 1
+                raise CircuitBreakerOpen(
+                    "Circuit breaker for {} is open after {} consecutive failures".format(
+                        key, state["failures"]
+                    )
+                )
+        attempt += 1
+        _retry_local.active = True
+        try:
+            result = operation()
+        except (pymysql.Error, sqlite3.Error) as err:
+            if not retryable(err):
+                raise
+            wait = _backoff_wait(policy, attempt)
+            elapsed = time.monotonic() - start
+            with _retry_lock:
+                if attempt >= policy["max_attempts"] or elapsed + wait > policy["max_elapsed"]:
+                    # Only a call which has used up its attempts counts towards the breaker
+                    state = _breaker_state.setdefault(key, {"failures": 0, "open_until": 0.0})
+                    state["failures"] += 1
+                    if state["failures"] >= policy["breaker_threshold"]:
+                        state["open_until"] = time.monotonic() + policy["breaker_reset"]
+                        _retry_metrics["breaker_trips"] += 1
+                    _retry_metrics["giveups"] += 1
+                    raise
+                _retry_metrics["retries"] += 1
+                _retry_metrics["wait_seconds"] += wait
+            logger.warning(
+                f"Caught exception '{err}' in {description}, attempt {attempt}, "
+                f"waiting {wait:.2f} seconds and having another go"
+            )
+            time.sleep(wait)
+        else:
+            with _retry_lock:
+                _breaker_state.pop(key, None)
+            return result
+        finally:
+            _retry_local.active = False
+
+
+def _with_retry(func, write=False):
+    """
+    This is a private decorator which applies the shared retry policy to a db_utils entry point
+    taking a db_config argument. Any connection left open by a failed attempt is closed, so
+    that a retry does not find its own database locked. With write=True the function inserts
+    rows into its table argument, and errors are classified by _is_write_retryable.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        db_config = _normalise_config(bound.arguments["db_config"])
+        bound.arguments["db_config"] = db_config
+
+        # Sharded databases fan out to one call per shard, each of which is retried separately
+        if db_config.get("db_shards"):
+            return func(*bound.args, **bound.kwargs)
+
+        def operation():
+            try:
+                return func(*bound.args, **bound.kwargs)
+            except (pymysql.Error, sqlite3.Error) as err:
+                _close_quietly(db_config.get("db_conn"))
+                if not _spill_full_staging(db_config, err):
+                    raise
+            # A staged database reached its budget and is now on disk
+            return func(*bound.args, **bound.kwargs)
+
+        if not write:
+            return _call_with_retry(db_config, operation, func.__name__)
+
+        table = bound.arguments.get("table", signature.parameters["table"].default)
+        return _call_with_retry(
+            db_config,
+            operation,
+            func.__name__,
+            lambda err: _is_write_retryable(db_config, table, err),
+        )
+
+    return wrapper
+
+
+def _with_write_retry(func):
+    """
+    This is a private decorator, as _with_retry, for entry points which insert rows into the
+    table given by their table argument
+    """
+    return _with_retry(func, write=True)
+
+
+def clear_metadata_cache(db_config=None):
+    """
+    Forgets cached database existence, table lists and column definitions, and the key
+    indexes built by write_to_db(..., key_index=True)
+
+    The cache is invalidated automatically by configure_db, drop_db_tables and
+    create_mysql_database, and the table list is refreshed by every call to list_tables or
+    check_table_exists, which always query the database. This function is for when a schema
+    is changed by other means, for example by another process or a DROP TABLE issued through
+    delete_from_db. Key indexes are
+    also forgotten by update_to_db and the delete functions, but not when another process
+    deletes rows.
+
+    Keyword args:
+       db_config (str or dict):
+            the database to forget, if None then the whole cache is cleared
+
+    Returns:
+       No return value
+    """
+    with _metadata_lock:
+        if db_config is None:
+            _metadata_cache.clear()
+        else:
+            _metadata_cache.pop(_db_key(_normalise_config(db_config)), None)
+    _forget_key_indexes(db_config)
+
+
+def _forget_key_indexes(db_config=None, table=None):
+    with _key_index_lock:
+        if db_config is None:
+            _key_indexes.clear()
+            return
+        db_key = _db_key(_normalise_config(db_config))
+        for index_key in [x for x in _key_indexes if x[0] == db_key]:
+            if table is None or index_key[1] == table:
+                _key_indexes.pop(index_key)
+
+
+def _add_to_key_index(db_config, db_fields, table, data, rejected_data):
+    """
+    This is a private function which adds the keys of rows written by write_to_db, other than
+    those rejected, to the table's key index if one has been built, so that it stays current
+    """
+    with _key_index_lock:
+        known_keys = _key_indexes.get((_db_key(db_config), table))
+    if known_keys is None:
+        return
+    key_of = _key_getter(db_config, db_fields, table, data[0])
+    rejected_ids = set(id(row) for row in rejected_data)
+    new_keys = [key_of(row) for row in data if id(row) not in rejected_ids]
+    with _key_index_lock:
+        known_keys.update(new_keys)
+
+
+def _cached_metadata(db_config):
+    """
+    This is a private function which returns the metadata cache entry for db_config, it should
+    only be called with _metadata_lock held
+    """
+    return _metadata_cache.setdefault(
+        _db_key(db_config), {"database_exists": False, "tables": None, "columns": {}}
+    )
+
+
+def _cached_table_names(db_config, cursor=None):
+    """
+    This is a private function which returns the names of the tables in a database, querying
+    sqlite_master/information_schema only if the list is not already cached. If a cursor is
+    supplied it is used for the query, otherwise a connection is made and closed.
+    """
+    if db_config.get("db_shards"):
+        return _cached_table_names(_shard_configs(db_config)[0])
+
+    with _metadata_lock:
+        tables = _cached_metadata(db_config)["tables"]
+    if tables is not None:
+        return tables
+    return _query_table_names(db_config, cursor)
+
+
+def _query_table_names(db_config, cursor=None):
+    """
+    This is a private function which queries the names of the tables in a database and
+    refreshes the metadata cache with them
+    """
+    if db_config.get("db_shards"):
+        return _query_table_names(_shard_configs(db_config)[0])
+
+    if db_config["db_type"] == "sqlite":
+        table_list_query = "SELECT name FROM sqlite_master WHERE type='table';"
+    elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
+        table_list_query = (
+            "SELECT table_name as name FROM "
+            "information_schema.tables WHERE table_schema = '{}';".format(db_config["db_name"])
+        )
+
+    if cursor is None:
+        conn = _make_connection(db_config)
+        cursor = conn.cursor()
+        cursor.execute(table_list_query)
+        tables = [x[0] for x in cursor.fetchall()]
+        conn.close()
+    else:
+        cursor.execute(table_list_query)
+        tables = [x[0] for x in cursor.fetchall()]
+
+    with _metadata_lock:
+        _cached_metadata(db_config)["tables"] = tables
+    return tables
+
+
+def _cached_database_exists(db_config):
+    """
+    This is a private function which wraps check_mysql_database_exists with the metadata cache,
+    only a positive answer is cached
+    """
+    with _metadata_lock:
+        if _cached_metadata(db_config)["database_exists"]:
+            return True
+
+    exists = check_mysql_database_exists(db_config)
+    if exists:
+        with _metadata_lock:
+            _cached_metadata(db_config)["database_exists"] = True
+    return exists
+
+
+def _forget_table(db_config, table):
+    with _metadata_lock:
+        entry = _cached_metadata(db_config)
+        if entry["tables"] is not None:
+            entry["tables"] = [x for x in entry["tables"] if x.lower() != table.lower()]
+        entry["columns"].pop(table, None)
+
+
+def _record_created_table(db_config, table):
+    with _metadata_lock:
+        entry = _cached_metadata(db_config)
+        if entry["tables"] is not None and table not in entry["tables"]:
+            entry["tables"].append(table)
+        entry["columns"].pop(table, None)
+
+
+@_with_retry
+def get_table_columns(db_config, table):
+    """
+    This function returns the column definitions of a table, using the metadata cache
+
+    Args:
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+       table (str):
+            name of the table
+
+    Returns:
+       An OrderedDict of column name to declared type, as reported by the database, in table
+       order, empty if the table does not exist
+    """
+    db_config = _normalise_config(db_config)
+    columns, _ = _table_schema(db_config, table)
+    return columns.copy()
+
+
+@_with_retry
+def get_primary_key_columns(db_config, table):
+    """
+    This function returns the primary key columns of a table, using the metadata cache
+
+    Args:
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+       table (str):
+            name of the table
+
+    Returns:
+       A list of column names, in key order for sqlite and column order for MariaDB/MySQL,
+       empty if the table has no primary key
+    """
+    db_config = _normalise_config(db_config)
+    _, primary_keys = _table_schema(db_config, table)
+    return list(primary_keys)
+
+
+def _table_schema(db_config, table):
+    """
+    This is a private function which returns the cached (columns, primary_keys) of a table,
+    querying PRAGMA table_info/information_schema.columns on a cache miss
+    """
+    if db_config.get("db_shards"):
+        return _table_schema(_shard_configs(db_config)[0], table)
+
+    with _metadata_lock:
+        schema = _cached_metadata(db_config)["columns"].get(table)
+    if schema is not None:
+        return schema
+
+    conn = _make_connection(db_config)
+    cursor = conn.cursor()
+    if db_config["db_type"] == "sqlite":
+        cursor.execute("PRAGMA table_info({})".format(table))
+        result = cursor.fetchall()
+        columns = OrderedDict([(x[1], x[2]) for x in result])
+        primary_keys = [x[1] for x in sorted(result, key=lambda x: x[5]) if x[5] > 0]
+    elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
+        cursor.execute(
+            "SELECT column_name, column_type, column_key FROM information_schema.columns "
+            "WHERE table_schema = %s AND table_name = %s ORDER BY ordinal_position",
+            (db_config["db_name"], table),
+        )
+        result = cursor.fetchall()
+        columns = OrderedDict([(x[0], x[1]) for x in result])
+        primary_keys = [x[0] for x in result if x[2] == "PRI"]
+    conn.close()
+
+    schema = (columns, primary_keys)
+    if len(columns) != 0:
+        with _metadata_lock:
+            _cached_metadata(db_config)["columns"][table] = schema
+    return schema
 
+
+@_with_retry
 def configure_db(db_config, db_fields, tables="property_data", force=False):
     """This function sets up a sqlite or MariaDB/MySQL database
 
@@ -54,6 +661,46 @@ def configure_db(db_config, db_fields, tables="property_data", force=False):
     Returns
        db_config structure, in particular with the db_conn field populated for MariaDB/MySQL
 
+    Notes
+        For sqlite, db_config["db_staging"] = True stages the database in memory: it and
+        subsequent writes to the same db_path go to an in-memory copy, which finalise_db
+        copies to db_path with the sqlite online backup API. Nothing reaches db_path until
+        then, so call finalise_db or commit_staged_db when loading is done. A database still
+        staged when the interpreter exits normally is written to disk with a warning, but
+        one staged by a process which is killed or crashes is lost. The in-memory copy is
+        capped at db_config["db_staging_budget"] bytes: a write which would take it over is
+        rolled back, the copy is written to disk, staging ends and the write runs again
+        there.
+
+        For sqlite, db_config["db_shards"] = N creates N files alongside db_path
+        (name_shard00.sqlite etc). write_to_db routes each row to a shard by a hash of its
+        primary key, so shards can be loaded by separate processes, while read_db attaches
+        all the shards and queries a TEMP UNION ALL view of each table. Joins, aggregates and
+        ORDER BY over the views give the same results as a single file, but the views have
+        no rowid, cannot be written to and do not use the shards' indexes for joins across
+        shards. sqlite attaches at most 10 databases by default, so a database with more
+        shards can be written but not read. update_to_db, delete_from_db,
+        delete_from_db_chunked, delete_keys_from_db, finalise_db and drop_db_tables are
+        applied to every shard, read_db_partitioned and read_db_bbox read each shard in
+        turn. write_changed_rows, file_unchanged_since_load, record_file_load and
+        recommend_indexes do not support sharded databases.
+
+        For MariaDB/MySQL, db_config["db_engine"] sets the storage engine of new tables,
+        either one of MYSQL_ENGINES for every table or a dictionary of table name to engine
+        with an optional "default". MyISAM is used otherwise. InnoDB has row-level locking
+        and is crash safe, Aria is crash safe with table-level locking and MyISAM has neither.
+
+        For sqlite, db_config["db_sqlite_table_options"] takes a list of SQLITE_TABLE_OPTIONS,
+        for every table or as a dictionary of table name to list with an optional "default".
+        WITHOUT ROWID stores rows in primary key order in the primary key's B-tree, rather
+        than in a rowid table with a separate index for a primary key which is not a single
+        INTEGER, which suits lookup tables with compound keys. STRICT, from sqlite 3.37,
+        rejects values of the wrong type, declared types being mapped to INTEGER, REAL, TEXT,
+        BLOB or ANY. FIXED WIDTH FIRST puts the integer and real columns ahead of text and
+        blob columns, so they are read without stepping over long values, which changes the
+        column order of SELECT *. delete_from_db_chunked, read_db_partitioned and sample_db
+        use the primary key in place of rowid for WITHOUT ROWID tables.
+
     Example
         >>> db_fields = OrderedDict([
               ("UPRN","INTEGER PRIMARY KEY"),
@@ -70,6 +717,12 @@ def configure_db(db_config, db_fields, tables="property_data", force=False):
     # for backward compatibility
 
     db_config = _normalise_config(db_config)
+    clear_metadata_cache(db_config)
+
+    if db_config.get("db_shards"):
+        for shard_config in _shard_configs(db_config):
+            configure_db(shard_config, db_fields, tables=tables, force=force)
+        return db_config
 
     if isinstance(tables, str):
         tables = [tables]
@@ -89,6 +742,9 @@ def configure_db(db_config, db_fields, tables="property_data", force=False):
             )
             os.makedirs(os.path.dirname(db_config["db_path"]))
 
+        if db_config.get("db_staging"):
+            _start_staging(db_config, force)
+
         _ = _make_connection(db_config)
     # Default behaviour for mysql/mariadb is not to drop database
     elif db_config["db_type"] == "mysql" or db_config["db_type"] == "mariadb":
@@ -106,7 +762,17 @@ def configure_db(db_config, db_fields, tables="property_data", force=False):
     return db_config
 
 
-def write_to_db(data, db_config, db_fields, table="property_data", whatever=False):
+@_with_write_retry
+def write_to_db(
+    data,
+    db_config,
+    db_fields,
+    table="property_data",
+    whatever=False,
+    batch_bytes=None,
+    key_index=False,
+    bulk_load=False,
+):
     """
     This function writes a list of rows to a sqlite or MariaDB/MySQL database
 
@@ -125,14 +791,61 @@ def write_to_db(data, db_config, db_fields, table="property_data", whatever=Fals
        whatever (bool):
             If true each item is tried individually and only those accepted are written,
             list of those not inserted is returned
+       batch_bytes (int):
+            If set the rows are written in executemany batches sized to fit this memory budget,
+            the batch size adapts to the observed throughput and memory use
+       key_index (bool):
+            If true rows whose primary key is already in the table, or earlier in data, are
+            not sent to the database and are returned as rejected rows
+       bulk_load (bool):
+            If true, for MariaDB/MySQL, unique and foreign key checks and autocommit are
+            turned off for the session and MyISAM/Aria non-unique index updates deferred until
+            the rows are written, after which every setting is restored
 
     Returns:
        No return value
 
 
     Notes:
-        If data is prepared as a dictionary then it can be converted using:
-        >>> ([x for x in new_row.values()])
+        Dictionary rows are bound by field name, so their key order does not need to match
+        db_fields and they may contain extra keys. Tuples and lists are passed to the
+        database as they are, in db_fields order. With whatever=True the rejected rows are
+        returned as supplied.
+
+        Geometry columns (POINT, POLYGON etc) accept either WKT strings, which are parsed by
+        the server with GeomFromText, or WKB bytes, for example from geometry_to_wkb, which
+        are bound with ST_GeomFromWKB and avoid the text parse. The choice is made per
+        column from the first row. sqlite stores geometries as WKB, converting WKT strings
+        before they are written, and adds the bounding boxes of new rows to any R*Tree
+        built by finalise_db(spatial=True).
+
+        With batch_bytes the first batch is sized from the estimated size of a sample of rows,
+        later batches grow while rows/sec improves and shrink when it falls, always capped by
+        the budget. If tracemalloc is tracing, the peak of a batch which raises the traced
+        peak corrects the estimate of the memory used per row, otherwise growth in resident
+        memory is checked. The traced peak itself is left as it is. The
+        batches used by the last such write to each table are returned by get_batch_stats.
+
+        With key_index the primary key of the table, from db_fields or else from the database,
+        is read once into an in-memory set per table which later writes keep up to date.
+        Single integer keys are held as they are, others as 64-bit hashes, so a hash
+        collision could very rarely reject a new row. Rows are compared as supplied, so a key
+        given as "1" does not match a stored 1. Later calls to write_to_db, including those
+        made by BufferedWriter and write_changed_rows, add the keys they write to the set. The
+        set is dropped if an insert fails on a duplicate, and by clear_metadata_cache,
+        update_to_db, transfer_table, write_columns_to_db and the delete functions.
+
+        With bulk_load the server does not check secondary UNIQUE indexes or foreign keys for
+        the rows written, so it is only for data already known to satisfy them. Primary keys
+        are always checked. It has no effect on sqlite, where write_to_db already writes in
+        one transaction.
+
+        Failed writes are retried under the retry policy only where the failed attempt cannot
+        have left rows behind: sqlite busy or locked errors, MariaDB/MySQL connection
+        failures, deadlocks and lock wait timeouts. A connection lost during the write, which
+        may leave an executemany partly applied, is retried only for InnoDB tables since
+        the server rolls back their uncommitted rows. For MyISAM and other non-transactional
+        tables the error is raised, and the rows already written stay in the table.
 
     Example:
         >>> db_fields = OrderedDict([
@@ -150,345 +863,3583 @@ def write_to_db(data, db_config, db_fields, table="property_data", whatever=Fals
     """
     db_config = _normalise_config(db_config)
 
-    ONE_PLACEHOLDER = ""
-    if db_config["db_type"] == "sqlite":
-        ONE_PLACEHOLDER = "?,"
-    elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
-        ONE_PLACEHOLDER = "%s,"
-
-    conn = _make_connection(db_config)
-    cursor = conn.cursor()
-
-    DB_INSERT_ROOT = "INSERT INTO {} (".format(table)
-    DB_INSERT_MIDDLE = ") VALUES ("
-    DB_INSERT_TAIL = ")"
-
-    DB_FIELDS = DB_INSERT_ROOT
-    DB_PLACEHOLDERS = DB_INSERT_MIDDLE
-
-    for k in db_fields.keys():
-        DB_FIELDS = DB_FIELDS + k + ","
-        if db_fields[k] in [
-            "POINT",
-            "POLYGON",
-            "LINESTRING",
-            "MULTIPOLYGON",
-            "GEOMETRY",
-        ]:
-            DB_PLACEHOLDERS = DB_PLACEHOLDERS + "GeomFromText(%s),"
-        else:
-            DB_PLACEHOLDERS = DB_PLACEHOLDERS + ONE_PLACEHOLDER
-
-    INSERT_statement = DB_FIELDS[0:-1] + DB_PLACEHOLDERS[0:-1] + DB_INSERT_TAIL
-
     rejected_data = []
 
-    # convert a list of dictionary to a list of lists, if required:
-
-    converted_data = []
-    if len(data) > 0 and isinstance(data[0], dict):
-        for row in data:
-            converted_data.append([x for x in row.values()])
-    else:
-        converted_data = data
+    if len(data) == 0:
+        logger.info("No data supplied to write_to_db for table: {}".format(table))
+        return rejected_data
 
-    if whatever:
-        for row in converted_data:
-            try:
-                cursor.execute(INSERT_statement, row)
-            except (pymysql.err.IntegrityError, sqlite3.IntegrityError):
-                rejected_data.append(row)
+    if db_config.get("db_shards"):
+        return _write_to_shards(data, db_config, db_fields, table, whatever, key_index)
 
-    else:
-        try:
+    if key_index:
+        key_of = _key_getter(db_config, db_fields, table, data[0])
+        known_keys = _table_key_index(db_config, db_fields, table)
+        new_keys = []
+        accepted = []
+        with _key_index_lock:
+            for row in data:
+                row_key = key_of(row)
+                if row_key in known_keys:
+                    rejected_data.append(row)
+                else:
+                    known_keys.add(row_key)
+                    new_keys.append(row_key)
+                    accepted.append(row)
+        if len(rejected_data) != 0:
             logger.debug(
-                "Insert statement = {}\nData line 1 = {}".format(
-                    INSERT_statement, converted_data[0]
+                "write_to_db key index rejected {} rows for table {}".format(
+                    len(rejected_data), table
                 )
             )
-            cursor.executemany(INSERT_statement, converted_data)
+        try:
+            db_rejected = write_to_db(
+                accepted, db_config, db_fields, table, whatever, batch_bytes, bulk_load=bulk_load
+            )
         except (pymysql.err.IntegrityError, sqlite3.IntegrityError):
-            conn.close()
+            _forget_key_indexes(db_config)
             raise
-        except (pymysql.err.DataError):
-            conn.close()
-            logger.info("write_to_db failed with {}".format(converted_data))
+        except BaseException:
+            with _key_index_lock:
+                known_keys.difference_update(new_keys)
             raise
+        if len(db_rejected) != 0:
+            with _key_index_lock:
+                known_keys.difference_update(key_of(row) for row in db_rejected)
+        return rejected_data + db_rejected
 
-    conn.commit()
-    conn.close()
+    # Rows are bound lazily, dictionaries through an itemgetter built once per call
+    bind_row = _row_binder(db_fields, data[0])
+    first_row = data[0] if bind_row is None else bind_row(data[0])
 
+    INSERT_statement = _insert_statement(
+        db_config, db_fields, table, wkb_fields=_wkb_fields(db_fields, first_row)
+    )
+
+    rtrees = []
+    if db_config["db_type"] == "sqlite":
+        bind_row = _sqlite_geometry_binder(db_fields, first_row, bind_row)
+        rtrees = _sqlite_rtrees(db_config, db_fields, table)
+
+    conn = _make_connection(db_config)
+    cursor = conn.cursor()
+    bulk_settings = None
+    committed = False
+    try:
+        if bulk_load and (db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql"):
+            bulk_settings = _start_bulk_load(cursor, db_config, table)
+        if len(rtrees) != 0:
+            rtree_after_rowid = cursor.execute(
+                "SELECT MAX(rowid) FROM {}".format(table)
+            ).fetchone()[0]
+
+        if whatever:
+            for row in data:
+                try:
+                    cursor.execute(INSERT_statement, row if bind_row is None else bind_row(row))
+                except (pymysql.err.IntegrityError, sqlite3.IntegrityError):
+                    rejected_data.append(row)
+
+        else:
+            try:
+                logger.debug(
+                    "Insert statement = {}\nData line 1 = {}".format(INSERT_statement, first_row)
+                )
+                if batch_bytes is None:
+                    cursor.executemany(
+                        INSERT_statement, data if bind_row is None else map(bind_row, data)
+                    )
+                else:
+                    batch_stats = _write_batches(
+                        cursor, INSERT_statement, data, bind_row, batch_bytes
+                    )
+                    logger.debug("write_to_db batches for table {}: {}".format(table, batch_stats))
+                    with _batch_stats_lock:
+                        _batch_stats[(_db_key(db_config), table)] = batch_stats
+            except (pymysql.err.DataError):
+                logger.info("write_to_db failed with data line 1 = {}".format(first_row))
+                raise
+
+        if len(rtrees) != 0:
+            key = _integer_primary_key(db_fields)
+            if key is None:
+                _update_rtrees(cursor, table, rtrees, after_rowid=rtree_after_rowid or 0)
+            else:
+                rejected_ids = set(id(row) for row in rejected_data)
+                position = list(db_fields.keys()).index(key)
+                ids = [
+                    (row if bind_row is None else bind_row(row))[position]
+                    for row in data
+                    if id(row) not in rejected_ids
+                ]
+                _update_rtrees(cursor, table, rtrees, ids=ids)
+
+        conn.commit()
+        committed = True
+    finally:
+        try:
+            if bulk_settings is not None:
+                _close_bulk_load(conn, cursor, table, bulk_settings, committed)
+        finally:
+            conn.close()
+
+    _add_to_key_index(db_config, db_fields, table, data, rejected_data)
     return rejected_data
 
 
-def update_to_db(data, db_config, db_fields, table="property_data", key=["UPRN"]):
+def _start_bulk_load(cursor, db_config, table):
+    """
+    This is a private function which saves the session's unique_checks, foreign_key_checks
+    and autocommit settings before turning them off, and for a MyISAM or Aria table defers
+    updates of its non-unique indexes, returning what is needed to undo this
+    """
+    cursor.execute(
+        "SELECT @@SESSION.unique_checks, @@SESSION.foreign_key_checks, @@SESSION.autocommit"
+    )
+    unique_checks, foreign_key_checks, autocommit = cursor.fetchone()
+    cursor.execute(
+        "SELECT ENGINE FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s",
+        (db_config["db_name"], table),
+    )
+    engine = cursor.fetchone()
+    disable_keys = engine is not None and engine[0] in ("MyISAM", "Aria")
+
+    cursor.execute("SET SESSION unique_checks = 0, foreign_key_checks = 0, autocommit = 0")
+    if disable_keys:
+        cursor.execute("ALTER TABLE {} DISABLE KEYS".format(table))
+    logger.debug("Bulk load of table {} started, disable_keys = {}".format(table, disable_keys))
+    return {
+        "unique_checks": int(unique_checks),
+        "foreign_key_checks": int(foreign_key_checks),
+        "autocommit": int(autocommit),
+        "disable_keys": disable_keys,
+    }
+
+
+def _end_bulk_load(cursor, table, bulk_settings):
+    """
+    This is a private function which rebuilds any deferred indexes and restores the session
+    settings saved by _start_bulk_load
+    """
+    start_time = time.monotonic()
+    try:
+        if bulk_settings["disable_keys"]:
+            cursor.execute("ALTER TABLE {} ENABLE KEYS".format(table))
+    finally:
+        cursor.execute(
+            "SET SESSION unique_checks = %s, foreign_key_checks = %s, autocommit = %s",
+            (
+                bulk_settings["unique_checks"],
+                bulk_settings["foreign_key_checks"],
+                bulk_settings["autocommit"],
+            ),
+        )
+    logger.debug(
+        "Bulk load of table {} ended, indexes rebuilt in {:.2f}s".format(
+            table, time.monotonic() - start_time
+        )
+    )
+
+
+def _close_bulk_load(conn, cursor, table, bulk_settings, committed):
+    """
+    This is a private function which rolls back anything uncommitted and ends a bulk load.
+    Unless the load was committed a failure is logged rather than raised, so that the
+    exception which stopped the load is the one raised
+    """
+    try:
+        # Rolling back first stops restoring autocommit from committing a failed load
+        conn.rollback()
+    except pymysql.Error as err:
+        logger.warning("Bulk load of table {} could not be rolled back: {}".format(table, err))
+    try:
+        _end_bulk_load(cursor, table, bulk_settings)
+    except pymysql.Error as err:
+        if committed:
+            raise
+        logger.warning("Bulk load of table {} could not be ended: {}".format(table, err))
+
+
+def write_columns_to_db(columns, db_config, db_fields, table="property_data", batch_size=10000):
+    """
+    This function writes columns of data, rather than rows, to a sqlite or MariaDB/MySQL
+    database
+
+    Args:
+       columns (dict of sequences or NumPy structured array):
+            One sequence or array per field in db_fields, keyed by fieldname, all the same
+            length
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+       db_fields (OrderedDict):
+            A dictionary of fieldnames and types for the table
+
+    Keyword args:
+       table (str):
+            name of table to which we are writing
+       batch_size (int):
+            number of rows taken from each column at a time
+
+    Returns:
+       number of rows written
+
+    Notes:
+        Rows are made by zipping slices of the columns as the database consumes them, so no
+        row dictionaries are built. Slices with a tolist method, such as NumPy arrays, are
+        converted with it so the database receives Python values, NumPy is never imported.
+
+        The rows are written in one transaction which is retried as a whole under the retry
+        policy, with the same limits on retrying writes as write_to_db. For sqlite tables
+        with geometry columns, and sharded databases, each batch is passed to write_to_db
+        and committed and retried separately, so a failure can leave earlier batches written.
+
+    Example:
+        >>> columns = {"UPRN": [1, 2, 3],
+                       "PropertyID": [2, 3, 3],
+                       "Addr1": ["hello", "Fred", "Beans"]}
+        >>> write_columns_to_db(columns, db_file_path, db_fields, table="test")
+        3
+    """
+    db_config = _normalise_config(db_config)
+
+    names = getattr(getattr(columns, "dtype", None), "names", None)
+    available = names if names is not None else columns.keys()
+    missing = [k for k in db_fields.keys() if k not in available]
+    if len(missing) != 0:
+        raise ValueError("write_columns_to_db has no column for fields: {}".format(missing))
+
+    field_columns = [columns[k] for k in db_fields.keys()]
+    lengths = set(len(column) for column in field_columns)
+    if len(lengths) != 1:
+        raise ValueError("write_columns_to_db columns differ in length: {}".format(lengths))
+    n_rows = lengths.pop()
+
+    if n_rows == 0:
+        logger.info("No data supplied to write_columns_to_db for table: {}".format(table))
+        return 0
+
+    def batches():
+        for start in range(0, n_rows, batch_size):
+            stop = min(start + batch_size, n_rows)
+            yield zip(*[_column_slice(column, start, stop) for column in field_columns])
+
+    if db_config.get("db_shards"):
+        for batch in batches():
+            _write_to_shards(list(batch), db_config, db_fields, table, False)
+        return n_rows
+
+    # sqlite geometries may need converting to WKB and adding to an R*Tree, which write_to_db
+    # does for each batch
+    if db_config["db_type"] == "sqlite" and any(v in GEOMETRY_TYPES for v in db_fields.values()):
+        for batch in batches():
+            write_to_db(list(batch), db_config, db_fields, table)
+        return n_rows
+
+    _write_column_batches(batches, db_config, db_fields, table)
+    return n_rows
+
+
+@_with_write_retry
+def _write_column_batches(batches, db_config, db_fields, table):
+    """
+    This is a private function which writes the rows of write_columns_to_db in one
+    transaction, each attempt calls batches again so a retry starts from the first row
+    """
+    rows = itertools.chain.from_iterable(batches())
+    first_row = next(rows)
+
+    INSERT_statement = _insert_statement(
+        db_config, db_fields, table, wkb_fields=_wkb_fields(db_fields, first_row)
+    )
+
+    conn = _make_connection(db_config)
+    try:
+        cursor = conn.cursor()
+        cursor.executemany(INSERT_statement, itertools.chain([first_row], rows))
+        conn.commit()
+    finally:
+        conn.close()
+        # Rows written here bypass write_to_db, so a key index for the table is out of date
+        _forget_key_indexes(db_config, table=table)
+
+
+def _column_slice(column, start, stop):
+    """
+    This is a private function which takes rows start to stop of a column, as Python values
+    where the column offers tolist
+    """
+    chunk = column[start:stop]
+    if hasattr(chunk, "tolist"):
+        return chunk.tolist()
+    return chunk
+
+
+def _insert_statement(db_config, db_fields, table, wkb_fields=()):
+    """
+    This is a private function which builds the parameterised INSERT statement for a table,
+    geometry fields named in wkb_fields take WKB bytes rather than WKT text
+    """
+    ONE_PLACEHOLDER = ""
+    if db_config["db_type"] == "sqlite":
+        ONE_PLACEHOLDER = "?,"
+    elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
+        ONE_PLACEHOLDER = "%s,"
+
+    DB_INSERT_ROOT = "INSERT INTO {} (".format(table)
+    DB_INSERT_MIDDLE = ") VALUES ("
+    DB_INSERT_TAIL = ")"
+
+    DB_FIELDS = DB_INSERT_ROOT
+    DB_PLACEHOLDERS = DB_INSERT_MIDDLE
+
+    for k in db_fields.keys():
+        DB_FIELDS = DB_FIELDS + k + ","
+        if db_fields[k] in GEOMETRY_TYPES and db_config["db_type"] == "sqlite":
+            # sqlite has no geometry functions, WKT is converted to WKB before binding
+            DB_PLACEHOLDERS = DB_PLACEHOLDERS + ONE_PLACEHOLDER
+        elif db_fields[k] in GEOMETRY_TYPES and k in wkb_fields:
+            DB_PLACEHOLDERS = DB_PLACEHOLDERS + "ST_GeomFromWKB(%s),"
+        elif db_fields[k] in GEOMETRY_TYPES:
+            DB_PLACEHOLDERS = DB_PLACEHOLDERS + "GeomFromText(%s),"
+        else:
+            DB_PLACEHOLDERS = DB_PLACEHOLDERS + ONE_PLACEHOLDER
+
+    return DB_FIELDS[0:-1] + DB_PLACEHOLDERS[0:-1] + DB_INSERT_TAIL
+
+
+def _wkb_fields(db_fields, first_row):
+    """
+    This is a private function which returns the geometry fields supplied as WKB bytes in the
+    first row of data, which is in db_fields order
+    """
+    wkb_fields = []
+    for k, value in zip(db_fields.keys(), first_row):
+        if db_fields[k] in GEOMETRY_TYPES and isinstance(value, (bytes, bytearray, memoryview)):
+            wkb_fields.append(k)
+    return wkb_fields
+
+
+def geometry_to_wkb(geometry_type, coordinates):
+    """
+    This function converts coordinates directly to little-endian Well Known Binary, suitable for
+    writing to a geometry column with write_to_db, without building a WKT string
+
+    Args:
+       geometry_type (str):
+            one of POINT, LINESTRING, POLYGON or MULTIPOLYGON
+       coordinates:
+            (x, y) for a POINT, a sequence of (x, y) for a LINESTRING, a sequence of rings
+            for a POLYGON and a sequence of polygons for a MULTIPOLYGON
+
+    Returns:
+       WKB as bytes
+
+    Example:
+        >>> geometry_to_wkb("POINT", (0, 10))
+        >>> geometry_to_wkb("POLYGON", [[(0, 0), (0, 1), (1, 1), (0, 0)]])
+    """
+    geometry_type = geometry_type.upper()
+    if geometry_type not in WKB_TYPE_CODES:
+        raise ValueError("geometry_to_wkb does not support geometry type {}".format(geometry_type))
+    type_code = WKB_TYPE_CODES[geometry_type]
+
+    if geometry_type == "POINT":
+        return struct.pack("<BIdd", 1, type_code, coordinates[0], coordinates[1])
+    elif geometry_type == "LINESTRING":
+        return struct.pack("<BI", 1, type_code) + _wkb_points(coordinates)
+    elif geometry_type == "POLYGON":
+        parts = [struct.pack("<BII", 1, type_code, len(coordinates))]
+        parts.extend(_wkb_points(ring) for ring in coordinates)
+        return b"".join(parts)
+    else:
+        parts = [struct.pack("<BII", 1, type_code, len(coordinates))]
+        parts.extend(geometry_to_wkb("POLYGON", polygon) for polygon in coordinates)
+        return b"".join(parts)
+
+
+def _wkb_points(points):
+    """
+    This is a private function which packs a point count followed by the points' doubles
+    """
+    n_points = len(points)
+    return struct.pack(
+        "<I{}d".format(2 * n_points), n_points, *itertools.chain.from_iterable(points)
+    )
+
+
+def _wkt_to_wkb(wkt):
+    """
+    This is a private function which converts a 2D POINT, LINESTRING, POLYGON or MULTIPOLYGON
+    in Well Known Text to little-endian WKB
+    """
+    match = re.match(r"\s*([A-Za-z]+)\s*(\(.*\))\s*$", wkt, flags=re.DOTALL)
+    if match is None or match.group(1).upper() not in WKB_TYPE_CODES:
+        raise ValueError("Cannot convert WKT '{}' to WKB".format(wkt[0:50]))
+    # The coordinates become nested JSON lists: "x y" pairs are lists and brackets replace
+    # parentheses
+    number = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+    body = re.sub(r"({0})\s+({0})".format(number), r"[\1,\2]", match.group(2))
+    try:
+        coordinates = json.loads(body.replace("(", "[").replace(")", "]"))
+    except ValueError:
+        raise ValueError("Cannot convert WKT '{}' to WKB".format(wkt[0:50]))
+    geometry_type = match.group(1).upper()
+    if geometry_type == "POINT":
+        coordinates = coordinates[0]
+    return geometry_to_wkb(geometry_type, coordinates)
+
+
+def _wkb_bounds(wkb):
+    """
+    This is a private function which returns the bounding box (min_x, min_y, max_x, max_y) of
+    a 2D WKB geometry of any type, or None if it has no points
+    """
+    xs = []
+    ys = []
+
+    def read(offset):
+        byte_order = "<" if wkb[offset] == 1 else ">"
+        (type_code,) = struct.unpack_from(byte_order + "I", wkb, offset + 1)
+        offset = offset + 5
+        if type_code == 1:
+            x, y = struct.unpack_from(byte_order + "dd", wkb, offset)
+            xs.append(x)
+            ys.append(y)
+            return offset + 16
+        elif type_code in (2, 3):
+            # A polygon is a count of rings, each like a linestring
+            (n_parts,) = struct.unpack_from(byte_order + "I", wkb, offset)
+            rings = 1 if type_code == 2 else n_parts
+            if type_code == 3:
+                offset = offset + 4
+            for _ in range(rings):
+                (n_points,) = struct.unpack_from(byte_order + "I", wkb, offset)
+                values = struct.unpack_from(
+                    byte_order + "{}d".format(2 * n_points), wkb, offset + 4
+                )
+                xs.extend(itertools.islice(values, 0, None, 2))
+                ys.extend(itertools.islice(values, 1, None, 2))
+                offset = offset + 4 + 16 * n_points
+            return offset
+        elif type_code in (4, 5, 6, 7):
+            (n_parts,) = struct.unpack_from(byte_order + "I", wkb, offset)
+            offset = offset + 4
+            for _ in range(n_parts):
+                offset = read(offset)
+            return offset
+        raise ValueError("_wkb_bounds does not support WKB type {}".format(type_code))
+
+    read(0)
+    if len(xs) == 0:
+        return None
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def _sqlite_geometry_binder(db_fields, first_row, bind_row):
+    """
+    This is a private function which wraps bind_row so that geometry fields supplied as WKT
+    in the first row are converted to WKB for sqlite
+    """
+    positions = [
+        i
+        for i, k in enumerate(db_fields.keys())
+        if db_fields[k] in GEOMETRY_TYPES and isinstance(first_row[i], str)
+    ]
+    if len(positions) == 0:
+        return bind_row
+
+    def bind(row):
+        values = list(row if bind_row is None else bind_row(row))
+        for i in positions:
+            if values[i] is not None:
+                values[i] = _wkt_to_wkb(values[i])
+        return values
+
+    return bind
+
+
+def _integer_primary_key(db_fields):
+    """
+    This is a private function which returns the field which is a sqlite INTEGER PRIMARY KEY,
+    and so the rowid, or None
+    """
+    key_fields = [k for k in db_fields.keys() if "PRIMARY KEY" in db_fields[k].upper()]
+    if len(key_fields) == 1 and db_fields[key_fields[0]].upper().split()[0] == "INTEGER":
+        return key_fields[0]
+    return None
+
+
+def _sqlite_rtrees(db_config, db_fields, table):
+    """
+    This is a private function which returns (column, R*Tree name) for each geometry column
+    of a table with an R*Tree built by finalise_db
+    """
+    table_names = [x.lower() for x in _cached_table_names(db_config)]
+    rtrees = []
+    for k, v in db_fields.items():
+        name = SQLITE_RTREE_NAME.format(table=table, column=k)
+        if v in GEOMETRY_TYPES and name.lower() in table_names:
+            rtrees.append((k, name))
+    return rtrees
+
+
+def _update_rtrees(cursor, table, rtrees, ids=None, after_rowid=None):
+    """
+    This is a private function which adds the bounding boxes of the rows with the given
+    rowids, or with rowids after after_rowid, to the R*Trees of a table
+    """
+    columns = ",".join(column for column, _ in rtrees)
+    if ids is None:
+        cursor.execute(
+            "SELECT rowid, {} FROM {} WHERE rowid > ?".format(columns, table), (after_rowid,)
+        )
+        rows = cursor.fetchall()
+    else:
+        rows = []
+        ids = iter(ids)
+        while True:
+            chunk = list(itertools.islice(ids, 999))
+            if len(chunk) == 0:
+                break
+            cursor.execute(
+                "SELECT rowid, {} FROM {} WHERE rowid IN ({})".format(
+                    columns, table, ",".join(["?"] * len(chunk))
+                ),
+                chunk,
+            )
+            rows.extend(cursor.fetchall())
+
+    for i, (_, name) in enumerate(rtrees, start=1):
+        cursor.executemany(
+            "INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?, ?)".format(name),
+            _rtree_entries((row[0], row[i]) for row in rows),
+        )
+
+
+def _rtree_entries(rows):
+    """
+    This is a private function which turns (rowid, WKB) pairs into R*Tree rows of rowid,
+    min_x, max_x, min_y, max_y, skipping empty geometries
+    """
+    for rowid, wkb in rows:
+        if wkb is None:
+            continue
+        bounds = _wkb_bounds(wkb)
+        if bounds is not None:
+            yield (rowid, bounds[0], bounds[2], bounds[1], bounds[3])
+
+
+def _row_binder(db_fields, first_row):
+    """
+    This is a private function which returns a callable mapping a dictionary row onto a tuple
+    in db_fields order, or None if rows are sequences which can be bound as they are
+    """
+    if not isinstance(first_row, dict):
+        return None
+    fieldnames = list(db_fields.keys())
+    if len(fieldnames) == 1:
+        fieldname = fieldnames[0]
+        return lambda row: (row[fieldname],)
+    return operator.itemgetter(*fieldnames)
+
+
+def _estimate_row_bytes(row):
+    """
+    This is a private function which cheaply estimates the size of a row's values in bytes,
+    strings and bytes count their length and anything else 8 bytes
+    """
+    values = row.values() if isinstance(row, dict) else row
+    size = 0
+    for value in values:
+        if isinstance(value, (str, bytes, bytearray)):
+            size = size + len(value)
+        else:
+            size = size + 8
+    return size
+
+
+def _key_fields(db_config, db_fields, table):
+    """
+    This is a private function which returns the primary key fields of a table, from
+    db_fields or else from the database, and whether it is a single integer key
+    """
+    key_fields = [k for k in db_fields.keys() if "PRIMARY KEY" in db_fields[k].upper()]
+    if len(key_fields) == 0:
+        key_fields = get_primary_key_columns(db_config, table)
+    if len(key_fields) == 0:
+        raise ValueError("write_to_db key_index needs a primary key for table {}".format(table))
+    integer = len(key_fields) == 1 and "INT" in db_fields.get(key_fields[0], "").upper()
+    return key_fields, integer
+
+
+def _key_getter(db_config, db_fields, table, first_row):
+    """
+    This is a private function which returns a callable giving the key index entry for a
+    row
+    """
+    key_fields, integer = _key_fields(db_config, db_fields, table)
+    if isinstance(first_row, dict):
+        values_of = operator.itemgetter(*key_fields)
+    else:
+        fieldnames = list(db_fields.keys())
+        values_of = operator.itemgetter(*[fieldnames.index(k) for k in key_fields])
+
+    if len(key_fields) == 1:
+        return lambda row: _key_entry((values_of(row),), integer)
+    return lambda row: _key_entry(values_of(row), integer)
+
+
+def _key_entry(values, integer=False):
+    """
+    This is a private function which returns the value of a single integer key as it is and
+    a 64-bit hash of any other key, with bit 64 set to keep hashes apart from integer keys
+    """
+    if integer and isinstance(values[0], int):
+        return values[0]
+    digest = hashlib.blake2b(
+        "\x1f".join([repr(value) for value in values]).encode("utf-8"), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, "little") | (1 << 64)
+
+
+def _table_key_index(db_config, db_fields, table):
+    """
+    This is a private function which returns the key index set for a table, reading every
+    primary key from the table to build it the first time
+    """
+    index_key = (_db_key(db_config), table)
+    with _key_index_lock:
+        known_keys = _key_indexes.get(index_key)
+    if known_keys is not None:
+        return known_keys
+
+    key_fields, integer = _key_fields(db_config, db_fields, table)
+    known_keys = set()
+    conn, cursor = _execute_with_retry(
+        dict(db_config),
+        "SELECT {} FROM {}".format(",".join(key_fields), table),
+        "write_to_db key index",
+        unbuffered=True,
+    )
+    try:
+        while True:
+            rows = cursor.fetchmany(10000)
+            if len(rows) == 0:
+                break
+            known_keys.update(_key_entry(row, integer) for row in rows)
+    finally:
+        conn.close()
+    logger.info("write_to_db key index for table {} holds {} keys".format(table, len(known_keys)))
+
+    with _key_index_lock:
+        return _key_indexes.setdefault(index_key, known_keys)
+
+
+def _current_rss():
+    """
+    This is a private function which returns the resident memory of this process in bytes
+    from /proc, or None where that is not available
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def _write_batches(cursor, INSERT_statement, data, bind_row, batch_bytes, sample_size=100):
+    """
+    This is a private function which writes data with executemany in batches sized to fit
+    batch_bytes, adapting the batch size to the observed rows/sec and memory use
+
+    Returns:
+       dict of batches written, the rows in each as batch_sizes, final batch_rows,
+       max_batch_bytes estimated for the largest batch, rows_per_second of the best batch and
+       the memory overhead per estimated row byte
+    """
+    sample = list(itertools.islice(data, sample_size))
+    row_bytes = max(1, sum(_estimate_row_bytes(row) for row in sample) / len(sample))
+    # Bound parameters are escaped and copied into the statement so each row costs more than
+    # its values, this starting guess is replaced by a measurement if tracemalloc is on
+    overhead = 2.0
+
+    def rows_in_budget():
+        return max(1, int(batch_bytes / (row_bytes * overhead)))
+
+    batch_rows = min(rows_in_budget(), 1000)
+    # Hill climb on rows/sec, keep moving while throughput clearly improves, turn back when it
+    # clearly falls and otherwise prefer larger batches since they save round trips
+    step = 2.0
+    last_rate = None
+    best_rate = 0.0
+    batch_sizes = []
+    max_batch_bytes = 0
+    measured_rows = 0
+    rows = iter(data)
+    while True:
+        batch = list(itertools.islice(rows, batch_rows))
+        if not batch:
+            break
+        # A cheap look at each batch catches wider rows later in the data
+        row_bytes = max(
+            row_bytes, max(_estimate_row_bytes(row) for row in itertools.islice(batch, 10))
+        )
+        max_batch_bytes = max(max_batch_bytes, sum(_estimate_row_bytes(row) for row in batch))
+
+        # The peak is not reset since it belongs to whoever started tracing, for example
+        # write_profile, so a batch is only measured when it raises the peak
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            traced_before, peak_before = tracemalloc.get_traced_memory()
+        rss_before = _current_rss()
+        start = time.perf_counter()
+        cursor.executemany(INSERT_statement, batch if bind_row is None else map(bind_row, batch))
+        elapsed = time.perf_counter() - start
+        rss_after = _current_rss()
+
+        # Part of the peak is a fixed cost per executemany, so only a batch at least as large
+        # as the last one measured updates the overhead, otherwise smaller batches would
+        # inflate it and shrink the next batch in turn
+        peak_after = tracemalloc.get_traced_memory()[1] if tracing else 0
+        if tracing and peak_after > peak_before and len(batch) >= measured_rows:
+            overhead = max(1.0, (peak_after - traced_before) / (row_bytes * len(batch)))
+            measured_rows = len(batch)
+        elif rss_before is not None and rss_after is not None:
+            if rss_after - rss_before > batch_bytes:
+                overhead = overhead * 2
+
+        batch_sizes.append(len(batch))
+        rate = len(batch) / max(elapsed, 1e-9)
+        best_rate = max(best_rate, rate)
+        if last_rate is not None:
+            if rate < last_rate * 0.9:
+                step = 1 / step
+            elif rate <= last_rate * 1.1:
+                step = 2.0
+        last_rate = rate
+        batch_rows = max(1, min(int(batch_rows * step), rows_in_budget()))
+
+    return {
+        "batches": len(batch_sizes),
+        "batch_sizes": batch_sizes,
+        "batch_rows": batch_rows,
+        "max_batch_bytes": max_batch_bytes,
+        "rows_per_second": best_rate,
+        "overhead": overhead,
+    }
+
+
+class BufferedWriter:
+    """
+    This class accumulates small writes per table and passes them to write_to_db in larger
+    batches from a background thread, once a row count, byte size or age threshold is reached
+
+    Args:
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+       db_fields (OrderedDict or dictionary of OrderedDicts):
+            A dictionary of fieldnames and types, either for every table or per table
+
+    Keyword args:
+       max_rows (int):
+            flush once this many rows are buffered
+       max_bytes (int):
+            flush once the buffered rows are estimated to hold this many bytes
+       max_seconds (float):
+            flush once the oldest buffered row is this many seconds old
+       whatever (bool):
+            passed to write_to_db, rows rejected are collected in the rejected attribute
+       clock (callable):
+            returns the current time in seconds for the age threshold, time.monotonic by default
+
+    Notes:
+        Buffered rows are flushed by close(), on leaving a with block and, if the writer is
+        not closed, when the interpreter exits normally or with an unhandled exception. Rows
+        still buffered when the process is killed are lost. An error raised while writing in
+        the background is raised again by the next call to write, flush or close. The rows
+        of the table which failed and of any tables not yet written stay buffered and are
+        tried again by the next flush; if close fails they are attached to the error raised
+        as unwritten_rows, a dictionary of rows per table. At interpreter exit nothing is
+        raised, the error and the number of rows left unwritten per table are logged.
+
+    Example:
+        >>> with BufferedWriter(db_file_path, db_fields, max_rows=5000) as writer:
+                for row in scrape():
+                    writer.write([row], table="test")
+        >>> writer.metrics()
+    """
+
+    def __init__(
+        self,
+        db_config,
+        db_fields,
+        max_rows=1000,
+        max_bytes=1024 * 1024,
+        max_seconds=5.0,
+        whatever=False,
+        clock=time.monotonic,
+    ):
+        self.db_config = _normalise_config(db_config)
+        self.db_fields = db_fields
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.whatever = whatever
+        self.rejected = []
+        self._clock = clock
+
+        self._condition = threading.Condition()
+        self._buffers = OrderedDict()
+        self._buffered_rows = 0
+        self._buffered_bytes = 0
+        self._oldest = None
+        self._writing = False
+        self._flush_requested = False
+        self._closing = False
+        self._error = None
+        self._metrics = {
+            "rows_written": 0,
+            "batches": 0,
+            "min_batch": None,
+            "max_batch": 0,
+            "flush_reasons": {"rows": 0, "bytes": 0, "time": 0, "explicit": 0},
+        }
+
+        self._thread = threading.Thread(target=self._run, name="BufferedWriter", daemon=True)
+        self._thread.start()
+        atexit.register(self._close_at_exit)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data, table="property_data"):
+        """
+        Buffers a list of rows, as for write_to_db, for a table
+        """
+        self._raise_error()
+        with self._condition:
+            if self._closing:
+                raise ValueError("BufferedWriter is closed")
+            self._buffers.setdefault(table, []).extend(data)
+            self._buffered_rows = self._buffered_rows + len(data)
+            self._buffered_bytes = self._buffered_bytes + sum(_estimate_row_bytes(x) for x in data)
+            # The background thread is woken to start the age timer or to flush
+            if self._oldest is None:
+                self._oldest = self._clock()
+                self._condition.notify_all()
+            elif self._flush_reason() is not None:
+                self._condition.notify_all()
+
+    def flush(self):
+        """
+        Writes all buffered rows, returning when they have been committed
+        """
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            while (self._buffered_rows != 0 or self._writing) and self._error is None:
+                self._condition.wait()
+        self._raise_error()
+
+    def close(self):
+        """
+        Flushes buffered rows and stops the background thread
+        """
+        atexit.unregister(self._close_at_exit)
+        if self._thread.is_alive():
+            with self._condition:
+                self._closing = True
+                self._condition.notify_all()
+            self._thread.join()
+        with self._condition:
+            err = self._error
+            self._error = None
+            if err is not None:
+                err.unwritten_rows = self._buffers
+                self._buffers = OrderedDict()
+                self._buffered_rows = 0
+                self._buffered_bytes = 0
+        if err is not None:
+            raise err
+
+    def metrics(self):
+        """
+        Returns a dictionary of the batch sizes achieved: rows_written, batches, min_batch,
+        max_batch, mean_batch and a count of flush_reasons
+        """
+        with self._condition:
+            metrics = dict(self._metrics)
+            metrics["flush_reasons"] = dict(self._metrics["flush_reasons"])
+        metrics["mean_batch"] = (
+            metrics["rows_written"] / metrics["batches"] if metrics["batches"] != 0 else 0.0
+        )
+        return metrics
+
+    def _flush_reason(self):
+        # Nothing is retried until the caller has been given the last error
+        if self._buffered_rows == 0 or self._error is not None:
+            return None
+        if self._buffered_rows >= self.max_rows:
+            return "rows"
+        if self._buffered_bytes >= self.max_bytes:
+            return "bytes"
+        if self._clock() - self._oldest >= self.max_seconds:
+            return "time"
+        if self._flush_requested or self._closing:
+            return "explicit"
+        return None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                reason = self._flush_reason()
+                while reason is None and not self._closing:
+                    timeout = None
+                    if self._oldest is not None and self._error is None:
+                        timeout = max(0.0, self._oldest + self.max_seconds - self._clock())
+                    self._flush_requested = False
+                    self._condition.notify_all()
+                    self._condition.wait(timeout)
+                    reason = self._flush_reason()
+                if reason is None:
+                    return
+                buffers = list(self._buffers.items())
+                oldest = self._oldest
+                self._buffers = OrderedDict()
+                self._buffered_rows = 0
+                self._buffered_bytes = 0
+                self._oldest = None
+                self._writing = True
+
+            written = 0
+            try:
+                for table, rows in buffers:
+                    self._write_batch(table, rows, reason)
+                    written = written + 1
+            except Exception as err:
+                logger.critical("BufferedWriter failed writing to the database: {}".format(err))
+                self._rebuffer(buffers[written:], oldest, err)
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
+
+    def _write_batch(self, table, rows, reason):
+        db_fields = self.db_fields
+        if table in db_fields and not isinstance(db_fields[table], str):
+            db_fields = db_fields[table]
+        rejected = write_to_db(rows, self.db_config, db_fields, table=table, whatever=self.whatever)
+        with self._condition:
+            self.rejected.extend(rejected)
+            self._metrics["rows_written"] += len(rows)
+            self._metrics["batches"] += 1
+            self._metrics["max_batch"] = max(self._metrics["max_batch"], len(rows))
+            if self._metrics["min_batch"] is None or len(rows) < self._metrics["min_batch"]:
+                self._metrics["min_batch"] = len(rows)
+            self._metrics["flush_reasons"][reason] += 1
+        logger.debug("BufferedWriter wrote {} rows to {} ({})".format(len(rows), table, reason))
+
+    def _rebuffer(self, unwritten, oldest, err):
+        # Rows not written go back ahead of anything buffered during the failed flush
+        with self._condition:
+            newer = self._buffers
+            self._buffers = OrderedDict(unwritten)
+            for table, rows in newer.items():
+                self._buffers[table] = self._buffers.get(table, []) + rows
+            for table, rows in unwritten:
+                self._buffered_rows = self._buffered_rows + len(rows)
+                self._buffered_bytes = self._buffered_bytes + sum(
+                    _estimate_row_bytes(x) for x in rows
+                )
+            self._oldest = oldest
+            self._error = err
+
+    def _close_at_exit(self):
+        try:
+            self.close()
+        except Exception as err:
+            unwritten = getattr(err, "unwritten_rows", {})
+            logger.critical(
+                "BufferedWriter failed writing at exit: {}, rows unwritten: {}".format(
+                    err, {table: len(rows) for table, rows in unwritten.items()}
+                )
+            )
+
+    def _raise_error(self):
+        with self._condition:
+            err = self._error
+            self._error = None
+            # The background thread waits without a timeout while an error is pending, so
+            # it is woken to restart the age timer
+            if err is not None:
+                self._condition.notify_all()
+        if err is not None:
+            raise err
+
+
+@_with_retry
+def update_to_db(data, db_config, db_fields, table="property_data", key=["UPRN"]):
+    """
+    This function updates rows in a sqlite or MariaDB/MySQL database
+
+    Args:
+       data (list of lists or dictionaries):
+            List of lists of data to update to database, order matches db_fields
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+       db_fields (OrderedDict):
+            A list of fieldnames in an OrderedDict containing the fields to update and
+            the key field in the order in which the fields are presented in the data lists
+
+    Keyword args:
+       table (str):
+            name of table to which we are writing, key to db_fields
+       key (str):
+            the field which forms the key of the update
+
+    Returns:
+       No return value
+
+    Notes:
+        As for write_to_db, sqlite geometry columns given WKT are stored as WKB, and the
+        R*Tree built by finalise_db(spatial=True) is updated with the new bounding boxes.
+
+    Example:
+        >>> db_fields = OrderedDict([
+              ("UPRN","INTEGER PRIMARY KEY"),
+              ("PropertyID", "INT"),
+              ("Addr1", "TEXT"),
+        ])
+        >>> db_filename = "test_write_db.sqlite"
+        >>> db_dir = "ihutilities\\fixtures"
+        >>> db_file_path = os.path.join(db_dir, db_filename)
+        >>> data = [(1, 2, "hello"),
+                    (2, 3, "Fred"),
+                    (3, 3, "Beans")]
+        >>> update_fields = ["Addr1", "UPRN"]
+        >>> update = [("Some", 3)]
+        >>> update_to_db(update, db_file_path, update_fields, table="test", key="UPRN")
+    """
+    if isinstance(key, str):
+        key = [key]
+
+    db_config = _normalise_config(db_config)
+    _forget_key_indexes(db_config)
+
+    if db_config.get("db_shards"):
+        for shard_config in _shard_configs(db_config):
+            update_to_db(data, shard_config, db_fields, table=table, key=key)
+        return
+
+    PLACEHOLDER = ""
+    DB_UPDATE_TAIL = ""
+    if db_config["db_type"] == "sqlite":
+        # WHERE KEY1 = ?
+        # WHERE KEY1 = ? AND KEY2 = ?
+        # WHERE KEY1 = ? AND KEY2 = ? AND KEY3 = ?
+        DB_UPDATE_TAIL = " WHERE "
+        joiner = ""
+        for k in key:
+            DB_UPDATE_TAIL = DB_UPDATE_TAIL + "{} {} = ?".format(joiner, k)
+            joiner = "AND"
+        PLACEHOLDER = " = ?,"
+    elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
+        DB_UPDATE_TAIL = " WHERE "
+        joiner = ""
+        for k in key:
+            DB_UPDATE_TAIL = DB_UPDATE_TAIL + "{} {} = %s".format(joiner, k)
+            joiner = "AND"
+        PLACEHOLDER = " = %s,"
+
+    # sqlite stores geometries as WKB, so WKT is converted as write_to_db does, and the
+    # bounding boxes of updated rows are replaced in any R*Tree built by finalise_db
+    geometry_fields = set()
+    rtrees = []
+    rtree_ids = []
+    if db_config["db_type"] == "sqlite":
+        columns_schema = get_table_columns(db_config, table)
+        geometry_fields = set(k for k, v in columns_schema.items() if v.upper() in GEOMETRY_TYPES)
+        rtrees = _sqlite_rtrees(db_config, columns_schema, table)
+
+    conn = _make_connection(db_config)
+    cursor = conn.cursor()
+    DB_UPDATE_ROOT = "UPDATE {} SET ".format(table)
+
+    key_indices = []
+    for k in key:
+        key_index = db_fields.index(k)
+        key_indices.append(key_index)
+
+    # convert a list of dictionary to a list of lists, if required:
+
+    converted_data = []
+    if isinstance(data[0], dict):
+        for row in data:
+            converted_data.append([x for x in row.values()])
+
+        if db_fields != list(data[0].keys()):
+            raise KeyError(
+                f"db_fields supplied to update_to_db ('{db_fields}')"
+                f"do not match fields in update dictionary {list(data[0].keys())}"
+            )
+    else:
+        converted_data = data
+    for row in converted_data:
+        # print(update_statement, [x for x in row])
+        key_vals = []
+        for k in key_indices:
+            key_vals.append(row[k])
+        update_fields = []
+        update_data = []
+        for i, _ in enumerate(row):
+            if i not in key_indices and row[i] is not None:
+                update_fields.append(db_fields[i])
+                if db_fields[i] in geometry_fields and isinstance(row[i], str):
+                    update_data.append(_wkt_to_wkb(row[i]))
+                else:
+                    update_data.append(row[i])
+
+        update_statement = ""
+        DB_FIELDS = DB_UPDATE_ROOT
+        for k in update_fields:
+            DB_FIELDS = DB_FIELDS + k + PLACEHOLDER
+            update_statement = DB_FIELDS[0:-1] + DB_UPDATE_TAIL
+
+        update_data.extend(key_vals)
+        if len(update_fields) != 0:
+            logging.debug(
+                "Attempting update with statement = '{}' and data = '{}'".format(
+                    update_statement, update_data
+                )
+            )
+            cursor.execute(update_statement, update_data)
+            if any(k in geometry_fields for k in update_fields) and len(rtrees) != 0:
+                cursor.execute("SELECT rowid FROM {}".format(table) + DB_UPDATE_TAIL, key_vals)
+                rtree_ids.extend(x[0] for x in cursor.fetchall())
+
+    if len(rtree_ids) != 0:
+        _update_rtrees(cursor, table, rtrees, ids=rtree_ids)
+    conn.commit()
+    conn.close()
+
+
+@_with_retry
+def drop_db_tables(db_config, tables):
+    db_config = _normalise_config(db_config)
+    if db_config.get("db_shards"):
+        for shard_config in _shard_configs(db_config):
+            drop_db_tables(shard_config, tables)
+        clear_metadata_cache(db_config)
+        return
+
+    rtree_names = []
+    if db_config["db_type"] == "sqlite":
+        # The R*Trees built by finalise_db(spatial=True) go with their tables
+        for table in tables:
+            for k, v in get_table_columns(db_config, table).items():
+                if v.upper() in GEOMETRY_TYPES:
+                    rtree_names.append(SQLITE_RTREE_NAME.format(table=table, column=k))
+
+    conn = _make_connection(db_config)
+    cursor = conn.cursor()
+
+    for table in list(tables) + rtree_names:
+        cursor.execute("DROP TABLE IF EXISTS {}".format(table))
+    conn.close()
+    clear_metadata_cache(db_config)
+
+
+@_with_retry
+def finalise_db(
+    db_config,
+    index_name="idx_postcode",
+    table="property_data",
+    colname="postcode",
+    spatial=False,
+    staging_complete=True,
+):
+    """
+    This function creates an index in a sqlite or MariaDB/MySQL database
+
+    Args:
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+
+    Keyword args:
+       index_name (str):
+            name of the index to be created
+       table (str):
+            the table on which the index is to be created
+       colname (str):
+            the column on which the index is to be created
+       spatial (bool):
+            True for a spatial index, false otherwise. sqlite has no spatial index so instead
+            an R*Tree virtual table of the bounding boxes of colname, named
+            {table}_{colname}_rtree, is built in bulk, replacing any existing one, and
+            index_name is not used. write_to_db adds new rows to the R*Tree and read_db_bbox
+            queries it.
+       staging_complete (bool):
+            for a sqlite database staged in memory (see configure_db), True copies it to disk
+            after the index is built and ends staging. Pass False for all but the last of
+            several finalise_db calls so that every index is built in memory.
+
+    Returns:
+       No return value
+
+    Notes:
+       The sqlite R*Tree is keyed on rowid so the table must not be WITHOUT ROWID. Rows
+       removed by delete_from_db leave entries in the R*Tree which read_db_bbox ignores, and
+       update_to_db keeps the R*Tree up to date for the geometries it changes.
+
+    """
+
+    db_config = _normalise_config(db_config)
+
+    if db_config.get("db_shards"):
+        for shard_config in _shard_configs(db_config):
+            finalise_db(
+                shard_config,
+                index_name=index_name,
+                table=table,
+                colname=colname,
+                spatial=spatial,
+                staging_complete=staging_complete,
+            )
+        return
+
+    if spatial and db_config["db_type"] == "sqlite":
+        _build_sqlite_rtree(db_config, table, colname)
+        if staging_complete:
+            commit_staged_db(db_config)
+        return
+
+    conn = _make_connection(db_config)
+    cursor = conn.cursor()
+
+    if isinstance(colname, list):
+        colname = ",".join(colname)
+
+    time_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    logger.info(
+        "Creating index named '{}' on column(s) '{}' at {}".format(index_name, colname, time_str)
+    )
+    if spatial:
+        cursor.execute(
+            "CREATE SPATIAL INDEX {index_name} on {table}({colname})".format(
+                index_name=index_name, table=table, colname=colname
+            )
+        )
+    else:
+        cursor.execute(
+            "CREATE INDEX {index_name} on {table}({colname} ASC)".format(
+                index_name=index_name, table=table, colname=colname
+            )
+        )
+    conn.commit()
+    conn.close()
+
+    if staging_complete and db_config["db_type"] == "sqlite":
+        commit_staged_db(db_config)
+
+
+def _build_sqlite_rtree(db_config, table, colname):
+    """
+    This is a private function which builds an R*Tree of the bounding boxes of the WKB
+    geometries in a sqlite column
+    """
+    if not _sqlite_has_rowid(db_config, table):
+        raise ValueError(
+            "An R*Tree cannot be built for table '{}' since it is WITHOUT ROWID".format(table)
+        )
+    rtree_name = SQLITE_RTREE_NAME.format(table=table, column=colname)
+
+    time_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    logger.info("Creating R*Tree '{}' on column '{}' at {}".format(rtree_name, colname, time_str))
+
+    conn = _make_connection(db_config)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("DROP TABLE IF EXISTS {}".format(rtree_name))
+        cursor.execute(
+            "CREATE VIRTUAL TABLE {} USING rtree(id, min_x, max_x, min_y, max_y)".format(rtree_name)
+        )
+        # A second cursor streams the geometries while the first inserts their bounding boxes
+        geometries = conn.cursor()
+        geometries.execute(
+            "SELECT rowid, {colname} FROM {table} WHERE {colname} IS NOT NULL".format(
+                colname=colname, table=table
+            )
+        )
+        cursor.executemany(
+            "INSERT INTO {} VALUES (?, ?, ?, ?, ?)".format(rtree_name), _rtree_entries(geometries)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    _record_created_table(db_config, rtree_name)
+
+
+def recommend_indexes(db_config, create=False, limit=5):
+    """
+    This function recommends indexes from the queries recorded by read_db and delete_from_db
+    for a database with db_index_advisor set in its db_config, and optionally creates them
+    with finalise_db
+
+    Args:
+       db_config (dict):
+            the db_config the queries were run with, which has db_index_advisor set to True
+
+    Keyword args:
+       create (bool):
+            if True the recommended indexes are created
+       limit (int):
+            the maximum number of indexes to recommend
+
+    Returns:
+       A list of dictionaries, largest benefit first, each with the table, columns and
+       index_name of the index, the number of executions of the queries it helps, the
+       table_rows scanned by those queries now, a benefit of executions * table_rows, the
+       estimated_bytes of the index and its write_overhead, the fractional increase in
+       B-tree inserts per row written, counting sqlite's automatic index for a primary key
+       which is not an INTEGER PRIMARY KEY
+
+    Notes:
+        The WHERE, JOIN ... ON and ORDER BY columns of each query are found with regular
+        expressions rather than a SQL parser, so unusual queries may be missed. Only tables
+        which the query plan shows as fully scanned, or sorted without an index, get
+        recommendations. Equality columns come first, then at most one range column, then
+        the ORDER BY columns if no range column is used.
+
+    Example:
+        >>> db_config = {**db_config_template, "db_type": "sqlite", "db_path": db_file_path,
+                         "db_index_advisor": True}
+        >>> rows = list(read_db("select * from test where PropertyID = 3;", db_config))
+        >>> recommend_indexes(db_config, create=True)
+    """
+    db_config = _normalise_config(db_config)
+    _refuse_shards(db_config, "recommend_indexes")
+
+    with _query_log_lock:
+        queries = list(_query_log.get(_db_key(db_config), {}).items())
+
+    quiet_config = dict(db_config, db_index_advisor=False)
+    candidates = {}
+    for sql_query, record in queries:
+        usage = _query_columns(sql_query, quiet_config)
+        for table, scanned, sorted_ in _query_plan_scans(quiet_config, sql_query, record["params"]):
+            columns = _candidate_index_columns(usage, table, scanned, sorted_)
+            if len(columns) == 0:
+                continue
+            entry = candidates.setdefault((table, tuple(columns)), {"executions": 0})
+            entry["executions"] = entry["executions"] + record["count"]
+
+    # An index on (a, b) also serves queries wanting (a), so shorter prefixes are folded in
+    for table, columns in sorted(candidates, key=lambda x: len(x[1])):
+        for other_table, other_columns in candidates:
+            if (
+                other_table == table
+                and len(other_columns) > len(columns)
+                and tuple(itertools.islice(other_columns, len(columns))) == columns
+                and "executions" in candidates[(table, columns)]
+            ):
+                candidates[(other_table, other_columns)]["executions"] += candidates[
+                    (table, columns)
+                ].pop("executions")
+                break
+
+    recommendations = []
+    taken = set()
+    if db_config["db_type"] == "sqlite":
+        # sqlite index names are unique across the database
+        taken.update(
+            x["name"]
+            for x in read_db("SELECT name FROM sqlite_master WHERE type = 'index'", quiet_config)
+        )
+    for (table, columns), entry in candidates.items():
+        if "executions" not in entry:
+            continue
+        existing = _existing_indexes(quiet_config, table)
+        if any(
+            tuple(itertools.islice(index, len(columns))) == columns for index in existing.values()
+        ):
+            continue
+        table_rows, key_bytes = _index_size_estimate(quiet_config, table, columns)
+        index_name = _recommended_index_name(table, columns, taken.union(existing.keys()))
+        taken.add(index_name)
+        recommendations.append(
+            {
+                "table": table,
+                "columns": list(columns),
+                "index_name": index_name,
+                "executions": entry["executions"],
+                "table_rows": table_rows,
+                "benefit": entry["executions"] * table_rows,
+                "estimated_bytes": int(table_rows * (key_bytes + 8)),
+                "write_overhead": 1.0 / _index_btrees(quiet_config, table, existing),
+            }
+        )
+
+    recommendations = sorted(recommendations, key=lambda x: x["benefit"], reverse=True)[0:limit]
+
+    if create:
+        for i, recommendation in enumerate(recommendations):
+            finalise_db(
+                db_config,
+                index_name=recommendation["index_name"],
+                table=recommendation["table"],
+                colname=recommendation["columns"],
+                staging_complete=(i == len(recommendations) - 1),
+            )
+
+    return recommendations
+
+
+def clear_query_log(db_config=None):
+    """
+    Forgets the queries recorded for recommend_indexes
+
+    Keyword args:
+       db_config (str or dict):
+            the database to forget, if None then every database is forgotten
+
+    Returns:
+       No return value
+    """
+    with _query_log_lock:
+        if db_config is None:
+            _query_log.clear()
+        else:
+            _query_log.pop(_db_key(_normalise_config(db_config)), None)
+
+
+def _record_query(db_config, sql_query, params):
+    """
+    This is a private function which counts executions of a query for recommend_indexes, if
+    db_index_advisor is set, keeping the params of its first execution for EXPLAIN
+    """
+    if not db_config.get("db_index_advisor"):
+        return
+    with _query_log_lock:
+        log = _query_log.setdefault(_db_key(db_config), OrderedDict())
+        record = log.get(sql_query)
+        if record is None:
+            if len(log) >= QUERY_LOG_LIMIT:
+                return
+            record = log[sql_query] = {"count": 0, "params": params}
+        record["count"] = record["count"] + 1
+
+
+def _query_columns(sql_query, db_config):
+    """
+    This is a private function which finds the tables of a query and the columns it uses in
+    WHERE, JOIN ... ON and ORDER BY clauses, as lists of (table, column, kind) where kind is
+    equality, range or order
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql_query)
+    sql = re.sub(r"\s+", " ", sql).strip().rstrip(";")
+
+    aliases = _table_aliases(sql)
+    tables = list(OrderedDict.fromkeys(aliases.values()))
+
+    def resolve(name):
+        qualifier, _, column = name.rpartition(".")
+        if qualifier:
+            table = aliases.get(qualifier)
+            return None if table is None else (table, column)
+        if len(tables) == 1:
+            return (tables[0], column)
+        for table in tables:
+            if column in get_table_columns(db_config, table):
+                return (table, column)
+        return None
+
+    clause_end = r"(?=\b(?:GROUP BY|ORDER BY|LIMIT|HAVING|UNION|JOIN|INNER|LEFT|RIGHT|WHERE)\b|$)"
+    used = []
+    column = r"([A-Za-z_][\w]*(?:\.[A-Za-z_]\w*)?)"
+    for clause in re.findall(r"\b(?:WHERE|ON)\b(.*?)" + clause_end, sql, flags=re.IGNORECASE):
+        for match in re.finditer(
+            column + r"\s*(=|<=|>=|<>|!=|<|>|\bIN\b|\bIS\b|\bBETWEEN\b|\bLIKE\b)",
+            clause,
+            flags=re.IGNORECASE,
+        ):
+            name, operator_ = match.group(1), match.group(2).upper()
+            if name.lower() in SQL_KEYWORDS:
+                continue
+            kind = "equality" if operator_ in ("=", "IN", "IS") else "range"
+            resolved = resolve(name)
+            if resolved is not None:
+                used.append(resolved + (kind,))
+        # Both sides of a join condition can use an index
+        for match in re.finditer(column + r"\s*=\s*" + column, clause):
+            resolved = resolve(match.group(2))
+            if resolved is not None and match.group(2).lower() not in SQL_KEYWORDS:
+                used.append(resolved + ("equality",))
+
+    for clause in re.findall(r"\bORDER BY\b(.*?)(?=\bLIMIT\b|$)", sql, flags=re.IGNORECASE):
+        for item in clause.split(","):
+            name = re.sub(r"\s+(ASC|DESC)$", "", item.strip(), flags=re.IGNORECASE)
+            if re.fullmatch(column, name):
+                resolved = resolve(name)
+                if resolved is not None:
+                    used.append(resolved + ("order",))
+
+    return used
+
+
+def _table_aliases(sql_query):
+    """
+    This is a private function which maps the tables of a query, and their aliases, to their
+    table names
+    """
+    aliases = OrderedDict()
+    for match in re.finditer(
+        r"\b(?:FROM|JOIN|UPDATE|INTO)\s+`?([A-Za-z_]\w*)`?(?:\s+(?:AS\s+)?([A-Za-z_]\w*))?",
+        sql_query,
+        flags=re.IGNORECASE,
+    ):
+        table, alias = match.group(1), match.group(2)
+        aliases[table] = table
+        if alias is not None and alias.lower() not in SQL_KEYWORDS:
+            aliases[alias] = table
+    return aliases
+
+
+def _query_plan_scans(db_config, sql_query, params):
+    """
+    This is a private function which returns (table, scanned, sorted) for each table in a
+    query's plan, scanned if it is read in full and sorted if rows are sorted without an index
+    """
+    if db_config["db_type"] == "sqlite":
+        plan = list(read_db("EXPLAIN QUERY PLAN " + sql_query, db_config, params=params))
+        details = [row["detail"] for row in plan]
+        sorted_ = any("TEMP B-TREE FOR ORDER BY" in detail for detail in details)
+        aliases = _table_aliases(sql_query)
+        results = []
+        for detail in details:
+            match = re.match(r"(SCAN|SEARCH)(?: TABLE)? (\w+)(?: AS (\w+))?(.*)", detail)
+            if match is None:
+                continue
+            table = aliases.get(match.group(2), match.group(2))
+            scanned = match.group(1) == "SCAN" and "INDEX" not in match.group(4)
+            results.append((table, scanned, sorted_))
+        return results
+
+    plan = list(read_db("EXPLAIN " + sql_query, db_config, params=params))
+    aliases = _table_aliases(sql_query)
+    return [
+        (
+            aliases.get(row["table"], row["table"]),
+            row["type"] == "ALL",
+            "filesort" in (row["Extra"] or ""),
+        )
+        for row in plan
+        if row["table"] is not None
+    ]
+
+
+def _candidate_index_columns(usage, table, scanned, sorted_):
+    """
+    This is a private function which orders the columns of a table used by a query into a
+    candidate index: equality columns, then one range column, then ORDER BY columns
+    """
+    equality = [c for t, c, kind in usage if t == table and kind == "equality"]
+    ranges = [c for t, c, kind in usage if t == table and kind == "range"]
+    order = [c for t, c, kind in usage if t == table and kind == "order"]
+    order_elsewhere = any(t != table for t, _, kind in usage if kind == "order")
+
+    columns = []
+    if scanned:
+        columns = equality + ranges[0:1]
+    if sorted_ and len(ranges) == 0 and not order_elsewhere and (scanned or len(equality) == 0):
+        columns = columns + order
+    return list(OrderedDict.fromkeys(columns))[0:4]
+
+
+def _existing_indexes(db_config, table):
+    """
+    This is a private function which returns an OrderedDict of index name to columns for a
+    table, with its primary key as PRIMARY
+    """
+    indexes = OrderedDict()
+    if db_config["db_type"] == "sqlite":
+        for index in read_db("PRAGMA index_list({})".format(table), db_config):
+            name = "PRIMARY" if index["origin"] == "pk" else index["name"]
+            indexes[name] = [
+                x["name"] for x in read_db("PRAGMA index_info({})".format(index["name"]), db_config)
+            ]
+        primary_keys = get_primary_key_columns(db_config, table)
+        if len(primary_keys) != 0:
+            indexes.setdefault("PRIMARY", primary_keys)
+    else:
+        for row in read_db("SHOW INDEX FROM {}".format(table), db_config):
+            indexes.setdefault(row["Key_name"], []).append(row["Column_name"])
+    return indexes
+
+
+def _recommended_index_name(table, columns, taken):
+    """
+    This is a private function which names an index on columns of table, adding a hash of
+    the table and columns if the plain name is too long or already taken, since columns
+    ("a", "b") and ("a_b",) would otherwise share a name
+    """
+    index_name = "idx_{}_{}".format(table, "_".join(columns))
+    if len(index_name) > 64 or index_name in taken:
+        digest = hashlib.sha1("\0".join((table,) + tuple(columns)).encode("utf-8")).hexdigest()
+        index_name = "{}_{}".format(index_name[0:55], digest[0:8])
+    return index_name
+
+
+def _index_btrees(db_config, table, existing):
+    """
+    This is a private function which counts the B-trees written for each row inserted into a
+    table, the table itself and every secondary index in existing, from _existing_indexes.
+    A sqlite rowid table whose primary key is not an INTEGER PRIMARY KEY also writes the
+    automatic index enforcing that key.
+    """
+    btrees = 1 + len([x for x in existing if x != "PRIMARY"])
+    if db_config["db_type"] == "sqlite" and _sqlite_has_rowid(db_config, table):
+        index_list = list(read_db("PRAGMA index_list({})".format(table), db_config))
+        if any(index["origin"] == "pk" for index in index_list):
+            btrees = btrees + 1
+    return btrees
+
+
+def _index_size_estimate(db_config, table, columns):
+    """
+    This is a private function which returns the row count of a table and the average size
+    in bytes of the given columns, sampled from up to 1000 rows
+    """
+    table_rows = list(read_db("SELECT COUNT(*) AS n FROM {}".format(table), db_config))[0]["n"]
+    lengths = "+".join("COALESCE(LENGTH({}), 0)".format(column) for column in columns)
+    sample = list(
+        read_db(
+            "SELECT AVG({}) AS key_bytes FROM (SELECT {} FROM {} LIMIT 1000) AS sample".format(
+                lengths, ",".join(columns), table
+            ),
+            db_config,
+        )
+    )
+    return table_rows, float(sample[0]["key_bytes"] or 0)
+
+
+def read_db(sql_query, db_config, params=None, prefetch=None, prefetch_batch_size=1000):
+    """
+    This function runs a query on a sqlite or MariaDB/MySQL database, yielding rows
+
+    Args:
+       sql_query (str):
+            the query, with ? (sqlite) or %s (MariaDB/MySQL) placeholders if params are given
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+
+    Keyword args:
+       params (sequence):
+            values bound to the placeholders in sql_query
+       prefetch (int):
+            if set, a background thread runs the query on its own connection and fetches up
+            to this many batches ahead of the caller
+       prefetch_batch_size (int):
+            the number of rows in each prefetched batch
+
+    Returns:
+       A generator of OrderedDicts keyed by column name
+
+    Notes:
+        With prefetch MariaDB/MySQL results are streamed from the server with an unbuffered
+        cursor, so fetching over the network overlaps with the caller's processing. If the
+        caller stops early the background thread is stopped and its connection closed when
+        the generator is closed or garbage collected.
+
+    Example:
+        >>> for row in read_db("select * from test where UPRN = ?;", db_file_path, params=[3]):
+                print(row["Addr1"])
+    """
+    db_config = _normalise_config(db_config)
+
+    if db_config["db_type"] == "sqlite" and not _sqlite_database_exists(db_config):
+        raise IOError("Database file '{}' does not exist".format(db_config["db_path"]))
+
+    _record_query(db_config, sql_query, params)
+
+    if prefetch:
+        yield from _read_db_prefetch(sql_query, db_config, params, prefetch, prefetch_batch_size)
+        return
+
+    conn, cursor = _read_db_cursor(sql_query, db_config, params)
+
+    colnames = [x[0] for x in cursor.description]
+
+    # rows = cursor.fetchall()
+    # conn.close()
+
+    # for row in rows:
+    #     if row is not None:
+    #         labelled_row = OrderedDict(zip(colnames, row))
+    #         yield labelled_row
+
+    # The connection is closed in finally so that it is released if the caller stops early
+    try:
+        while True:
+            row = cursor.fetchone()
+            if row is not None:
+                labelled_row = OrderedDict(zip(colnames, row))
+                yield labelled_row
+            else:
+                # raise StopIteration # - this is depreciated in Python 3.5 onwards
+                return
+    finally:
+        conn.close()
+
+
+def _read_db_cursor(sql_query, db_config, params):
+    """
+    This is a private function which executes a read_db query under the retry policy and
+    returns the connection and cursor
+    """
+    try:
+        return _execute_with_retry(db_config, sql_query, "read_db", params=params)
+    except sqlite3.OperationalError as err:
+        logger.info("Caught exception {} on query '{}'".format(err, sql_query))
+        print("Caught exception {} on query '{}'".format(err, sql_query), flush=True)
+        raise
+
+
+def read_db_cached(
+    sql_query, db_config, cache_dir, params=None, version=None, max_bytes=256 * 1024**2
+):
+    """
+    This function runs a query as read_db does but keeps the result set in a file in
+    cache_dir, so identical queries against an unchanged database, from any process, read
+    the file rather than the database
+
+    Args:
+       sql_query (str):
+            the query, with ? (sqlite) or %s (MariaDB/MySQL) placeholders if params are given
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+       cache_dir (str):
+            directory holding the cached result sets, created if it does not exist
+
+    Keyword args:
+       params (sequence):
+            values bound to the placeholders in sql_query
+       version (str):
+            a token which changes whenever the database does, required for MariaDB/MySQL,
+            for sqlite it defaults to the size and modification time of the database files
+       max_bytes (int):
+            once the cache exceeds this size the least recently used result sets are removed
+
+    Returns:
+       A generator of OrderedDicts keyed by column name
+
+    Notes:
+        Results are keyed on a hash of the query, params and version. Each is written to a
+        temporary file which is renamed into place once complete, so concurrent processes
+        only ever see whole files, and read back through mmap. A result set with values of
+        a type the cache cannot store is returned but not cached. An empty result set is
+        cached as its column names alone. Staged sqlite databases are read directly, since
+        their file does not change until they are committed.
+
+    Example:
+        >>> for row in read_db_cached("select count(*) from test;", db_file_path, "cache"):
+                print(row)
+    """
+    db_config = _normalise_config(db_config)
+
+    if version is None:
+        if db_config["db_type"] != "sqlite":
+            raise ValueError("read_db_cached requires a version token for MariaDB/MySQL")
+        if _is_staged(db_config):
+            yield from read_db(sql_query, db_config, params=params)
+            return
+        version = _sqlite_version_token(db_config)
+
+    key = hashlib.sha256(
+        json.dumps(
+            [sql_query, list(params) if params is not None else None, version], default=str
+        ).encode("utf-8")
+    ).hexdigest()
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, key + RESULT_CACHE_SUFFIX)
+
+    try:
+        cache_file = open(cache_path, "rb")
+    except FileNotFoundError:
+        cache_file = None
+
+    if cache_file is not None:
+        logger.debug("read_db_cached hit for query '{}'".format(sql_query))
+        try:
+            # Touching the file marks it as recently used for eviction
+            os.utime(cache_path)
+        except OSError:
+            pass
+        with cache_file:
+            yield from _read_cached_result(cache_file)
+        return
+
+    logger.debug("read_db_cached miss for query '{}'".format(sql_query))
+    if db_config["db_type"] == "sqlite" and not _sqlite_database_exists(db_config):
+        raise IOError("Database file '{}' does not exist".format(db_config["db_path"]))
+    _record_query(db_config, sql_query, params)
+
+    # The header is written from the cursor's description, so an empty result is cached too
+    conn, cursor = _read_db_cursor(sql_query, db_config, params)
+    colnames = [x[0] for x in cursor.description]
+    temp_path = "{}.{}.{}.tmp".format(cache_path, os.getpid(), threading.get_ident())
+    temp_file = None
+    complete = False
+    try:
+        temp_file = open(temp_path, "wb")
+        _write_cache_header(temp_file, colnames)
+        while True:
+            row = cursor.fetchone()
+            if row is None:
+                break
+            row = OrderedDict(zip(colnames, row))
+            if temp_path is not None:
+                try:
+                    temp_file.write(_encode_cache_row(row.values()))
+                except TypeError as err:
+                    logger.info("read_db_cached not caching query '{}': {}".format(sql_query, err))
+                    temp_file.close()
+                    os.remove(temp_path)
+                    temp_path = None
+            yield row
+        complete = temp_path is not None
+    finally:
+        conn.close()
+        if temp_file is not None and not temp_file.closed:
+            temp_file.close()
+        if complete and temp_file is not None:
+            os.replace(temp_path, cache_path)
+            _evict_cached_results(cache_dir, max_bytes)
+        elif temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _is_staged(db_config):
+    with _staging_lock:
+        return os.path.abspath(db_config["db_path"]) in _staging_databases
+
+
+def _sqlite_version_token(db_config):
+    """
+    This is a private function which summarises the size and modification time of a sqlite
+    database, its write ahead log and any shards
+    """
+    paths = [db_config["db_path"]]
+    if db_config.get("db_shards"):
+        paths = [shard_config["db_path"] for shard_config in _shard_configs(db_config)]
+    token = []
+    for path in paths:
+        for suffix in ["", "-wal"]:
+            try:
+                stat = os.stat(path + suffix)
+            except FileNotFoundError:
+                continue
+            token.append([path + suffix, stat.st_size, stat.st_mtime_ns])
+    return token
+
+
+def _write_cache_header(cache_file, colnames):
+    header = json.dumps(colnames).encode("utf-8")
+    cache_file.write(RESULT_CACHE_MAGIC + struct.pack("<I", len(header)) + header)
+
+
+def _encode_cache_row(values):
+    """
+    This is a private function which encodes a row as a tag byte per value followed by the
+    value, raising TypeError for values it cannot store
+    """
+    parts = []
+    for value in values:
+        if value is None:
+            parts.append(b"N")
+        elif isinstance(value, bool) or (isinstance(value, int) and -(2**63) <= value < 2**63):
+            parts.append(b"i" + struct.pack("<q", value))
+        elif isinstance(value, float):
+            parts.append(b"f" + struct.pack("<d", value))
+        elif isinstance(value, (str, int, decimal.Decimal, datetime.date, datetime.timedelta)):
+            if isinstance(value, str):
+                tag, text = b"s", value
+            elif isinstance(value, int):
+                tag, text = b"I", str(value)
+            elif isinstance(value, decimal.Decimal):
+                tag, text = b"D", str(value)
+            elif isinstance(value, datetime.datetime):
+                tag, text = b"T", value.isoformat()
+            elif isinstance(value, datetime.date):
+                tag, text = b"d", value.isoformat()
+            else:
+                tag, text = b"t", repr(value.total_seconds())
+            encoded = text.encode("utf-8")
+            parts.append(tag + struct.pack("<I", len(encoded)) + encoded)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            parts.append(b"b" + struct.pack("<I", len(value)) + bytes(value))
+        else:
+            raise TypeError("cannot cache value of type {}".format(type(value).__name__))
+    return b"".join(parts)
+
+
+def _read_cached_result(cache_file):
+    """
+    This is a private function which memory maps a cached result set and yields its rows
+    """
+    with mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        if _unpack_bytes(buffer, 0, len(RESULT_CACHE_MAGIC)) != RESULT_CACHE_MAGIC:
+            raise IOError("'{}' is not a read_db_cached result set".format(cache_file.name))
+        offset = len(RESULT_CACHE_MAGIC)
+        (header_length,) = struct.unpack_from("<I", buffer, offset)
+        offset = offset + 4
+        colnames = json.loads(_unpack_bytes(buffer, offset, header_length))
+        offset = offset + header_length
+
+        text_types = {
+            b"s": str,
+            b"I": int,
+            b"D": decimal.Decimal,
+            b"T": datetime.datetime.fromisoformat,
+            b"d": datetime.date.fromisoformat,
+            b"t": lambda x: datetime.timedelta(seconds=float(x)),
+        }
+        end = len(buffer)
+        while offset < end:
+            row = []
+            for _ in colnames:
+                tag = _unpack_bytes(buffer, offset, 1)
+                offset = offset + 1
+                if tag == b"N":
+                    row.append(None)
+                elif tag == b"i":
+                    row.append(struct.unpack_from("<q", buffer, offset)[0])
+                    offset = offset + 8
+                elif tag == b"f":
+                    row.append(struct.unpack_from("<d", buffer, offset)[0])
+                    offset = offset + 8
+                else:
+                    (length,) = struct.unpack_from("<I", buffer, offset)
+                    offset = offset + 4
+                    value = _unpack_bytes(buffer, offset, length)
+                    offset = offset + length
+                    if tag == b"b":
+                        row.append(value)
+                    else:
+                        row.append(text_types[tag](value.decode("utf-8")))
+            yield OrderedDict(zip(colnames, row))
+
+
+def _unpack_bytes(buffer, offset, length):
+    return struct.unpack_from("{}s".format(length), buffer, offset)[0]
+
+
+def _evict_cached_results(cache_dir, max_bytes):
+    """
+    This is a private function which removes the least recently used result sets until the
+    cache fits in max_bytes, tolerating files removed by other processes meanwhile
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(RESULT_CACHE_SUFFIX):
+            continue
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum(entry[1] for entry in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total = total - size
+
+
+def _read_db_prefetch(sql_query, db_config, params, prefetch, batch_size):
+    """
+    This is a private function which yields the rows of a query fetched in batches by a
+    background thread into a queue of at most prefetch batches
+    """
+    batches = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Time out regularly so that a stopped reader does not leave the thread blocked
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch():
+        conn = None
+        try:
+            conn, cursor = _execute_with_retry(
+                dict(db_config), sql_query, "read_db", params=params, unbuffered=True
+            )
+            if not put([x[0] for x in cursor.description]):
+                return
+            while not stop.is_set():
+                rows = cursor.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                if not put(rows):
+                    return
+            put(done)
+        except BaseException as err:
+            put(err)
+        finally:
+            _close_quietly(conn)
+
+    thread = threading.Thread(target=fetch, name="read_db-prefetch", daemon=True)
+    thread.start()
+    try:
+        item = batches.get()
+        if isinstance(item, BaseException):
+            raise item
+        colnames = item
+        while True:
+            item = batches.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            for row in item:
+                yield OrderedDict(zip(colnames, row))
+    finally:
+        stop.set()
+        thread.join()
+
+
+class KeysetScan:
+    """
+    This class walks a table in key order one page at a time, each page selecting the rows
+    after the last key of the previous page, and can be resumed from a token
+
+    Args:
+       table (str):
+            name of the table to scan
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+
+    Keyword args:
+       key (str or list of str):
+            unique column(s) to scan in order of, by default the table's primary key or for a
+            sqlite table without one, rowid
+       columns (str or list of str):
+            columns to select
+       where (str):
+            an optional additional condition on the rows scanned
+       page_size (int):
+            the number of rows fetched by each query
+       token (str):
+            a token from an earlier scan of the same table and key, the scan continues after
+            the last row that scan yielded
+
+    Notes:
+        Unlike LIMIT/OFFSET each page is a range read on the key so later pages cost the same
+        as the first. A connection lost between or during pages is reopened under the retry
+        policy and the page read again from the last key, so the rows yielded are unaffected.
+        The token attribute is updated as each row is yielded, and can be saved to resume
+        in another process.
+
+    Example:
+        >>> scan = KeysetScan("test", db_file_path, page_size=1000)
+        >>> for row in scan:
+                process(row)
+                checkpoint(scan.token)
+    """
+
+    def __init__(
+        self, table, db_config, key=None, columns="*", where=None, page_size=10000, token=None
+    ):
+        self.table = table
+        self.db_config = _normalise_config(db_config)
+        self.page_size = page_size
+        self.pages = 0
+
+        if key is None:
+            key = get_primary_key_columns(self.db_config, table)
+            sqlite = self.db_config["db_type"] == "sqlite"
+            if len(key) == 0 and sqlite and _sqlite_has_rowid(self.db_config, table):
+                key = ["rowid"]
+            elif len(key) == 0:
+                raise ValueError("KeysetScan requires a key for table {}".format(table))
+        if isinstance(key, str):
+            key = [key]
+        self.key = key
+        if isinstance(columns, list):
+            columns = ",".join(columns)
+        elif columns == "*":
+            # MariaDB/MySQL only accept an unqualified * as the first select item
+            columns = "{}.*".format(table)
+
+        self._last_key = None
+        if token is not None:
+            state = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+            if state["table"] != table or state["key"] != key:
+                raise ValueError(
+                    "KeysetScan token is for table {} key {}".format(state["table"], state["key"])
+                )
+            self._last_key = state["last_key"]
+
+        placeholder = "?" if self.db_config["db_type"] == "sqlite" else "%s"
+        # (a, b) > (x, y) written out in full, as a > x OR (a = x AND b > y), which every
+        # backend can answer from an index on the key
+        after = []
+        for i, column in enumerate(key):
+            terms = ["{} = {}".format(k, placeholder) for k in key[0:i]]
+            terms.append("{} > {}".format(column, placeholder))
+            after.append("({})".format(" AND ".join(terms)))
+
+        # The key is selected first, aliased so as not to clash with the requested columns,
+        # so that the last key can be read whatever columns are requested
+        select = "SELECT {}, {} FROM {}".format(
+            ",".join("{} AS wow_key{}".format(k, i) for i, k in enumerate(key)), columns, table
+        )
+        order = " ORDER BY {} LIMIT {}".format(",".join(key), int(page_size))
+        conditions = [] if where is None else ["({})".format(where)]
+        self._first_query = (
+            select + (" WHERE " + " AND ".join(conditions) if conditions else "") + order
+        )
+        self._next_query = (
+            select
+            + " WHERE "
+            + " AND ".join(conditions + ["({})".format(" OR ".join(after))])
+            + order
+        )
+        self._conn = None
+
+    @property
+    def token(self):
+        """
+        A string from which a new KeysetScan continues after the last row yielded, or None
+        if no row has been yielded and the scan did not start from a token
+        """
+        if self._last_key is None:
+            return None
+        state = {"table": self.table, "key": self.key, "last_key": list(self._last_key)}
+        return base64.urlsafe_b64encode(json.dumps(state).encode("utf-8")).decode("ascii")
+
+    def __iter__(self):
+        try:
+            while True:
+                colnames, rows = self._read_page()
+                self.pages = self.pages + 1
+                n_keys = len(self.key)
+                for row in rows:
+                    self._last_key = list(itertools.islice(row, n_keys))
+                    yield OrderedDict(zip(colnames, itertools.islice(row, n_keys, None)))
+                if len(rows) < self.page_size:
+                    return
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Closes the scan's connection, iterating again reopens it
+        """
+        _close_quietly(self._conn)
+        self._conn = None
+
+    def _read_page(self):
+        if self._last_key is None:
+            sql_query, params = self._first_query, None
+        else:
+            # Each OR term repeats the leading key values before its > comparison
+            params = []
+            for i in range(len(self.key)):
+                params.extend(itertools.islice(self._last_key, i + 1))
+            sql_query = self._next_query
+
+        def operation():
+            if self._conn is None:
+                self._conn = _make_connection(dict(self.db_config))
+            try:
+                cursor = self._conn.cursor()
+                if params is None:
+                    cursor.execute(sql_query)
+                else:
+                    cursor.execute(sql_query, params)
+                rows = cursor.fetchall()
+            except (pymysql.Error, sqlite3.Error):
+                self.close()
+                raise
+            colnames = [x[0] for x in itertools.islice(cursor.description, len(self.key), None)]
+            return colnames, rows
+
+        return _call_with_retry(self.db_config, operation, "KeysetScan")
+
+
+def sample_db(
+    table, db_config, n=None, fraction=None, columns="*", key=None, seed=None, method=None
+):
+    """
+    This function returns a random sample of the rows of a table without sorting it, either
+    about n rows or about a fraction of them
+
+    Args:
+       table (str):
+            name of the table to sample
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+
+    Keyword args:
+       n (int):
+            the number of rows wanted
+       fraction (float):
+            the fraction of rows wanted, used if n is None
+       columns (str or list of str):
+            columns to select
+       key (str):
+            an integer column with unique values to probe, by default a single integer primary
+            key or for sqlite, rowid
+       seed:
+            seed for the random number generator, the same seed gives the same sample of
+            unchanged data
+       method (str):
+            "probe" or "scan", by default probe if the table has an integer key
+
+    Returns:
+       A list of OrderedDicts, as for read_db
+
+    Notes:
+        probe draws random values between the minimum and maximum of the key and reads the
+        rows with those keys, drawing again for the misses caused by gaps in the key, so only
+        about n rows are read. For a fraction the table is counted first. Sparse keys, where
+        fewer than one value in a hundred is used, and samples of more than half the key
+        range fall back to a scan.
+
+        scan reads the whole table once in storage order, keeping a reservoir sample of n
+        rows or each row with probability fraction, so the number of rows returned for a
+        fraction is approximate.
+
+    Example:
+        >>> rows = sample_db("test", db_file_path, n=100, seed=42)
+    """
+    db_config = _normalise_config(db_config)
+
+    if (n is None) == (fraction is None):
+        raise ValueError("sample_db requires one of n or fraction")
+    if isinstance(columns, list):
+        columns = ",".join(columns)
+    rng = random.Random(seed)
+
+    if key is None:
+        primary_keys = get_primary_key_columns(db_config, table)
+        table_columns = get_table_columns(db_config, table)
+        if len(primary_keys) == 1 and "INT" in table_columns.get(primary_keys[0], "").upper():
+            key = primary_keys[0]
+        elif db_config["db_type"] == "sqlite" and _sqlite_has_rowid(db_config, table):
+            key = "rowid"
+    if method is None:
+        method = "scan" if key is None else "probe"
+
+    if method == "probe":
+        if key is None:
+            raise ValueError("sample_db probe requires an integer key for table {}".format(table))
+        if n is None:
+            count = list(read_db("SELECT COUNT(*) AS n FROM {}".format(table), db_config))
+            n = int(round(fraction * count[0]["n"]))
+        rows = _sample_by_probing(table, db_config, n, columns, key, rng)
+        if rows is not None:
+            return rows
+        logger.info("sample_db cannot probe table {} efficiently, scanning".format(table))
+    elif method != "scan":
+        raise ValueError("sample_db method should be probe or scan, not {}".format(method))
+
+    sample = []
+    scan = read_db("SELECT {} FROM {}".format(columns, table), db_config)
+    if n is None:
+        sample = [row for row in scan if rng.random() < fraction]
+    else:
+        # Algorithm R, each row seen replaces one in the reservoir with probability n / seen
+        for seen, row in enumerate(scan, start=1):
+            if len(sample) < n:
+                sample.append(row)
+            else:
+                position = rng.randrange(seen)
+                if position < n:
+                    sample[position] = row
+    return sample
+
+
+def _sample_by_probing(table, db_config, n, columns, key, rng):
+    """
+    This is a private function which samples n rows by reading rows with random values of an
+    integer key, returning None if the key is too sparse, or the sample too large a part of
+    the table, for that to be efficient
+    """
+    # MIN and MAX are queried separately since sqlite only reads them from the index when
+    # each is alone in its query
+    low = list(read_db("SELECT MIN({}) AS low FROM {}".format(key, table), db_config))[0]["low"]
+    high = list(read_db("SELECT MAX({}) AS high FROM {}".format(key, table), db_config))[0]["high"]
+    if low is None or n <= 0:
+        return []
+
+    span = high - low + 1
+    if span < 2 * n:
+        return None
+    if columns == "*":
+        # MariaDB/MySQL only accept an unqualified * as the first select item
+        columns = "{}.*".format(table)
+    drawn = set()
+    rows = []
+    hit_rate = 1.0
+    while len(rows) < n and len(drawn) < span:
+        # Draw enough untried keys to expect the remaining rows at the hit rate seen so far
+        wanted = min(span - len(drawn), int((n - len(rows)) / hit_rate * 1.2) + 1)
+        candidates = []
+        while len(candidates) < wanted:
+            candidate = rng.randint(low, high)
+            if candidate not in drawn:
+                drawn.add(candidate)
+                candidates.append(candidate)
+        found = list(
+            read_by_keys(
+                table,
+                db_config,
+                key,
+                candidates,
+                columns="{} AS wow_sample_key, {}".format(key, columns),
+            )
+        )
+        rows.extend(found)
+        hit_rate = max(len(rows), 1) / len(drawn)
+        if hit_rate < 0.01 and len(drawn) >= 1000:
+            return None
+
+    # Rows arrive in whatever order the database returns them, so they are put in key order
+    # before any excess is trimmed at random to keep the sample reproducible
+    rows = sorted(rows, key=lambda row: row["wow_sample_key"])
+    if len(rows) > n:
+        rows = rng.sample(rows, n)
+    for row in rows:
+        del row["wow_sample_key"]
+    return rows
+
+
+def read_db_bbox(table, db_config, bbox, colname="geom", columns="*"):
+    """
+    This function reads the rows of a table whose geometry's bounding box intersects a
+    bounding box, using the spatial index built by finalise_db(spatial=True)
+
+    Args:
+       table (str):
+            name of the table to read
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+       bbox (tuple):
+            the bounding box as (min_x, min_y, max_x, max_y)
+
+    Keyword args:
+       colname (str):
+            the geometry column
+       columns (str or list of str):
+            columns to select
+
+    Returns:
+       A generator of OrderedDicts, as for read_db
+
+    Notes:
+        For sqlite the rows are found from the R*Tree, which must have been built by finalise_db.
+        The R*Tree stores bounding boxes as 32 bit floats rounded outwards so a geometry whose
+        bounding box lies just outside bbox may be returned. For MariaDB/MySQL the query uses
+        MBRIntersects, which the spatial index serves.
+
+    Example:
+        >>> rows = list(read_db_bbox("test", db_file_path, (-1.0, 51.0, 0.5, 52.0)))
+    """
+    db_config = _normalise_config(db_config)
+    if db_config.get("db_shards"):
+        return itertools.chain.from_iterable(
+            [
+                read_db_bbox(table, shard_config, bbox, colname=colname, columns=columns)
+                for shard_config in _shard_configs(db_config)
+            ]
+        )
+    if isinstance(columns, list):
+        columns = ",".join(columns)
+    min_x, min_y, max_x, max_y = bbox
+
+    if db_config["db_type"] == "sqlite":
+        rtree_name = SQLITE_RTREE_NAME.format(table=table, column=colname)
+        if rtree_name.lower() not in [x.lower() for x in _cached_table_names(db_config)]:
+            raise ValueError(
+                "Table '{}' has no R*Tree for column '{}', "
+                "run finalise_db with spatial=True".format(table, colname)
+            )
+        # sqlite searches the R*Tree first and then looks up each match by rowid, ids left
+        # by deleted rows find nothing
+        sql_query = (
+            "SELECT {columns} FROM {table} WHERE rowid IN (SELECT id FROM {rtree} "
+            "WHERE max_x >= ? AND min_x <= ? AND max_y >= ? AND min_y <= ?)"
+        ).format(columns=columns, table=table, rtree=rtree_name)
+        params = [min_x, max_x, min_y, max_y]
+    elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
+        sql_query = "SELECT {} FROM {} WHERE MBRIntersects({}, ST_GeomFromText(%s))".format(
+            columns, table, colname
+        )
+        params = [
+            "POLYGON(({0} {1},{2} {1},{2} {3},{0} {3},{0} {1}))".format(
+                repr(float(min_x)), repr(float(min_y)), repr(float(max_x)), repr(float(max_y))
+            )
+        ]
+
+    return read_db(sql_query, db_config, params=params)
+
+
+def read_by_keys(
+    table, db_config, key_fields, keys, columns="*", chunk_size=None, use_temp_table=False
+):
+    """
+    This function streams the rows of a table matching many keys, using parameterised
+    IN (...) queries each covering a chunk of keys rather than one query per key
+
+    Args:
+       table (str):
+            name of the table
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+       key_fields (str or list of str):
+            the column(s) making up the key
+       keys (iterable):
+            key values, scalars for a single key field or tuples for a compound key
+
+    Keyword args:
+       columns (str or list of str):
+            columns to select
+       chunk_size (int):
+            keys per query, by default as many as the backend's parameter limit allows
+            (999 or 32766 for sqlite depending on version, 65535 for MariaDB/MySQL)
+       use_temp_table (bool):
+            if True each chunk of keys is loaded into a temporary table and joined, rather
+            than bound into an IN list
+
+    Returns:
+       A generator of OrderedDicts, as for read_db, in no particular order
+
+    Notes:
+        For MariaDB/MySQL a chunk also ends before its keys are estimated to fill half of the
+        server's max_allowed_packet, since parameters are bound into the statement text
+
+    Example:
+        >>> for row in read_by_keys("test", db_file_path, "UPRN", [1, 3]):
+                print(row)
+    """
+    db_config = _normalise_config(db_config)
+
+    if isinstance(key_fields, str):
+        key_fields = [key_fields]
+        keys = ((x,) for x in keys)
+    if isinstance(columns, list):
+        columns = ",".join(columns)
+
+    max_bytes = None
+    if db_config["db_type"] == "sqlite":
+        placeholder = "?"
+        parameter_limit = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+    elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
+        placeholder = "%s"
+        parameter_limit = 65535
+        max_bytes = _max_allowed_packet(db_config) // 2
+    if chunk_size is None:
+        chunk_size = max(1, parameter_limit // len(key_fields))
+    chunks = _key_chunks(keys, chunk_size, max_bytes)
+
+    if use_temp_table:
+        yield from _read_by_key_table(table, db_config, key_fields, chunks, columns)
+        return
+
+    row_placeholder = placeholder
+    if len(key_fields) > 1:
+        row_placeholder = "({})".format(",".join([placeholder] * len(key_fields)))
+    SELECT_ROOT = "SELECT {} FROM {} WHERE ".format(columns, table)
+    if len(key_fields) == 1:
+        SELECT_ROOT = SELECT_ROOT + "{} IN (".format(key_fields[0])
+    elif db_config["db_type"] == "sqlite":
+        SELECT_ROOT = SELECT_ROOT + "({}) IN (VALUES ".format(",".join(key_fields))
+    else:
+        SELECT_ROOT = SELECT_ROOT + "({}) IN (".format(",".join(key_fields))
+
+    for chunk in chunks:
+        sql_query = SELECT_ROOT + ",".join([row_placeholder] * len(chunk)) + ")"
+        yield from read_db(sql_query, db_config, params=list(itertools.chain.from_iterable(chunk)))
+
+
+def _max_allowed_packet(db_config):
+    """
+    This is a private function which returns the MariaDB/MySQL server's max_allowed_packet
+    """
+    conn, cursor = _execute_with_retry(
+        db_config, "SELECT @@max_allowed_packet", "max_allowed_packet"
+    )
+    try:
+        return int(cursor.fetchone()[0])
+    finally:
+        conn.close()
+
+
+def _key_chunks(keys, chunk_size, max_bytes=None):
+    """
+    This is a private function which splits key tuples into lists of at most chunk_size keys
+    and, if max_bytes is given, of at most about max_bytes once written into a statement
+    """
+    chunk = []
+    size = 0
+    for key in keys:
+        # Allow for quoting and a separator around each value
+        key_bytes = _estimate_row_bytes(key) + 3 * len(key)
+        if len(chunk) != 0 and (
+            len(chunk) >= chunk_size or (max_bytes is not None and size + key_bytes > max_bytes)
+        ):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(key)
+        size = size + key_bytes
+    if len(chunk) != 0:
+        yield chunk
+
+
+def _read_by_key_table(table, db_config, key_fields, chunks, columns):
+    """
+    This is a private function which implements read_by_keys with a temporary table of keys,
+    each chunk is loaded and joined under the retry policy on a connection which is opened
+    again, with its temporary table, if an attempt fails
+    """
+    columns_schema = get_table_columns(db_config, table)
+    key_definitions = ",".join(["{} {}".format(k, columns_schema.get(k, "")) for k in key_fields])
+    if db_config["db_type"] == "sqlite":
+        placeholders = ",".join(["?"] * len(key_fields))
+        DB_CREATE_KEYS = "CREATE TEMP TABLE wow_read_keys ({})"
+    else:
+        placeholders = ",".join(["%s"] * len(key_fields))
+        DB_CREATE_KEYS = "CREATE TEMPORARY TABLE wow_read_keys ({})"
+    if columns == "*":
+        columns = "{}.*".format(table)
+    sql_query = "SELECT {} FROM {} JOIN wow_read_keys ON {}".format(
+        columns,
+        table,
+        " AND ".join(["{}.{} = wow_read_keys.{}".format(table, k, k) for k in key_fields]),
+    )
+
+    state = {"conn": None}
+
+    def load_chunk(chunk):
+        if state["conn"] is None:
+            conn = _make_connection(db_config)
+            try:
+                conn.cursor().execute(DB_CREATE_KEYS.format(key_definitions))
+            except (pymysql.Error, sqlite3.Error):
+                _close_quietly(conn)
+                raise
+            state["conn"] = conn
+        try:
+            cursor = state["conn"].cursor()
+            cursor.execute("DELETE FROM wow_read_keys")
+            cursor.executemany("INSERT INTO wow_read_keys VALUES ({})".format(placeholders), chunk)
+            cursor.execute(sql_query)
+        except (pymysql.Error, sqlite3.Error):
+            _close_quietly(state["conn"])
+            state["conn"] = None
+            raise
+        return cursor
+
+    try:
+        for chunk in chunks:
+            cursor = _call_with_retry(db_config, lambda: load_chunk(chunk), "read_by_keys")
+            colnames = [x[0] for x in cursor.description]
+            while True:
+                rows = cursor.fetchmany(1000)
+                if len(rows) == 0:
+                    break
+                for row in rows:
+                    yield OrderedDict(zip(colnames, row))
+    finally:
+        _close_quietly(state["conn"])
+
+
+def read_db_partitioned(
+    table,
+    db_config,
+    key=None,
+    columns="*",
+    where=None,
+    partition_size=10000,
+    workers=4,
+    ordered=True,
+    executor="thread",
+):
+    """
+    This function scans a table in parallel by splitting it into ranges of an integer key,
+    each range is read by read_db on its own connection
+
+    Args:
+       table (str):
+            name of the table to scan
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+
+    Keyword args:
+       key (str):
+            integer column to partition on, for sqlite this defaults to rowid, for
+            MariaDB/MySQL it must be supplied and should be indexed
+       columns (str or list of str):
+            columns to select
+       where (str):
+            an optional additional condition applied to every partition
+       partition_size (int):
+            the width of each key range
+       workers (int):
+            the number of partitions read concurrently
+       ordered (bool):
+            if True rows are yielded in key order, otherwise partitions are yielded as they
+            complete
+       executor (str):
+            "thread" or "process"
+
+    Returns:
+       A generator of OrderedDicts, as for read_db
+
+    Notes:
+        A sharded database is scanned one shard at a time, so with ordered=True rows are in key
+        order within each shard rather than overall.
+
+        Each partition is read in full by its worker before its rows are yielded, and at most
+        2 * workers partitions are in flight, so up to 2 * workers * partition_size rows are
+        held in memory for a unique key, 80,000 with the defaults. Lower partition_size to
+        bound memory for wide rows.
+
+    Example:
+        >>> for row in read_db_partitioned("test", db_file_path, partition_size=1000):
+                print(row)
+    """
+    db_config = _normalise_config(db_config)
+
+    if db_config.get("db_shards"):
+        for shard_config in _shard_configs(db_config):
+            yield from read_db_partitioned(
+                table,
+                shard_config,
+                key=key,
+                columns=columns,
+                where=where,
+                partition_size=partition_size,
+                workers=workers,
+                ordered=ordered,
+                executor=executor,
+            )
+        return
+
+    if key is None:
+        if db_config["db_type"] != "sqlite":
+            raise ValueError("read_db_partitioned requires a key column for MariaDB/MySQL")
+        elif _sqlite_has_rowid(db_config, table):
+            key = "rowid"
+        else:
+            # The table is stored in primary key order, so ranges of its first column are
+            # cheap to read if it is an integer
+            key = get_primary_key_columns(db_config, table)[0]
+            if _sqlite_affinity(get_table_columns(db_config, table)[key]) != "INTEGER":
+                raise ValueError(
+                    "read_db_partitioned requires a key column for table {}".format(table)
+                )
+
+    if isinstance(columns, list):
+        columns = ",".join(columns)
+
+    bounds = list(
+        read_db(
+            "SELECT MIN({key}), MAX({key}) FROM {table}".format(key=key, table=table), db_config
+        )
+    )
+    low, high = list(bounds[0].values())
+    if low is None:
+        return
+
+    PARTITION_QUERY = "SELECT {} FROM {} WHERE {} >= {{}} AND {} < {{}}".format(
+        columns, table, key, key
+    )
+    if where is not None:
+        PARTITION_QUERY = PARTITION_QUERY + " AND ({})".format(where)
+    PARTITION_QUERY = PARTITION_QUERY + " ORDER BY {}".format(key)
+
+    queries = [
+        PARTITION_QUERY.format(start, start + partition_size)
+        for start in range(int(low), int(high) + 1, partition_size)
+    ]
+    logger.info(
+        "Scanning {} in {} partitions with {} {} workers".format(
+            table, len(queries), workers, executor
+        )
+    )
+
+    # Workers must not share db_config, since _make_connection stores the connection in it
+    worker_config = db_config.copy()
+    worker_config["db_conn"] = None
+
+    if executor == "process":
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    # Only a bounded number of partitions are in flight, so memory use is independent of
+    # table size, though proportional to workers * partition_size
+    max_in_flight = 2 * workers
+    pending = list(reversed(queries))
+    in_flight = []
+    try:
+        while len(pending) != 0 or len(in_flight) != 0:
+            while len(pending) != 0 and len(in_flight) < max_in_flight:
+                in_flight.append(pool.submit(_read_partition, pending.pop(), worker_config))
+            if ordered:
+                done = in_flight.pop(0)
+            else:
+                done = next(concurrent.futures.as_completed(in_flight))
+                in_flight.remove(done)
+            for row in done.result():
+                yield row
+    finally:
+        for future in in_flight:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
+def _read_partition(sql_query, db_config):
+    """
+    This is a private function which reads one partition for read_db_partitioned, it is at
+    module level so that it can be pickled for a process pool
+    """
+    return list(read_db(sql_query, db_config.copy()))
+
+
+def transfer_table(
+    table,
+    source_config,
+    dest_config,
+    dest_table=None,
+    db_fields=None,
+    indexes=None,
+    batch_size=10000,
+    queue_size=4,
+    force=False,
+):
+    """
+    This function streams a table from one database to another, for example from MariaDB into
+    a local sqlite file, reading and writing concurrently through a bounded queue of batches
+
+    Args:
+       table (str):
+            name of the table in the source database
+       source_config (str or dict):
+            the database to read from, as for read_db
+       dest_config (str or dict):
+            the database to write to, as for configure_db
+
+    Keyword args:
+       dest_table (str):
+            name of the table in the destination, defaults to table
+       db_fields (OrderedDict):
+            fieldnames and types for the destination table, if None they are derived from the
+            source table's columns and primary key, mapping types between sqlite and
+            MariaDB/MySQL where they differ. A ValueError is raised for a sqlite type with no
+            MariaDB/MySQL equivalent, supply db_fields for such tables.
+       indexes (list of tuples):
+            (index_name, colname) pairs created with finalise_db once all rows are written
+       batch_size (int):
+            number of rows per batch
+       queue_size (int):
+            maximum number of batches waiting to be written
+       force (bool):
+            passed to configure_db to replace an existing destination table
+
+    Returns:
+       a dictionary with keys rows, seconds and rows_per_second
+
+    Notes:
+        MariaDB/MySQL sources are read with an unbuffered cursor, so only queue_size batches
+        are held in memory whatever the size of the table. Geometry columns are read from
+        MariaDB/MySQL as WKB with ST_AsBinary.
+
+    Example:
+        >>> transfer_table("property_data", db_config, "property_data.sqlite")
     """
-    This function updates rows in a sqlite or MariaDB/MySQL database
+    source_config = _normalise_config(source_config)
+    dest_config = _normalise_config(dest_config)
+    if dest_table is None:
+        dest_table = table
+
+    if db_fields is None:
+        db_fields = _derive_db_fields(source_config, table, dest_config)
+    configure_db(dest_config, db_fields, tables=dest_table, force=force)
+
+    select_columns = []
+    for k, v in db_fields.items():
+        if v.split()[0].upper() in GEOMETRY_TYPES and source_config["db_type"] != "sqlite":
+            # MariaDB/MySQL return geometry in an internal format with an SRID prefix
+            select_columns.append("ST_AsBinary({0}) AS {0}".format(k))
+        else:
+            select_columns.append(k)
+
+    start_time = time.monotonic()
+    batches = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    reader = threading.Thread(
+        target=_transfer_reader,
+        args=(
+            "SELECT {} FROM {}".format(",".join(select_columns), table),
+            source_config.copy(),
+            batch_size,
+            batches,
+            stop,
+        ),
+        daemon=True,
+    )
+    reader.start()
+
+    INSERT_statement = None
+    n_rows = 0
+    # A sharded destination is written through _write_to_shards, which routes rows by key
+    sharded = bool(dest_config.get("db_shards"))
+    conn = None if sharded else _make_connection(dest_config)
+    try:
+        cursor = None if sharded else conn.cursor()
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            if sharded:
+                _write_to_shards(batch, dest_config, db_fields, dest_table, False)
+            else:
+                if INSERT_statement is None:
+                    INSERT_statement = _insert_statement(
+                        dest_config,
+                        db_fields,
+                        dest_table,
+                        wkb_fields=_wkb_fields(db_fields, batch[0]),
+                    )
+                    bind_row = None
+                    if dest_config["db_type"] == "sqlite":
+                        bind_row = _sqlite_geometry_binder(db_fields, batch[0], None)
+                try:
+                    cursor.executemany(
+                        INSERT_statement, batch if bind_row is None else map(bind_row, batch)
+                    )
+                    conn.commit()
+                except sqlite3.OperationalError as err:
+                    conn.close()
+                    if not _spill_full_staging(dest_config, err):
+                        raise
+                    # The staged destination reached its budget and is now on disk
+                    conn = _make_connection(dest_config)
+                    cursor = conn.cursor()
+                    cursor.executemany(
+                        INSERT_statement, batch if bind_row is None else map(bind_row, batch)
+                    )
+                    conn.commit()
+            n_rows = n_rows + len(batch)
+            logger.debug("transfer_table written {} rows to {}".format(n_rows, dest_table))
+    finally:
+        stop.set()
+        _close_quietly(conn)
+        reader.join()
+        # Rows written here bypass write_to_db, so a key index for the table is out of date
+        _forget_key_indexes(dest_config, table=dest_table)
+
+    if indexes is not None:
+        for index_name, colname in indexes:
+            finalise_db(dest_config, index_name=index_name, table=dest_table, colname=colname)
+
+    elapsed = time.monotonic() - start_time
+    stats = {
+        "rows": n_rows,
+        "seconds": elapsed,
+        "rows_per_second": n_rows / elapsed if elapsed > 0 else 0.0,
+    }
+    logger.info(
+        "Transferred {} rows from {} to {} in {:.2f} seconds, {:.0f} rows/second".format(
+            n_rows, table, dest_table, elapsed, stats["rows_per_second"]
+        )
+    )
+    return stats
+
+
+def _transfer_reader(sql_query, db_config, batch_size, batches, stop):
+    """
+    This is a private function run on the reading thread of transfer_table, it puts lists of
+    row tuples on the batches queue followed by None, or an exception if the read fails
+    """
+
+    def put(item):
+        # Time out periodically so that the thread exits if the writer has given up
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    conn = None
+    try:
+        conn, cursor = _execute_with_retry(db_config, sql_query, "transfer_table", unbuffered=True)
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if len(batch) == 0 or not put(batch):
+                break
+        put(None)
+    except Exception as err:
+        put(err)
+    finally:
+        _close_quietly(conn)
+
+
+def export_query_to_csv(
+    sql_query,
+    db_config,
+    filename,
+    compression=None,
+    max_rows=None,
+    max_bytes=None,
+    batch_size=10000,
+):
+    """
+    This function streams the results of a query straight to CSV, without holding the result
+    set in memory. MariaDB/MySQL results are read with an unbuffered cursor so they are not
+    held by the client either.
+
+    Args:
+       sql_query (str):
+            the query to export
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+       filename (str):
+            the output file
+
+    Keyword args:
+       compression (str):
+            None, "gzip", "bz2" or "xz"
+       max_rows (int):
+            split the output into files of at most this many rows
+       max_bytes (int):
+            split the output into files of roughly this many uncompressed characters
+       batch_size (int):
+            number of rows written at a time
+
+    Returns:
+       a list of the files written, a query returning no rows writes one file with only the
+       header
+
+    Example:
+        >>> export_query_to_csv("select * from test;", db_file_path, "test.csv", compression="gzip")
+    """
+    db_config = _normalise_config(db_config)
+    if db_config["db_type"] == "sqlite" and not _sqlite_database_exists(db_config):
+        raise IOError("Database file '{}' does not exist".format(db_config["db_path"]))
+    _record_query(db_config, sql_query, None)
+
+    start_time = time.monotonic()
+    conn, cursor = _execute_with_retry(db_config, sql_query, "export_query_to_csv", unbuffered=True)
+    colnames = [x[0] for x in cursor.description]
+
+    def rows():
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if len(batch) == 0:
+                return
+            for row in batch:
+                yield OrderedDict(zip(colnames, row))
+
+    try:
+        filenames = write_dictionaries_streaming(
+            filename,
+            rows(),
+            compression=compression,
+            max_rows=max_rows,
+            max_bytes=max_bytes,
+            batch_size=batch_size,
+            fieldnames=colnames,
+        )
+    finally:
+        conn.close()
+    logger.info(
+        "Exported query to {} file(s) in {:.2f} seconds".format(
+            len(filenames), time.monotonic() - start_time
+        )
+    )
+    return filenames
+
+
+def file_unchanged_since_load(filename, db_config):
+    """
+    This function checks a file against the fingerprint recorded by record_file_load, so that
+    an unchanged input file need not be reloaded. A file whose size differs from that recorded
+    has changed, the SHA-256 is only calculated if the size matches but the modification time
+    differs, and if it matches the recorded modification time is updated so that the next call
+    need not hash the file again.
+
+    Args:
+       filename (str):
+            path to the input file
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+
+    Returns:
+       True if the file content matches the recorded fingerprint, False otherwise
+
+    Example:
+        >>> if not file_unchanged_since_load("survey.csv", db_file_path):
+                load_survey("survey.csv")
+                record_file_load("survey.csv", db_file_path)
+    """
+    db_config = _normalise_config(db_config)
+    _refuse_shards(db_config, "file_unchanged_since_load")
+    _ensure_metadata_table(db_config, FILE_FINGERPRINT_TABLE, file_fingerprint_fields)
+
+    placeholder = "?" if db_config["db_type"] == "sqlite" else "%s"
+    conn = _make_connection(db_config)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT size, mtime, sha256 FROM {} WHERE filename = {}".format(
+            FILE_FINGERPRINT_TABLE, placeholder
+        ),
+        (os.path.abspath(filename),),
+    )
+    result = cursor.fetchall()
+    conn.close()
+    if len(result) == 0:
+        return False
+
+    size, mtime, sha256 = result[0]
+    stat = os.stat(filename)
+    if stat.st_size != size:
+        return False
+    if stat.st_mtime == mtime:
+        return True
+    fingerprint = file_fingerprint(filename)
+    if fingerprint["sha256"] != sha256:
+        return False
+
+    # The content is unchanged, only its modification time
+    conn = _make_connection(db_config)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE {} SET mtime = {} WHERE filename = {}".format(
+                FILE_FINGERPRINT_TABLE, placeholder, placeholder
+            ),
+            (fingerprint["mtime"], os.path.abspath(filename)),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return True
+
+
+def record_file_load(filename, db_config):
+    """
+    This function records the fingerprint (size, mtime and SHA-256) of a file which has been
+    loaded, for use by file_unchanged_since_load
+
+    Args:
+       filename (str):
+            path to the input file
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+
+    Returns:
+       the fingerprint dictionary from utils.file_fingerprint
+    """
+    db_config = _normalise_config(db_config)
+    _refuse_shards(db_config, "record_file_load")
+    _ensure_metadata_table(db_config, FILE_FINGERPRINT_TABLE, file_fingerprint_fields)
+
+    fingerprint = file_fingerprint(filename)
+    row = [
+        os.path.abspath(filename),
+        fingerprint["size"],
+        fingerprint["mtime"],
+        fingerprint["sha256"],
+        datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    ]
+    _replace_rows([row], db_config, file_fingerprint_fields, FILE_FINGERPRINT_TABLE)
+    return fingerprint
+
+
+def write_changed_rows(
+    data, db_config, db_fields, table="property_data", key=["UPRN"], chunk_size=10000
+):
+    """
+    This function writes only the rows which are new or have changed since they were last
+    written through it, using a SHA-256 content hash per row stored in a metadata table. New
+    rows are written with write_to_db and changed rows with update_to_db.
 
     Args:
        data (list of lists or dictionaries):
-            List of lists of data to update to database, order matches db_fields
+            rows to write, as for write_to_db
        db_config (str or dict):
             For sqlite a file path in a string is sufficient, MariaDB/MySQL require
             a dictionary and example of which is found in db_config_template
        db_fields (OrderedDict):
-            A list of fieldnames in an OrderedDict containing the fields to update and
-            the key field in the order in which the fields are presented in the data lists
+            A dictionary of fieldnames and types
 
     Keyword args:
        table (str):
-            name of table to which we are writing, key to db_fields
-       key (str):
-            the field which forms the key of the update
+            name of table to which we are writing
+       key (str or list of str):
+            the field(s) identifying a row
+       chunk_size (int):
+            the number of rows whose stored hashes are read at a time, in key order
 
     Returns:
-       No return value
+       a dictionary with counts of new, changed and unchanged rows
 
-    Example:
-        >>> db_fields = OrderedDict([
-              ("UPRN","INTEGER PRIMARY KEY"),
-              ("PropertyID", "INT"),
-              ("Addr1", "TEXT"),
-        ])
-        >>> db_filename = "test_write_db.sqlite"
-        >>> db_dir = "ihutilities\\fixtures"
-        >>> db_file_path = os.path.join(db_dir, db_filename)
-        >>> data = [(1, 2, "hello"),
-                    (2, 3, "Fred"),
-                    (3, 3, "Beans")]
-        >>> update_fields = ["Addr1", "UPRN"]
-        >>> update = [("Some", 3)]
-        >>> update_to_db(update, db_file_path, update_fields, table="test", key="UPRN")
+    Notes:
+        As for update_to_db, None values in a changed row do not overwrite existing values.
+        Rows already in the table but never written through this function are treated as
+        changed the first time they are seen.
     """
     if isinstance(key, str):
         key = [key]
 
     db_config = _normalise_config(db_config)
+    _refuse_shards(db_config, "write_changed_rows")
+    _ensure_metadata_table(db_config, ROW_HASH_TABLE, row_hash_fields)
 
-    PLACEHOLDER = ""
-    DB_UPDATE_TAIL = ""
-    if db_config["db_type"] == "sqlite":
-        # WHERE KEY1 = ?
-        # WHERE KEY1 = ? AND KEY2 = ?
-        # WHERE KEY1 = ? AND KEY2 = ? AND KEY3 = ?
-        DB_UPDATE_TAIL = " WHERE "
-        joiner = ""
-        for k in key:
-            DB_UPDATE_TAIL = DB_UPDATE_TAIL + "{} {} = ?".format(joiner, k)
-            joiner = "AND"
-        PLACEHOLDER = " = ?,"
-    elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
-        DB_UPDATE_TAIL = " WHERE "
-        joiner = ""
-        for k in key:
-            DB_UPDATE_TAIL = DB_UPDATE_TAIL + "{} {} = %s".format(joiner, k)
-            joiner = "AND"
-        PLACEHOLDER = " = %s,"
+    counts = {"new": 0, "changed": 0, "unchanged": 0}
+    if len(data) == 0:
+        return counts
 
-    conn = _make_connection(db_config)
-    cursor = conn.cursor()
-    DB_UPDATE_ROOT = "UPDATE {} SET ".format(table)
+    fieldnames = list(db_fields.keys())
+    key_getter = operator.itemgetter(*[fieldnames.index(k) for k in key])
+    bind_row = _row_binder(db_fields, data[0])
 
-    key_indices = []
-    for k in key:
-        key_index = db_fields.index(k)
-        key_indices.append(key_index)
+    hashed_rows = []
+    for row in data:
+        values = row if bind_row is None else bind_row(row)
+        row_key = json.dumps(key_getter(values), default=str)
+        row_hash = hashlib.sha256(json.dumps(list(values), default=str).encode("utf-8")).hexdigest()
+        hashed_rows.append((row_key, row_hash, values))
+    # Stored hashes are read for a chunk of keys at a time, in key order so that each chunk
+    # is a compact range of the metadata table's primary key
+    hashed_rows.sort(key=operator.itemgetter(0))
 
-    # convert a list of dictionary to a list of lists, if required:
+    new_rows = []
+    changed_rows = []
+    hash_rows = []
+    hashed_rows = iter(hashed_rows)
+    while True:
+        chunk = list(itertools.islice(hashed_rows, chunk_size))
+        if len(chunk) == 0:
+            break
+        known_hashes = {
+            x["row_key"]: x["row_hash"]
+            for x in read_by_keys(
+                ROW_HASH_TABLE,
+                db_config,
+                ["table_name", "row_key"],
+                [(table, row_key) for row_key, _, _ in chunk],
+                columns="row_key, row_hash",
+            )
+        }
+        for row_key, row_hash, values in chunk:
+            known_hash = known_hashes.get(row_key)
+            if known_hash == row_hash:
+                counts["unchanged"] += 1
+                continue
+            if known_hash is None:
+                new_rows.append(values)
+            else:
+                changed_rows.append(values)
+            hash_rows.append([table, row_key, row_hash])
 
-    converted_data = []
-    if isinstance(data[0], dict):
-        for row in data:
-            converted_data.append([x for x in row.values()])
+    if len(new_rows) != 0:
+        # Rows already present without a recorded hash are rejected by write_to_db, and are
+        # updated instead
+        rejected_rows = []
+        try:
+            write_to_db(new_rows, db_config, db_fields, table=table)
+        except (pymysql.err.IntegrityError, sqlite3.IntegrityError):
+            rejected_rows = None
+        # This is outside the except clause so that the failed cursor, which holds a sqlite
+        # lock until it is finalised, has been released
+        if rejected_rows is None:
+            rejected_rows = write_to_db(new_rows, db_config, db_fields, table=table, whatever=True)
+        changed_rows.extend(rejected_rows)
+        counts["new"] = len(new_rows) - len(rejected_rows)
+    if len(changed_rows) != 0:
+        update_to_db(changed_rows, db_config, fieldnames, table=table, key=key)
+    if len(hash_rows) != 0:
+        _replace_rows(hash_rows, db_config, row_hash_fields, ROW_HASH_TABLE)
+    counts["changed"] = len(changed_rows)
 
-        if db_fields != list(data[0].keys()):
-            raise KeyError(
-                f"db_fields supplied to update_to_db ('{db_fields}')"
-                f"do not match fields in update dictionary {list(data[0].keys())}"
-            )
-    else:
-        converted_data = data
-    for row in converted_data:
-        # print(update_statement, [x for x in row])
-        key_vals = []
-        for k in key_indices:
-            key_vals.append(row[k])
-        update_fields = []
-        update_data = []
-        for i, _ in enumerate(row):
-            if i not in key_indices and row[i] is not None:
-                update_fields.append(db_fields[i])
-                update_data.append(row[i])
+    logger.info(
+        "write_changed_rows to {}: {} new, {} changed, {} unchanged".format(
+            table, counts["new"], counts["changed"], counts["unchanged"]
+        )
+    )
+    return counts
 
-        update_statement = ""
-        DB_FIELDS = DB_UPDATE_ROOT
-        for k in update_fields:
-            DB_FIELDS = DB_FIELDS + k + PLACEHOLDER
-            update_statement = DB_FIELDS[0:-1] + DB_UPDATE_TAIL
 
-        update_data.extend(key_vals)
-        if len(update_fields) != 0:
-            logging.debug(
-                "Attempting update with statement = '{}' and data = '{}'".format(
-                    update_statement, update_data
-                )
-            )
-            cursor.execute(update_statement, update_data)
+def _refuse_shards(db_config, function_name):
+    if db_config.get("db_shards"):
+        raise ValueError("{} does not support sharded databases".format(function_name))
+
+
+def _ensure_metadata_table(db_config, table, db_fields):
+    """
+    This is a private function which creates one of db_utils' own metadata tables if it does not
+    already exist
+    """
+    if table.lower() not in [x.lower() for x in _cached_table_names(db_config)]:
+        configure_db(db_config.copy(), db_fields, tables=table)
 
+
+@_with_write_retry
+def _replace_rows(data, db_config, db_fields, table):
+    """
+    This is a private function which inserts rows, replacing any with the same primary key
+    """
+    INSERT_statement = _insert_statement(db_config, db_fields, table)
+    INSERT_statement = INSERT_statement.replace("INSERT INTO", "REPLACE INTO", 1)
+    conn = _make_connection(db_config)
+    cursor = conn.cursor()
+    cursor.executemany(INSERT_statement, data)
     conn.commit()
     conn.close()
 
 
-def drop_db_tables(db_config, tables):
+def _derive_db_fields(db_config, table, dest_config=None):
+    """
+    This is a private function which builds a db_fields OrderedDict for configure_db from an
+    existing table, mapping the types for dest_config if it is a different kind of database
+    """
+    columns, primary_keys = _table_schema(db_config, table)
+    if len(columns) == 0:
+        raise ValueError("Table '{}' not found when deriving db_fields".format(table))
+    if dest_config is None:
+        dest_config = db_config
+
+    db_fields = OrderedDict()
+    for k, v in columns.items():
+        # sqlite allows columns without a declared type, MariaDB/MySQL do not
+        v = v if v != "" else "TEXT"
+        if v.upper() in GEOMETRY_TYPES:
+            v = v.upper()
+        elif db_config["db_type"] == "sqlite" and dest_config["db_type"] != "sqlite":
+            v = _mysql_type_for_sqlite(k, v, k in primary_keys)
+        elif db_config["db_type"] != "sqlite" and dest_config["db_type"] == "sqlite":
+            v = _sqlite_type_for_mysql(v)
+        if k in primary_keys:
+            v = v + " PRIMARY KEY"
+        db_fields[k] = v
+    return db_fields
+
+
+def _mysql_type_for_sqlite(column, field_type, is_key):
+    """
+    This is a private function which maps a sqlite declared type onto a MariaDB/MySQL type,
+    keeping types MariaDB/MySQL understands and giving text keys an indexable VARCHAR
+    """
+    match = re.match(r"\s*(\w+)\s*(\([\d\s,]*\))?", field_type)
+    base = match.group(1).upper()
+    size = "" if match.group(2) is None else match.group(2).replace(" ", "")
+    affinity = _sqlite_affinity(field_type)
+
+    if is_key and affinity == "TEXT":
+        return base + size if base in ("VARCHAR", "CHAR") and size != "" else "VARCHAR(255)"
+    if is_key and affinity == "BLOB":
+        return base + size if base == "VARBINARY" and size != "" else "VARBINARY(255)"
+    if base in MYSQL_TYPE_NAMES:
+        if base in ("VARCHAR", "VARBINARY") and size == "":
+            return base + "(255)"
+        return base + size
+    if affinity == "INTEGER":
+        return "BIGINT"
+    if affinity == "TEXT":
+        return "TEXT"
+    if affinity == "REAL":
+        return "DOUBLE"
+    if affinity == "BLOB":
+        return "LONGBLOB"
+    raise ValueError(
+        "Column '{}' has sqlite type '{}' with no MariaDB/MySQL equivalent, "
+        "supply db_fields".format(column, field_type)
+    )
+
+
+def _sqlite_type_for_mysql(field_type):
+    """
+    This is a private function which maps a MariaDB/MySQL column type onto a type sqlite can
+    declare, dropping attributes like unsigned and keeping only numeric sizes
+    """
+    match = re.match(r"\s*(\w+)\s*(\([\d\s,]*\))?", field_type)
+    base = match.group(1).upper()
+    if base in ("ENUM", "SET", "JSON"):
+        return "TEXT"
+    return base + ("" if match.group(2) is None else match.group(2).replace(" ", ""))
+
+
+def delete_from_db(sql_query, db_config):
     db_config = _normalise_config(db_config)
-    conn = _make_connection(db_config)
-    cursor = conn.cursor()
+    # Recorded once here rather than per attempt, which the retry policy may repeat
+    _record_query(db_config, sql_query, None)
+    _delete_from_db(sql_query, db_config)
 
-    for table in tables:
-        cursor.execute("DROP TABLE IF EXISTS {}".format(table))
-    conn.close()
 
+@_with_retry
+def _delete_from_db(sql_query, db_config):
+    """
+    This is a private function which runs a delete_from_db query under the retry policy
+    """
+    _forget_key_indexes(db_config)
 
-def finalise_db(
-    db_config,
-    index_name="idx_postcode",
-    table="property_data",
-    colname="postcode",
-    spatial=False,
-):
+    if db_config.get("db_shards"):
+        for shard_config in _shard_configs(db_config):
+            _delete_from_db(sql_query, shard_config)
+        return
+
+    if db_config["db_type"] == "sqlite" and not _sqlite_database_exists(db_config):
+        raise IOError("Database file '{}' does not exist".format(db_config["db_path"]))
+
+    try:
+        conn = _make_connection(db_config)
+        cursor = conn.cursor()
+        cursor.execute(sql_query)
+    except sqlite3.OperationalError as err:
+        logger.info("Caught exception {} on query '{}'".format(err, sql_query))
+        print("Caught exception {} on query '{}'".format(err, sql_query), flush=True)
+        raise
+
+    conn.commit()
+    conn.close()
+
+
+def delete_from_db_chunked(table, db_config, where=None, chunk_size=10000):
     """
-    This function creates an index in a sqlite or MariaDB/MySQL database
+    This function deletes rows from a table in bounded batches, committing after each batch so
+    that locks and the journal/undo log stay small on large deletes
 
     Args:
+       table (str):
+            name of the table from which rows are deleted
        db_config (str or dict):
             For sqlite a file path in a string is sufficient, MariaDB/MySQL require
             a dictionary and example of which is found in db_config_template
 
     Keyword args:
-       index_name (str):
-            name of the index to be created
-       table (str):
-            the table on which the index is to be created
-       colname (str):
-            the column on which the index is to be created
-       spatial (bool):
-            True for a spatial index, false otherwise
+       where (str):
+            condition selecting the rows to delete, if None all rows are deleted
+       chunk_size (int):
+            for MariaDB/MySQL the LIMIT on each DELETE, for sqlite the width of each
+            rowid range, or for a WITHOUT ROWID table the number of rows in each DELETE
 
     Returns:
-       No return value
+       the number of rows deleted
 
+    Example:
+        >>> delete_from_db_chunked("test", db_file_path, where="PropertyID = 3")
     """
-
     db_config = _normalise_config(db_config)
+    _forget_key_indexes(db_config)
 
-    conn = _make_connection(db_config)
-    cursor = conn.cursor()
+    if db_config.get("db_shards"):
+        return sum(
+            delete_from_db_chunked(table, shard_config, where=where, chunk_size=chunk_size)
+            for shard_config in _shard_configs(db_config)
+        )
 
-    if isinstance(colname, list):
-        colname = ",".join(colname)
+    if db_config["db_type"] == "sqlite" and not _sqlite_database_exists(db_config):
+        raise IOError("Database file '{}' does not exist".format(db_config["db_path"]))
 
-    time_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    logger.info(
-        "Creating index named '{}' on column(s) '{}' at {}".format(index_name, colname, time_str)
-    )
-    if spatial:
-        cursor.execute(
-            "CREATE SPATIAL INDEX {index_name} on {table}({colname})".format(
-                index_name=index_name, table=table, colname=colname
+    condition = "1 = 1" if where is None else "({})".format(where)
+    start_time = time.monotonic()
+    deleted = 0
+    if db_config["db_type"] == "sqlite" and not _sqlite_has_rowid(db_config, table):
+        # WITHOUT ROWID tables are deleted from by primary key, a chunk at a time
+        primary_keys = ",".join(get_primary_key_columns(db_config, table))
+        DB_DELETE = (
+            "DELETE FROM {0} WHERE ({1}) IN (SELECT {1} FROM {0} WHERE {2} LIMIT {3})".format(
+                table, primary_keys, condition, chunk_size
             )
         )
-    else:
-        cursor.execute(
-            "CREATE INDEX {index_name} on {table}({colname} ASC)".format(
-                index_name=index_name, table=table, colname=colname
+        while True:
+            count = _run_delete_batch(db_config, [(DB_DELETE, None)])
+            deleted += count
+            if count < chunk_size:
+                break
+    elif db_config["db_type"] == "sqlite":
+        bounds = list(
+            read_db(
+                "SELECT MIN(rowid), MAX(rowid) FROM {} WHERE {}".format(table, condition),
+                db_config,
             )
         )
-    conn.commit()
-    conn.close()
+        low, high = list(bounds[0].values())
+        if low is not None:
+            for start in range(low, high + 1, chunk_size):
+                DB_DELETE = "DELETE FROM {} WHERE rowid >= {} AND rowid < {} AND {}".format(
+                    table, start, start + chunk_size, condition
+                )
+                deleted += _run_delete_batch(db_config, [(DB_DELETE, None)])
+    elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
+        DB_DELETE = "DELETE FROM {} WHERE {} LIMIT {}".format(table, condition, chunk_size)
+        while True:
+            count = _run_delete_batch(db_config, [(DB_DELETE, None)])
+            deleted += count
+            if count < chunk_size:
+                break
 
+    _log_delete_rate(table, deleted, start_time)
+    return deleted
 
-def read_db(sql_query, db_config):
-    db_config = _normalise_config(db_config)
 
-    err_wait = 30.0
+def delete_keys_from_db(table, db_config, key_fields, keys, chunk_size=10000):
+    """
+    This function deletes the rows matching a list of keys, joining against a temporary table
+    of keys rather than building a giant IN (...) list, committing after each chunk of keys
+
+    Args:
+       table (str):
+            name of the table from which rows are deleted
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+       key_fields (str or list of str):
+            the column(s) making up the key
+       keys (iterable):
+            key values, scalars for a single key field or tuples for a compound key
+
+    Keyword args:
+       chunk_size (int):
+            number of keys deleted per transaction
+
+    Returns:
+       the number of rows deleted
+
+    Example:
+        >>> delete_keys_from_db("test", db_file_path, "UPRN", [1, 2, 3])
+    """
+    db_config = _normalise_config(db_config)
+    _forget_key_indexes(db_config)
 
-    if db_config["db_type"] == "sqlite" and not os.path.isfile(db_config["db_path"]):
+    if db_config["db_type"] == "sqlite" and not _sqlite_database_exists(db_config):
         raise IOError("Database file '{}' does not exist".format(db_config["db_path"]))
 
-    try:
-        conn = _make_connection(db_config)
-        cursor = conn.cursor()
-        cursor.execute(sql_query)
-    except pymysql.Error as err:
-        if err.args[0] == CR_CONN_HOST_ERROR:
-            logger.warning(
-                f"Caught exception '{err}'. errno = '{err.args[0]}', "
-                f"waiting {err_wait} seconds and having another go"
-            )
-            time.sleep(err_wait)
-            conn = _make_connection(db_config)
-            cursor = conn.cursor()
-            cursor.execute(sql_query)
-        else:
-            raise
-    except sqlite3.OperationalError as err:
-        logger.info("Caught exception {} on query '{}'".format(err, sql_query))
-        print("Caught exception {} on query '{}'".format(err, sql_query), flush=True)
-        raise
+    if isinstance(key_fields, str):
+        key_fields = [key_fields]
+        keys = ((x,) for x in keys)
 
-    colnames = [x[0] for x in cursor.description]
+    columns = get_table_columns(db_config, table)
+    key_definitions = ",".join(["{} {}".format(k, columns.get(k, "")) for k in key_fields])
 
-    # rows = cursor.fetchall()
-    # conn.close()
+    if db_config["db_type"] == "sqlite":
+        PLACEHOLDERS = ",".join(["?"] * len(key_fields))
+        DB_CREATE_KEYS = "CREATE TEMP TABLE IF NOT EXISTS wow_delete_keys ({})".format(
+            key_definitions
+        )
+        DB_DELETE = "DELETE FROM {table} WHERE ({keys}) IN (SELECT {keys} FROM wow_delete_keys)"
+    elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
+        PLACEHOLDERS = ",".join(["%s"] * len(key_fields))
+        DB_CREATE_KEYS = "CREATE TEMPORARY TABLE IF NOT EXISTS wow_delete_keys ({})".format(
+            key_definitions
+        )
+        DB_DELETE = "DELETE {table} FROM {table} JOIN wow_delete_keys ON {join}"
 
-    # for row in rows:
-    #     if row is not None:
-    #         labelled_row = OrderedDict(zip(colnames, row))
-    #         yield labelled_row
+    DB_DELETE = DB_DELETE.format(
+        table=table,
+        keys=",".join(key_fields),
+        join=" AND ".join(["{}.{} = wow_delete_keys.{}".format(table, k, k) for k in key_fields]),
+    )
+    DB_INSERT_KEYS = "INSERT INTO wow_delete_keys VALUES ({})".format(PLACEHOLDERS)
 
-    while True:
-        row = cursor.fetchone()
-        if row is not None:
-            labelled_row = OrderedDict(zip(colnames, row))
-            yield labelled_row
-        else:
-            conn.close()
-            # raise StopIteration # - this is depreciated in Python 3.5 onwards
-            return
+    # Each chunk of keys is deleted from every shard of a sharded database
+    targets = [db_config]
+    if db_config.get("db_shards"):
+        targets = _shard_configs(db_config)
 
+    start_time = time.monotonic()
+    deleted = 0
+    keys = iter(keys)
+    while True:
+        chunk = list(itertools.islice(keys, chunk_size))
+        if len(chunk) == 0:
+            break
+        for target in targets:
+            deleted += _run_delete_batch(
+                target,
+                [
+                    (DB_CREATE_KEYS, None),
+                    ("DELETE FROM wow_delete_keys", None),
+                    (DB_INSERT_KEYS, chunk),
+                    (DB_DELETE, None),
+                ],
+            )
 
-def delete_from_db(sql_query, db_config):
-    db_config = _normalise_config(db_config)
+    _log_delete_rate(table, deleted, start_time)
+    return deleted
 
-    err_wait = 30.0
 
-    if db_config["db_type"] == "sqlite" and not os.path.isfile(db_config["db_path"]):
-        raise IOError("Database file '{}' does not exist".format(db_config["db_path"]))
+def _run_delete_batch(db_config, statements):
+    """
+    This is a private function which runs a list of (statement, rows) pairs in one transaction
+    under the retry policy, rows are passed to executemany. It returns the rowcount of the last
+    statement.
+    """
 
-    try:
+    def operation():
         conn = _make_connection(db_config)
-        cursor = conn.cursor()
-        cursor.execute(sql_query)
-    except pymysql.Error as err:
-        if err.args[0] == CR_CONN_HOST_ERROR:
-            logger.warning(
-                f"Caught exception '{err}'. errno = '{err.errno}', "
-                f"waiting {err_wait} seconds and having another go"
-            )
-            time.sleep(err_wait)
-            conn = _make_connection(db_config)
+        try:
             cursor = conn.cursor()
-            cursor.execute(sql_query)
-        else:
-            raise
-    except sqlite3.OperationalError as err:
-        logger.info("Caught exception {} on query '{}'".format(err, sql_query))
-        print("Caught exception {} on query '{}'".format(err, sql_query), flush=True)
-        raise
+            for statement, rows in statements:
+                if rows is None:
+                    cursor.execute(statement)
+                else:
+                    cursor.executemany(statement, rows)
+            count = cursor.rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        return count
+
+    return _call_with_retry(db_config, operation, "delete batch")
 
-    if conn:
-        conn.commit()
-        conn.close()
+
+def _log_delete_rate(table, deleted, start_time):
+    elapsed = time.monotonic() - start_time
+    rate = deleted / elapsed if elapsed > 0 else 0.0
+    logger.info(
+        "Deleted {} rows from {} in {:.2f} seconds, {:.0f} rows/second".format(
+            deleted, table, elapsed, rate
+        )
+    )
 
 
 def _normalise_config(db_config):
@@ -505,15 +4456,275 @@ def _normalise_config(db_config):
     return db_config
 
 
+def _execute_with_retry(db_config, sql_query, description="", params=None, unbuffered=False):
+    """
+    This is a private function which connects and executes sql_query under the retry policy,
+    returning the open connection and cursor, which for MariaDB/MySQL streams results from
+    the server if unbuffered is True
+    """
+
+    def operation():
+        conn = _make_connection(db_config)
+        try:
+            if unbuffered and db_config["db_type"] != "sqlite":
+                cursor = conn.cursor(pymysql.cursors.SSCursor)
+            else:
+                cursor = conn.cursor()
+            if params is None:
+                cursor.execute(sql_query)
+            else:
+                cursor.execute(sql_query, params)
+        except (pymysql.Error, sqlite3.Error):
+            _close_quietly(conn)
+            raise
+        return conn, cursor
+
+    return _call_with_retry(db_config, operation, description)
+
+
+def _close_quietly(conn):
+    if conn is None:
+        return
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def commit_staged_db(db_config):
+    """
+    This function copies a sqlite database staged in memory by configure_db to its db_path in
+    one pass with the online backup API and ends staging, it does nothing if the database is
+    not staged. finalise_db calls it by default.
+
+    Args:
+       db_config (str or dict):
+            the sqlite database
+
+    Returns:
+       True if a staged database was written to disk, False otherwise
+    """
+    db_config = _normalise_config(db_config)
+    with _staging_lock:
+        staging = _staging_databases.pop(os.path.abspath(db_config["db_path"]), None)
+    if staging is None:
+        return False
+
+    _backup_staging(staging, db_config["db_path"])
+    staging["conn"].close()
+    return True
+
+
+def _start_staging(db_config, force):
+    """
+    This is a private function which creates the in-memory copy of a sqlite database, loading
+    the existing file if there is one
+    """
+    db_path = os.path.abspath(db_config["db_path"])
+    budget = db_config.get("db_staging_budget", db_config_template["db_staging_budget"])
+    with _staging_lock:
+        staging = _staging_databases.get(db_path)
+        if staging is not None and not force:
+            return
+        if staging is not None:
+            _staging_databases.pop(db_path)
+            staging["conn"].close()
+
+        if os.path.isfile(db_path) and os.path.getsize(db_path) > budget:
+            logger.warning(
+                "Database '{}' is larger than the staging budget, writing directly".format(db_path)
+            )
+            return
+
+        uri = "file:wow_staging_{}?mode=memory&cache=shared".format(
+            hashlib.sha256(db_path.encode("utf-8")).hexdigest()[:16]
+        )
+        # This connection keeps the shared in-memory database alive until staging ends
+        anchor = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        if os.path.isfile(db_path):
+            disk = sqlite3.connect(db_path)
+            disk.backup(anchor)
+            disk.close()
+        # sqlite refuses to grow the database past the budget, raising "database or disk is
+        # full" for _spill_full_staging to handle
+        page_size = anchor.execute("PRAGMA page_size").fetchone()[0]
+        anchor.execute("PRAGMA max_page_count = {}".format(max(1, budget // page_size)))
+        _staging_databases[db_path] = {"conn": anchor, "uri": uri, "budget": budget}
+        logger.info("Staging database '{}' in memory".format(db_path))
+
+
+def _staged_connection(db_config):
+    """
+    This is a private function which returns a new connection to the in-memory copy of a
+    staged sqlite database, or None if it is not staged
+    """
+    db_path = os.path.abspath(db_config["db_path"])
+    with _staging_lock:
+        staging = _staging_databases.get(db_path)
+        if staging is None:
+            return None
+        return sqlite3.connect(staging["uri"], uri=True)
+
+
+def _spill_full_staging(db_config, err):
+    """
+    This is a private function which, if err is a staged sqlite database reaching its budget,
+    copies the database to disk and ends staging, returning True so that the failed write,
+    which must already have been rolled back, can be run again on disk
+    """
+    if db_config["db_type"] != "sqlite" or db_config.get("db_shards"):
+        return False
+    if not isinstance(err, sqlite3.OperationalError) or "full" not in str(err).lower():
+        return False
+    db_path = os.path.abspath(db_config["db_path"])
+    with _staging_lock:
+        staging = _staging_databases.pop(db_path, None)
+        if staging is None:
+            return False
+        logger.warning(
+            "Staged database '{}' has reached its budget of {} bytes, "
+            "copying to disk and writing directly".format(db_path, staging["budget"])
+        )
+        _backup_staging(staging, db_path)
+        staging["conn"].close()
+    return True
+
+
+def _commit_staged_at_exit():
+    """
+    This is a private function registered with atexit which writes any database still staged
+    in memory to disk
+    """
+    with _staging_lock:
+        db_paths = list(_staging_databases.keys())
+    for db_path in db_paths:
+        logger.warning(
+            "Database '{}' was still staged in memory at exit, writing it to disk".format(db_path)
+        )
+        commit_staged_db(db_path)
+
+
+atexit.register(_commit_staged_at_exit)
+
+
+def _backup_staging(staging, db_path):
+    start_time = time.monotonic()
+    disk = sqlite3.connect(db_path)
+    try:
+        staging["conn"].backup(disk)
+    finally:
+        disk.close()
+    logger.info(
+        "Copied staged database to '{}' in {:.2f} seconds".format(
+            db_path, time.monotonic() - start_time
+        )
+    )
+
+
+def _sqlite_database_exists(db_config):
+    if db_config.get("db_shards"):
+        return all(_sqlite_database_exists(x) for x in _shard_configs(db_config))
+    if os.path.isfile(db_config["db_path"]):
+        return True
+    with _staging_lock:
+        return os.path.abspath(db_config["db_path"]) in _staging_databases
+
+
+def _shard_configs(db_config):
+    """
+    This is a private function which returns a db_config for each shard of a sharded sqlite
+    database
+    """
+    if db_config["db_type"] != "sqlite":
+        raise ValueError("Sharding is only supported for sqlite databases")
+    root, ext = os.path.splitext(db_config["db_path"])
+    shard_configs = []
+    for i in range(db_config["db_shards"]):
+        shard_config = db_config.copy()
+        shard_config["db_path"] = "{}_shard{:02d}{}".format(root, i, ext)
+        shard_config["db_shards"] = None
+        shard_config["db_conn"] = None
+        shard_configs.append(shard_config)
+    return shard_configs
+
+
+def _write_to_shards(data, db_config, db_fields, table, whatever, key_index=False):
+    """
+    This is a private function which splits rows between shards by a hash of their primary key
+    and writes each shard's rows concurrently
+    """
+    fieldnames = list(db_fields.keys())
+    key_indices = [i for i, k in enumerate(fieldnames) if "PRIMARY KEY" in db_fields[k].upper()]
+    if len(key_indices) == 0:
+        key_indices = [0]
+
+    bind_row = _row_binder(db_fields, data[0])
+    shard_configs = _shard_configs(db_config)
+    shard_rows = [[] for _ in shard_configs]
+    for row in data:
+        values = row if bind_row is None else bind_row(row)
+        shard_key = "\x1f".join([str(values[i]) for i in key_indices]).encode("utf-8")
+        shard_rows[zlib.crc32(shard_key) % len(shard_configs)].append(values)
+
+    rejected_data = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(shard_configs)) as pool:
+        futures = [
+            pool.submit(
+                write_to_db, rows, shard_config, db_fields, table, whatever, None, key_index
+            )
+            for rows, shard_config in zip(shard_rows, shard_configs)
+            if len(rows) != 0
+        ]
+        for future in futures:
+            rejected_data.extend(future.result())
+    return rejected_data
+
+
+def _sharded_connection(db_config):
+    """
+    This is a private function which makes a connection with every shard attached and a
+    temporary UNION ALL view, named after the table, over each table in the shards
+    """
+    shard_configs = _shard_configs(db_config)
+    conn = sqlite3.connect(":memory:")
+    # sqlite's default limit on attached databases is 10
+    attach_limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    if len(shard_configs) > attach_limit:
+        conn.close()
+        raise ValueError(
+            "A database with {} shards cannot be read, sqlite can attach at most {}".format(
+                len(shard_configs), attach_limit
+            )
+        )
+    for i, shard_config in enumerate(shard_configs):
+        conn.execute("ATTACH DATABASE ? AS shard{}".format(i), (shard_config["db_path"],))
+
+    tables = conn.execute("SELECT name FROM shard0.sqlite_master WHERE type='table'").fetchall()
+    for (table,) in tables:
+        conn.execute(
+            "CREATE TEMP VIEW {} AS ".format(table)
+            + " UNION ALL ".join(
+                ["SELECT * FROM shard{}.{}".format(i, table) for i in range(len(shard_configs))]
+            )
+        )
+    return conn
+
+
 def _make_connection(db_config):
     """
     This is a private function responsible for making a connection to the database
     """
 
-    if db_config["db_type"] == "sqlite":
-        db_config["db_conn"] = sqlite3.connect(db_config["db_path"])
+    if db_config["db_type"] == "sqlite" and db_config.get("db_shards"):
+        conn = _sharded_connection(db_config)
+        db_config["db_conn"] = conn
+    elif db_config["db_type"] == "sqlite":
+        conn = _staged_connection(db_config)
+        if conn is None:
+            conn = sqlite3.connect(db_config["db_path"])
+        db_config["db_conn"] = conn
     elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
-        if not check_mysql_database_exists(db_config):
+        if not _cached_database_exists(db_config):
             create_mysql_database(db_config)
 
         # This code much fiddled with, essentially I was trying to do my own connection pooling
@@ -564,6 +4775,10 @@ def create_mysql_database(db_config):
     conn.commit()
     conn.close()
 
+    clear_metadata_cache(db_config)
+    with _metadata_lock:
+        _cached_metadata(db_config)["database_exists"] = True
+
 
 def check_mysql_database_exists(db_config):
     sql_query = (
@@ -590,29 +4805,126 @@ def check_mysql_database_exists(db_config):
     return exists
 
 
+@_with_retry
 def check_table_exists(db_config, table):
     db_config = _normalise_config(db_config)
-    conn = _make_connection(db_config)
 
-    if db_config["db_type"] == "sqlite":
-        table_check_query = "SELECT name FROM sqlite_master WHERE type='table' AND name='{}';"
-    elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
-        table_check_query = (
-            "SELECT table_name as name FROM information_schema.tables "
-            "WHERE table_schema = '{}'".format(db_config["db_name"]) + " AND table_name = '{}';"
+    table_names = _query_table_names(db_config)
+    logger.debug("check_table_exists table names: {}".format(table_names))
+    table_exists = table.lower() in [x.lower() for x in table_names]
+
+    return table_exists
+
+
+def _table_engine(db_config, table):
+    """
+    This is a private function which returns the MariaDB/MySQL storage engine configured for
+    a table in db_config["db_engine"]
+    """
+    engine = db_config.get("db_engine") or "MyISAM"
+    if isinstance(engine, dict):
+        engine = engine.get(table, engine.get("default", "MyISAM"))
+    for known in MYSQL_ENGINES:
+        if engine.lower() == known.lower():
+            return known
+    raise ValueError(
+        "db_engine for table {} should be one of {}, not {}".format(table, MYSQL_ENGINES, engine)
+    )
+
+
+def _sqlite_table_options(db_config, table):
+    """
+    This is a private function which returns the SQLITE_TABLE_OPTIONS configured for a table
+    in db_config["db_sqlite_table_options"], dropping STRICT where sqlite is too old for it
+    """
+    options = db_config.get("db_sqlite_table_options") or []
+    if isinstance(options, dict):
+        options = options.get(table, options.get("default", []))
+    if isinstance(options, str):
+        options = [options]
+    options = [" ".join(x.upper().split()) for x in options]
+    for option in options:
+        if option not in SQLITE_TABLE_OPTIONS:
+            raise ValueError(
+                "db_sqlite_table_options for table {} should be from {}, not {}".format(
+                    table, SQLITE_TABLE_OPTIONS, option
+                )
+            )
+    if "STRICT" in options and sqlite3.sqlite_version_info < (3, 37, 0):
+        logger.warning(
+            "sqlite {} does not support STRICT tables, creating table {} without".format(
+                sqlite3.sqlite_version, table
+            )
         )
+        options = [x for x in options if x != "STRICT"]
+    return options
 
-    cursor = conn.cursor()
 
-    cursor.execute(table_check_query.format(table))
-    result = cursor.fetchall()
-    logger.debug("table_check_query result: {}".format(result))
-    if len(result) != 0 and result[0][0].lower() == table.lower():
-        table_exists = True
-    else:
-        table_exists = False
+def _split_field_type(field_type):
+    """
+    This is a private function which splits a field definition into its type name, without
+    any (length) or (precision, scale), and the column constraints which follow, for example
+    "VARCHAR (255) NOT NULL" into "VARCHAR" and "NOT NULL"
+    """
+    match = re.match(
+        r"\s*((?:(?!(?:CONSTRAINT|PRIMARY|NOT|NULL|UNIQUE|CHECK|DEFAULT|COLLATE|REFERENCES|"
+        r"GENERATED|AS)\b)[A-Za-z_]\w*\s*)*)(\([^)]*\))?",
+        field_type,
+        re.I,
+    )
+    end = match.end()
+    return " ".join(match.group(1).split()), field_type[end:].strip()
 
-    return table_exists
+
+def _sqlite_affinity(field_type):
+    """
+    This is a private function which applies sqlite's rules for the affinity of a declared
+    type, treating geometry as BLOB since it is stored as WKB or WKT
+    """
+    declared = _split_field_type(field_type)[0].upper()
+    if declared in GEOMETRY_TYPES or declared == "" or "BLOB" in declared:
+        return "BLOB"
+    if "INT" in declared:
+        return "INTEGER"
+    if "CHAR" in declared or "CLOB" in declared or "TEXT" in declared:
+        return "TEXT"
+    if "REAL" in declared or "FLOA" in declared or "DOUB" in declared:
+        return "REAL"
+    return "NUMERIC"
+
+
+def _strict_type(field_type):
+    """
+    This is a private function which replaces the declared type at the start of a field
+    definition, including any length or precision, with the STRICT table type of the same
+    affinity, keeping any constraints
+    """
+    declared, constraints = _split_field_type(field_type)
+    affinity = _sqlite_affinity(field_type)
+    # STRICT tables have no NUMERIC type, ANY keeps values as they are given
+    if declared == "" or affinity == "NUMERIC":
+        affinity = "ANY"
+    return " ".join([affinity] + ([constraints] if constraints != "" else []))
+
+
+def _sqlite_has_rowid(db_config, table):
+    """
+    This is a private function which checks whether a sqlite table has a rowid, that is it was
+    not created WITHOUT ROWID
+    """
+    if db_config.get("db_shards"):
+        # The UNION ALL views over shards have no rowid
+        return False
+    rows = list(
+        read_db(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+            db_config,
+            params=[table],
+        )
+    )
+    if len(rows) == 0 or rows[0]["sql"] is None:
+        return True
+    return re.search(r"\)\s*(?:STRICT\s*,\s*)?WITHOUT\s+ROWID", rows[0]["sql"], re.I) is None
 
 
 def _create_tables_db(db_config, db_fields, tables, force):
@@ -620,25 +4932,35 @@ def _create_tables_db(db_config, db_fields, tables, force):
     This is a private function responsible for creating a database table
     """
     if db_config["db_type"] == "sqlite":
-        table_check_query = "SELECT name FROM sqlite_master WHERE type='table' AND name='{}';"
-        DB_CREATE_TAIL = ")"
         name = os.path.basename(db_config["db_path"])
     elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
-        table_check_query = (
-            "SELECT table_name as name FROM information_schema.tables "
-            "WHERE table_schema = '{}'".format(db_config["db_name"]) + " AND table_name = '{}';"
-        )
-        DB_CREATE_TAIL = ") ENGINE = MyISAM"
         name = db_config["db_name"]
 
     conn = db_config["db_conn"]
     cursor = conn.cursor()
     for table in tables:
+        options = []
+        if db_config["db_type"] == "sqlite":
+            options = _sqlite_table_options(db_config, table)
+            DB_CREATE_TAIL = ")"
+            tail_options = [x for x in options if x in ("WITHOUT ROWID", "STRICT")]
+            if len(tail_options) != 0:
+                DB_CREATE_TAIL = ") " + ", ".join(tail_options)
+        elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
+            DB_CREATE_TAIL = ") ENGINE = {}".format(_table_engine(db_config, table))
         DB_CREATE_ROOT = "CREATE TABLE {} (".format(table)
 
+        fields = list(db_fields[table].items())
+        if "FIXED WIDTH FIRST" in options:
+            fields = sorted(fields, key=lambda x: _sqlite_affinity(x[1]) not in ("INTEGER", "REAL"))
+
         DB_CREATE = DB_CREATE_ROOT
         primary_keys = []
-        for k, v in db_fields[table].items():
+        for k, v in fields:
+            if "WITHOUT ROWID" in options and "AUTOINCREMENT" in v.upper():
+                raise ValueError(
+                    "AUTOINCREMENT cannot be used in WITHOUT ROWID table {}".format(table)
+                )
             if (
                 db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql"
             ) and "AUTOINCREMENT" in v:
@@ -652,7 +4974,9 @@ def _create_tables_db(db_config, db_fields, tables, force):
                 v = v.replace("PRIMARY KEY", "")
                 primary_keys.append(k)
 
-            if v in ["POINT", "POLYGON", "LINESTRING", "MULTIPOLYGON", "GEOMETRY"]:
+            if "STRICT" in options:
+                DB_CREATE = DB_CREATE + " ".join([k, _strict_type(v)]) + ","
+            elif v in GEOMETRY_TYPES:
                 logger.debug(
                     f"Appending NOT NULL to {v} in {table}"
                     "to allow spatial indexing in MariaDB/MySQL [_create_tables_db]"
@@ -661,7 +4985,10 @@ def _create_tables_db(db_config, db_fields, tables, force):
             else:
                 DB_CREATE = DB_CREATE + " ".join([k, v]) + ","
 
-        # add in the PRIMARY KEY clause
+        # add in the PRIMARY KEY clause, in db_fields order whatever the column order
+        primary_keys = [k for k in db_fields[table].keys() if k in primary_keys]
+        if len(primary_keys) == 0 and "WITHOUT ROWID" in options:
+            raise ValueError("WITHOUT ROWID table {} needs a PRIMARY KEY".format(table))
         if len(primary_keys) == 0:
             logger.warning("No primary keys supplied for table '{}'".format(table))
             DB_CREATE = DB_CREATE[0:-1] + DB_CREATE_TAIL
@@ -676,19 +5003,18 @@ def _create_tables_db(db_config, db_fields, tables, force):
             logger.warning(
                 "Force is True, so dropping table '{}' in database '{}'".format(table, name)
             )
+            _forget_table(db_config, table)
         elif force and (db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql"):
             cursor.execute("DROP TABLE IF EXISTS `{}`.`{}`;".format(db_config["db_name"], table))
             logger.warning(
                 "Force is True, so dropping table '{}' in database '{}'".format(table, name)
             )
+            _forget_table(db_config, table)
 
-        cursor.execute(table_check_query.format(table))
-        result = cursor.fetchall()
-        logger.debug("table_check_query result: {}".format(result))
-        if len(result) != 0 and result[0][0].lower() == table.lower():
-            table_exists = True
-        else:
-            table_exists = False
+        # The table list is fetched once per configure_db and then maintained in the cache
+        table_names = _cached_table_names(db_config, cursor=cursor)
+        logger.debug("table_check_query result: {}".format(table_names))
+        table_exists = table.lower() in [x.lower() for x in table_names]
 
         if not table_exists:
             logger.info("Creating table {} with statement: \n{}".format(table, DB_CREATE))
@@ -701,6 +5027,7 @@ def _create_tables_db(db_config, db_fields, tables, force):
                     )
                 )
                 raise
+            _record_created_table(db_config, table)
         else:
             logger.warning("Table '{}' already exists in database '{}'".format(table, name))
 
@@ -708,21 +5035,9 @@ def _create_tables_db(db_config, db_fields, tables, force):
     db_config["db_conn"].close()
 
 
+@_with_retry
 def list_tables(db_config):
     db_config = _normalise_config(db_config)
-    table_check_query = ""
-    if db_config["db_type"] == "sqlite":
-        table_check_query = "SELECT name FROM sqlite_master WHERE type='table';"
-    elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
-        table_check_query = (
-            "SELECT table_name as name FROM "
-            "information_schema.tables WHERE table_schema = '{}';".format(db_config["db_name"])
-        )
-
-    conn = _make_connection(db_config)
-    cursor = conn.cursor()
 
-    cursor.execute(table_check_query)
-
-    result = cursor.fetchall()
+    result = [(x,) for x in _query_table_names(db_config)]
     return result
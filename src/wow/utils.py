@@ -1,11 +1,32 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import ast
+import bz2
+import cProfile
 import csv
+import gzip
+import hashlib
+import itertools
 import logging
+import io
+import lzma
 import os
+import pstats
+import re
+import tracemalloc
 
-from typing import Any, Dict, List, Optional, Union
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+COMPRESSION_OPENERS = {"gzip": gzip.open, "bz2": bz2.open, "xz": lzma.open}
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "bz2": ".bz2", "xz": ".xz"}
+
+# Functions in these files are singled out in profile summaries
+PROFILE_FOCUS_FILES = [
+    os.path.join("wow", "db_utils.py"),
+    os.path.join("wow", "utils.py"),
+]
 
 
 def write_dictionary(
@@ -52,6 +73,306 @@ def write_dictionary(
         dict_writer.writerows(data)
 
 
+def write_dictionaries_streaming(
+    filename: Union[str, os.PathLike],
+    data: Iterable[Dict[str, Any]],
+    compression: Optional[str] = None,
+    max_rows: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    batch_size: Optional[int] = 10000,
+    delimiter: Optional[str] = ",",
+    fieldnames: Optional[List[str]] = None,
+) -> List[str]:
+    """
+    Writes an iterable of dictionaries to one or more CSV files, consuming it in batches so that
+    memory use does not depend on the number of rows
+
+    :param filename: file path to the output file, when the output is split a part number is
+                     inserted before the extension, e.g. out_0001.csv.gz
+    :param data: An iterable of dictionaries to write, for example a read_db generator
+    :param compression: None, "gzip", "bz2" or "xz", the matching suffix is added to filename
+                        if it is not already present
+    :param max_rows: start a new file after this many rows
+    :param max_bytes: start a new file once this many (uncompressed) characters are written
+    :param batch_size: number of rows taken from data per write
+    :param delimiter: Delimiter character as per dictwriter interface
+    :param fieldnames: the CSV columns, by default the keys of the first dictionary. If given, a
+                       file with only the header is written when data is empty, otherwise no
+                       file is written
+    :return: returns a list of the files written
+    """
+    if compression is not None and compression not in COMPRESSION_OPENERS:
+        raise ValueError("Unknown compression '{}'".format(compression))
+
+    filename = os.fspath(filename)
+    if compression is not None and not filename.endswith(COMPRESSION_SUFFIXES[compression]):
+        filename = filename + COMPRESSION_SUFFIXES[compression]
+    opener = COMPRESSION_OPENERS.get(compression, open)
+    split = max_rows is not None or max_bytes is not None
+
+    root, ext = os.path.splitext(filename)
+    if compression is not None:
+        root, inner_ext = os.path.splitext(root)
+        ext = inner_ext + ext
+
+    data = iter(data)
+    filenames = []
+    output_file = None
+    try:
+        while True:
+            batch = list(itertools.islice(data, batch_size))
+            if len(batch) == 0:
+                if len(filenames) == 0 and fieldnames is not None:
+                    logging.info("New file {} is being created".format(filename))
+                    with opener(filename, "wt", encoding="utf-8", newline="") as header_file:
+                        csv.DictWriter(
+                            header_file, fieldnames, lineterminator="\n", delimiter=delimiter
+                        ).writeheader()
+                    filenames.append(filename)
+                break
+            position = 0
+            while position < len(batch):
+                if output_file is None:
+                    part_filename = filename
+                    if split:
+                        part_filename = "{}_{:04d}{}".format(root, len(filenames) + 1, ext)
+                    logging.info("New file {} is being created".format(part_filename))
+                    output_file = _CountingWriter(
+                        opener(part_filename, "wt", encoding="utf-8", newline="")
+                    )
+                    dict_writer = csv.DictWriter(
+                        output_file,
+                        list(batch[0].keys()) if fieldnames is None else fieldnames,
+                        lineterminator="\n",
+                        delimiter=delimiter,
+                    )
+                    dict_writer.writeheader()
+                    filenames.append(part_filename)
+                    rows_in_file = 0
+
+                if max_bytes is None:
+                    n_rows = len(batch) - position
+                    if max_rows is not None:
+                        n_rows = min(n_rows, max_rows - rows_in_file)
+                    dict_writer.writerows(itertools.islice(batch, position, position + n_rows))
+                else:
+                    # The size limit is checked after every row
+                    n_rows = 1
+                    dict_writer.writerow(batch[position])
+                position = position + n_rows
+                rows_in_file = rows_in_file + n_rows
+
+                if (max_rows is not None and rows_in_file >= max_rows) or (
+                    max_bytes is not None and output_file.count >= max_bytes
+                ):
+                    output_file.close()
+                    output_file = None
+    finally:
+        if output_file is not None:
+            output_file.close()
+
+    if len(filenames) == 0:
+        logging.info(
+            "No data supplied to write_dictionaries_streaming for filename: {}".format(filename)
+        )
+    return filenames
+
+
+class _CountingWriter:
+    """
+    Wraps a text file, counting the characters written through it
+    """
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.count = 0
+
+    def write(self, text: str) -> int:
+        self.count = self.count + len(text)
+        return self.output_file.write(text)
+
+    def close(self) -> None:
+        self.output_file.close()
+
+
+def file_fingerprint(
+    filename: Union[str, os.PathLike], chunk_size: Optional[int] = 1024 * 1024
+) -> Dict[str, Any]:
+    """
+    Calculates a fingerprint for a file, reading it in chunks so large files are not held in
+    memory
+
+    :param filename: file path to the file
+    :param chunk_size: number of bytes hashed at a time
+    :return: a dictionary with keys size, mtime and sha256 (a hex digest)
+    """
+    stat = os.stat(filename)
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), b""):
+            sha256.update(chunk)
+
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256.hexdigest()}
+
+
+def start_profiling() -> cProfile.Profile:
+    """
+    Starts cProfile and tracemalloc, for use with write_profile, keeping a snapshot of the
+    memory already traced so that write_profile reports only what was allocated afterwards
+
+    :return: the running profiler
+    """
+    tracemalloc.start(25)
+    profiler = cProfile.Profile()
+    profiler.start_snapshot = tracemalloc.take_snapshot()
+    profiler.enable()
+    return profiler
+
+
+def write_profile(
+    profiler: cProfile.Profile, prefix: Union[str, os.PathLike], top: Optional[int] = 20
+) -> List[str]:
+    """
+    Stops profiling started by start_profiling and writes three files: prefix.pstats (for
+    pstats/snakeviz), prefix.collapsed (collapsed stacks for flamegraph.pl or speedscope) and
+    prefix.txt, a summary of the top functions by time and allocation, with those in db_utils
+    and utils listed separately
+
+    Allocations are the difference between snapshots taken by start_profiling and here, so
+    they show memory allocated while profiling and still held when it stopped. Memory
+    allocated and freed in between only shows in the peak traced memory.
+
+    :param profiler: the profiler returned by start_profiling
+    :param prefix: path prefix for the output files
+    :param top: number of entries in each section of the summary
+    :return: returns a list of the files written
+    """
+    profiler.disable()
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    prefix = os.fspath(prefix)
+    stats = pstats.Stats(profiler)
+    stats.dump_stats(prefix + ".pstats")
+
+    with open(prefix + ".collapsed", "w", encoding="utf-8") as output_file:
+        for stack, seconds in sorted(_collapsed_stacks(stats).items()):
+            microseconds = int(seconds * 1e6)
+            if microseconds > 0:
+                output_file.write("{} {}\n".format(stack, microseconds))
+
+    summary = io.StringIO()
+    summary.write("Peak traced memory: {:.1f} MB\n\n".format(peak / 1e6))
+    summary.write("Top {} functions by cumulative time\n".format(top))
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(top)
+    focus_pattern = "|".join([re.escape(x) for x in PROFILE_FOCUS_FILES])
+    summary.write("db_utils and utils functions by internal time\n")
+    pstats.Stats(profiler, stream=summary).sort_stats("tottime").print_stats(focus_pattern, top)
+
+    summary.write(
+        "Top {} allocation sites since profiling started, still held at exit\n".format(top)
+    )
+    differences = snapshot.compare_to(profiler.start_snapshot, "lineno")
+    for stat in [x for x in differences if x.size_diff > 0][0:top]:
+        frame = stat.traceback[0]
+        summary.write(
+            "{:>12} B {:>8} blocks  {}:{}\n".format(
+                stat.size_diff, stat.count_diff, frame.filename, frame.lineno
+            )
+        )
+    summary.write("\ndb_utils and utils functions by allocation since profiling started\n")
+    differences = snapshot.compare_to(profiler.start_snapshot, "traceback")
+    for (filename, function), (size, count) in _allocations_by_function(differences)[0:top]:
+        summary.write(
+            "{:>12} B {:>8} blocks  {} ({})\n".format(
+                size, count, function, os.path.basename(filename)
+            )
+        )
+
+    with open(prefix + ".txt", "w", encoding="utf-8") as output_file:
+        output_file.write(summary.getvalue())
+
+    return [prefix + ".pstats", prefix + ".collapsed", prefix + ".txt"]
+
+
+def _profile_label(func: Tuple[str, int, str]) -> str:
+    filename, _, name = func
+    return "{}:{}".format(os.path.basename(filename), name).replace(";", ",").replace(" ", "_")
+
+
+def _collapsed_stacks(stats: pstats.Stats) -> Dict[str, float]:
+    """
+    Converts the caller/callee graph recorded by cProfile into collapsed stacks, sharing each
+    function's time between its callers in proportion to the time spent on each call path
+    """
+    callees = defaultdict(dict)
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge
+
+    stacks = defaultdict(float)
+
+    def walk(func, path, fraction):
+        _, _, tottime, _, _ = stats.stats[func]
+        path = path + [func]
+        stacks[";".join([_profile_label(x) for x in path])] += tottime * fraction
+        for callee, edge in callees[func].items():
+            callee_cumtime = stats.stats[callee][3]
+            # Skip recursion, by function rather than label since labels drop the line
+            # number, and call paths too small to show on a flamegraph
+            if callee_cumtime <= 0 or callee in path:
+                continue
+            callee_fraction = fraction * edge[3] / callee_cumtime
+            if callee_fraction * callee_cumtime >= 1e-6:
+                walk(callee, path, callee_fraction)
+
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        if len(callers) == 0:
+            walk(func, [], 1.0)
+    return stacks
+
+
+def _allocations_by_function(
+    differences: List[tracemalloc.StatisticDiff],
+) -> List[Tuple[Any, Any]]:
+    """
+    Totals the growth in tracemalloc allocations by the innermost db_utils or utils function
+    on their traceback
+    """
+    function_ranges = {}
+    totals = defaultdict(lambda: [0, 0])
+    for stat in differences:
+        if stat.size_diff <= 0:
+            continue
+        for frame in reversed(stat.traceback):
+            if not any(frame.filename.endswith(x) for x in PROFILE_FOCUS_FILES):
+                continue
+            if frame.filename not in function_ranges:
+                function_ranges[frame.filename] = _function_ranges(frame.filename)
+            function = "<module>"
+            for start, end, name in function_ranges[frame.filename]:
+                if start <= frame.lineno <= end:
+                    function = name
+            totals[(frame.filename, function)][0] += stat.size_diff
+            totals[(frame.filename, function)][1] += stat.count_diff
+            break
+    return sorted(totals.items(), key=lambda x: x[1][0], reverse=True)
+
+
+def _function_ranges(filename: str) -> List[Tuple[int, int, str]]:
+    with open(filename, encoding="utf-8") as source_file:
+        tree = ast.parse(source_file.read())
+    # Sorted so that nested functions, which start later, take precedence
+    return sorted(
+        [
+            (x.lineno, x.end_lineno, x.name)
+            for x in ast.walk(tree)
+            if isinstance(x, (ast.FunctionDef, ast.AsyncFunctionDef))
+        ]
+    )
+
+
 # Logging to file and console simultaneously
 # https://aykutakin.wordpress.com/2013/08/06/logging-to-console-and-file-in-python/
 def initialise_logger(output_file, mode="both", force=False, handler_mode="w", verbose=False):
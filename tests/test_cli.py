@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import csv
+import gzip
+import os
+import unittest
+
+from collections import OrderedDict
+
+from click.testing import CliRunner
+
+from wow.cli import cli_group
+from wow.db_utils import configure_db, write_to_db
+
+
+class TestCli(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        test_root = os.path.dirname(__file__)
+        cls.db_dir = os.path.join(test_root, "fixtures")
+        cls.db_fields = OrderedDict(
+            [
+                ("UPRN", "INTEGER PRIMARY KEY"),
+                ("PropertyID", "INT"),
+                ("Addr1", "TEXT"),
+            ]
+        )
+
+    def test_export(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        configure_db(db_file_path, self.db_fields, tables="test", force=True)
+        write_to_db(
+            [(i, i % 7, "row {}".format(i)) for i in range(1, 26)],
+            db_file_path,
+            self.db_fields,
+            table="test",
+        )
+        output_root = os.path.join(self.db_dir, "test_cli_export")
+
+        result = CliRunner().invoke(
+            cli_group,
+            [
+                "export",
+                "select * from test;",
+                db_file_path,
+                output_root + ".csv",
+                "--compression",
+                "gzip",
+                "--max-rows",
+                "20",
+            ],
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        filenames = result.output.split()
+        self.assertEqual(filenames, [output_root + "_{:04d}.csv.gz".format(i) for i in (1, 2)])
+        rows = []
+        for filename in filenames:
+            with gzip.open(filename, "rt", encoding="utf-8") as f:
+                rows.extend(list(csv.DictReader(f)))
+            os.remove(filename)
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[0], {"UPRN": "1", "PropertyID": "1", "Addr1": "row 1"})
+
+    def test_profile(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        configure_db(db_file_path, self.db_fields, tables="test", force=True)
+        write_to_db([(1, 2, "hello")], db_file_path, self.db_fields, table="test")
+        prefix = os.path.join(self.db_dir, "test_cli_profile")
+        output_filename = os.path.join(self.db_dir, "test_cli_profile.csv")
+
+        result = CliRunner().invoke(
+            cli_group,
+            ["--profile", prefix, "export", "select * from test;", db_file_path, output_filename],
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        filenames = [prefix + ".pstats", prefix + ".collapsed", prefix + ".txt"]
+        for filename in filenames:
+            self.assertIn("Profile written to {}".format(filename), result.output)
+        with open(prefix + ".collapsed", encoding="utf-8") as collapsed_file:
+            self.assertIn("db_utils.py:export_query_to_csv", collapsed_file.read())
+        with open(prefix + ".txt", encoding="utf-8") as summary_file:
+            self.assertIn("db_utils and utils functions by internal time", summary_file.read())
+
+        for filename in filenames + [output_filename]:
+            os.remove(filename)
@@ -2,8 +2,18 @@
 # encoding: utf-8
 
 import unittest
+import array
+import csv
+import gzip
+import itertools
 import os
 import sqlite3
+import subprocess
+import sys
+import threading
+import tracemalloc
+
+from unittest import mock
 
 # try:
 #     import mysql.connector
@@ -13,18 +23,49 @@ import sqlite3
 #     mysql_connector_installed = False
 import pymysql
 
+from pymysql.constants.CR import CR_CONN_HOST_ERROR, CR_SERVER_LOST
+
 from collections import OrderedDict
 
 from wow.db_utils import (
     db_config_template,
     configure_db,
     write_to_db,
+    write_columns_to_db,
     _make_connection,
+    _close_bulk_load,
     read_db,
+    read_db_cached,
+    recommend_indexes,
+    clear_query_log,
     update_to_db,
     finalise_db,
     check_mysql_database_exists,
     delete_from_db,
+    get_batch_stats,
+    get_retry_metrics,
+    reset_retry_metrics,
+    CircuitBreakerOpen,
+    check_table_exists,
+    list_tables,
+    drop_db_tables,
+    get_table_columns,
+    clear_metadata_cache,
+    read_db_partitioned,
+    delete_from_db_chunked,
+    delete_keys_from_db,
+    geometry_to_wkb,
+    transfer_table,
+    export_query_to_csv,
+    file_unchanged_since_load,
+    record_file_load,
+    write_changed_rows,
+    commit_staged_db,
+    BufferedWriter,
+    read_by_keys,
+    KeysetScan,
+    sample_db,
+    read_db_bbox,
 )
 
 
@@ -117,6 +158,55 @@ class MariaDBUtilitiesTests(unittest.TestCase):
         rows = cursor.fetchall()
         self.assertEqual(expected, rows)
 
+    def test_write_wkb_geom_to_mariadb(self):
+        db_config = db_config_template.copy()
+
+        db_fields = OrderedDict(
+            [
+                ("UPRN", "INTEGER PRIMARY KEY"),
+                ("PropertyID", "INT"),
+                ("points", "POINT"),
+            ]
+        )
+
+        db_config = configure_db(db_config, db_fields, tables="test", force=True)
+        data = [
+            (1, 2, geometry_to_wkb("POINT", (0, 10))),
+            (2, 3, geometry_to_wkb("POINT", (20, 20))),
+            (3, 3, geometry_to_wkb("POINT", (5, 15))),
+        ]
+
+        expected = ((1, 2, 0.0, 10.0), (2, 3, 20.0, 20.0), (3, 3, 5.0, 15.0))
+
+        write_to_db(data, db_config, db_fields, table="test")
+        conn = _make_connection(db_config)
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            select UPRN, PropertyID, X(points), Y(points) from test;
+        """
+        )
+        rows = cursor.fetchall()
+        self.assertEqual(expected, rows)
+
+    def test_bulk_load_innodb_mariadb(self):
+        db_config = db_config_template.copy()
+        db_config["db_engine"] = {"test": "InnoDB"}
+        db_config = configure_db(db_config, self.db_fields, tables="test", force=True)
+        data = [(i, i % 3, "row {}".format(i)) for i in range(1, 1001)]
+        write_to_db(data, db_config, self.db_fields, table="test", bulk_load=True)
+
+        conn = _make_connection(db_config)
+        cursor = conn.cursor()
+        cursor.execute(
+            "select ENGINE from information_schema.TABLES "
+            "where TABLE_SCHEMA = 'test' and TABLE_NAME = 'test';"
+        )
+        self.assertEqual(cursor.fetchone()[0], "InnoDB")
+        cursor.execute("select count(*) from test;")
+        self.assertEqual(cursor.fetchone()[0], 1000)
+        conn.close()
+
     def test_update_mariadb(self):
         db_config = db_config_template.copy()
         db_config = configure_db(db_config, self.db_fields, tables="test", force=True)
@@ -159,6 +249,98 @@ class MariaDBUtilitiesTests(unittest.TestCase):
             test_data = OrderedDict(zip(self.db_fields.keys(), data[i]))
             self.assertEqual(row, test_data)
 
+    def test_read_by_keys_mariadb(self):
+        db_config = db_config_template.copy()
+        db_config = configure_db(db_config, self.db_fields, tables="test", force=True)
+        data = [(i, i % 3, "row {}".format(i)) for i in range(1, 2001)]
+        write_to_db(data, db_config, self.db_fields, table="test")
+
+        # A small max_allowed_packet splits the keys into more, smaller queries
+        with mock.patch("wow.db_utils._max_allowed_packet", return_value=1024):
+            with mock.patch("wow.db_utils.read_db", wraps=read_db) as spy:
+                rows = list(read_by_keys("test", db_config, "UPRN", range(1, 2001)))
+        self.assertEqual(sorted([x["UPRN"] for x in rows]), list(range(1, 2001)))
+        self.assertEqual(spy.call_count > 1, True)
+
+    def test_keyset_scan_mariadb(self):
+        db_config = db_config_template.copy()
+        db_config = configure_db(db_config, self.db_fields, tables="test", force=True)
+        data = [(i, i % 3, "row {}".format(i)) for i in range(1, 26)]
+        write_to_db(data, db_config, self.db_fields, table="test")
+
+        scan = KeysetScan("test", db_config, page_size=7)
+        self.assertEqual([tuple(x.values()) for x in scan], data)
+        self.assertEqual(scan.pages, 4)
+
+        # Stop part way through and resume from the token in a new scan
+        scan = KeysetScan("test", db_config, where="PropertyID = 1", page_size=3)
+        rows = list(itertools.islice(scan, 4))
+        resumed = KeysetScan(
+            "test", db_config, where="PropertyID = 1", page_size=3, token=scan.token
+        )
+        rows = rows + list(resumed)
+        self.assertEqual([tuple(x.values()) for x in rows], [x for x in data if x[1] == 1])
+
+    def test_sample_db_mariadb(self):
+        db_config = db_config_template.copy()
+        db_config = configure_db(db_config, self.db_fields, tables="test", force=True)
+        data = [(i, i % 3, "row {}".format(i)) for i in range(1, 401) if i % 5 != 0]
+        write_to_db(data, db_config, self.db_fields, table="test")
+
+        for method in ["probe", "scan"]:
+            sample = sample_db("test", db_config, n=20, seed=1, method=method)
+            self.assertEqual(len(sample), 20)
+            self.assertEqual(list(sample[0].keys()), list(self.db_fields.keys()))
+            self.assertEqual(set(tuple(x.values()) for x in sample) <= set(data), True)
+            self.assertEqual(sample, sample_db("test", db_config, n=20, seed=1, method=method))
+
+    def test_transfer_table_mariadb(self):
+        db_config = db_config_template.copy()
+        sqlite_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        copy_path = os.path.join(self.db_dir, "test_config_db.sqlite")
+        for db_file_path in [sqlite_path, copy_path]:
+            if os.path.isfile(db_file_path):
+                os.remove(db_file_path)
+        db_fields = OrderedDict([("Code", "TEXT PRIMARY KEY"), ("points", "POINT")])
+        data = [("A{}".format(i), geometry_to_wkb("POINT", (i, 10))) for i in range(3)]
+        configure_db(sqlite_path, db_fields, tables="test")
+        write_to_db(data, sqlite_path, db_fields, table="test")
+
+        # A sqlite TEXT key becomes an indexable VARCHAR and geometry comes back as WKB
+        transfer_table("test", sqlite_path, db_config, force=True)
+        columns = list(
+            read_db(
+                "select COLUMN_NAME, COLUMN_TYPE from information_schema.COLUMNS "
+                "where TABLE_SCHEMA = 'test' and TABLE_NAME = 'test' order by ORDINAL_POSITION",
+                db_config,
+            )
+        )
+        self.assertEqual([x["COLUMN_TYPE"] for x in columns], ["varchar(255)", "point"])
+        transfer_table("test", db_config, copy_path)
+        self.assertEqual(
+            [tuple(x.values()) for x in read_db("select * from test order by Code", copy_path)],
+            data,
+        )
+
+        # The source is streamed, so the reader holds a few batches rather than the table
+        configure_db(db_config, self.db_fields, tables="test", force=True)
+        data = [(i, i % 7, "row {}".format(i) * 5) for i in range(20000)]
+        write_to_db(data, db_config, self.db_fields, table="test")
+        del data
+        os.remove(copy_path)
+        tracemalloc.start()
+        try:
+            held = list(read_db("select * from test", db_config))
+            held_bytes = tracemalloc.get_traced_memory()[0]
+            del held
+            tracemalloc.reset_peak()
+            base_bytes = tracemalloc.get_traced_memory()[0]
+            transfer_table("test", db_config, copy_path, batch_size=500, queue_size=2)
+            peak_bytes = tracemalloc.get_traced_memory()[1] - base_bytes
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak_bytes, held_bytes / 4)
+
     def test_check_mysql_database_exists(self):
         db_config = db_config_template.copy()
         db_config["db_name"] = "djnfsjnf"
@@ -181,6 +363,7 @@ class DatabaseUtilitiesTests(unittest.TestCase):
         )
         test_root = os.path.dirname(__file__)
         cls.db_dir = os.path.join(test_root, "fixtures")
+        cls.sha_test_file = os.path.join(os.path.dirname(test_root), "fixtures", "sha_test_file")
 
         # if os.path.isfile(cls.db_file_path):
         #    os.remove(cls.db_file_path)
@@ -295,6 +478,33 @@ class DatabaseUtilitiesTests(unittest.TestCase):
             rows = cursor.fetchall()
             self.assertEqual(data[1:], rows)
 
+    def test_delete_from_db_chunked(self):
+        db_filename = "test_delete_from_db.sqlite"
+        db_file_path = os.path.join(self.db_dir, db_filename)
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        data = [(i, i % 3, "row {}".format(i)) for i in range(1, 51)]
+        configure_db(db_file_path, self.db_fields, tables="test")
+        write_to_db(data, db_file_path, self.db_fields, table="test")
+
+        deleted = delete_from_db_chunked("test", db_file_path, where="PropertyID = 0", chunk_size=4)
+        self.assertEqual(deleted, 16)
+
+        deleted = delete_keys_from_db("test", db_file_path, "UPRN", range(1, 11), chunk_size=3)
+        self.assertEqual(deleted, 7)
+
+        deleted = delete_keys_from_db(
+            "test", db_file_path, ["UPRN", "PropertyID"], [(11, 2), (13, 2), (14, 2)]
+        )
+        self.assertEqual(deleted, 2)
+
+        with sqlite3.connect(db_file_path) as c:
+            cursor = c.cursor()
+            cursor.execute("select UPRN from test;")
+            rows = [x[0] for x in cursor.fetchall()]
+            expected = [x[0] for x in data if x[1] != 0 and x[0] > 10 and x[0] not in (11, 14)]
+            self.assertEqual(expected, rows)
+
     def test_write_dictionaries_to_db(self):
         db_filename = "test_write_db.sqlite"
         db_file_path = os.path.join(self.db_dir, db_filename)
@@ -318,6 +528,40 @@ class DatabaseUtilitiesTests(unittest.TestCase):
             for i, row in enumerate(rows):
                 self.assertEqual([x for x in data[i].values()], list(row))
 
+    def test_write_dictionaries_by_fieldname_to_db(self):
+        db_filename = "test_write_db.sqlite"
+        db_file_path = os.path.join(self.db_dir, db_filename)
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        data = [
+            {"Addr1": "hello", "UPRN": 1, "PropertyID": 2, "Extra": "ignored"},
+            {"PropertyID": 3, "Addr1": "Fred", "UPRN": 2},
+        ]
+        configure_db(db_file_path, self.db_fields, tables="test")
+        write_to_db(data, db_file_path, self.db_fields, table="test")
+        rejected = write_to_db(data[1:], db_file_path, self.db_fields, table="test", whatever=True)
+        self.assertEqual(rejected, data[1:])
+        with sqlite3.connect(db_file_path) as c:
+            cursor = c.cursor()
+            cursor.execute("select * from test;")
+            rows = cursor.fetchall()
+            self.assertEqual([(1, 2, "hello"), (2, 3, "Fred")], rows)
+
+    def test_geometry_to_wkb(self):
+        self.assertEqual(
+            geometry_to_wkb("POINT", (0, 10)).hex(),
+            "0101000000" + "0000000000000000" + "0000000000002440",
+        )
+        self.assertEqual(
+            geometry_to_wkb("LINESTRING", [(0, 0), (1, 1)]).hex(),
+            "010200000002000000" + "0000000000000000" * 2 + "000000000000f03f" * 2,
+        )
+        polygon = [[(0, 0), (0, 1), (1, 1), (0, 0)]]
+        wkb = geometry_to_wkb("MULTIPOLYGON", [polygon, polygon])
+        self.assertEqual(wkb[:9].hex(), "010600000002000000")
+        self.assertEqual(wkb[9:], geometry_to_wkb("POLYGON", polygon) * 2)
+        self.assertRaises(ValueError, geometry_to_wkb, "CIRCLE", (0, 0))
+
     def test_update_to_db(self):
         db_filename = "test_update_db.sqlite"
         db_file_path = os.path.join(self.db_dir, db_filename)
@@ -467,6 +711,37 @@ class DatabaseUtilitiesTests(unittest.TestCase):
             test_data = OrderedDict(zip(self.db_fields.keys(), data[i]))
             self.assertEqual(row, test_data)
 
+    def test_read_db_with_params(self):
+        db_config = os.path.join(self.db_dir, "test_finalise_db.sqlite")
+        if os.path.isfile(db_config):
+            os.remove(db_config)
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        configure_db(db_config, self.db_fields, tables="test")
+        write_to_db(data, db_config, self.db_fields, table="test")
+
+        rows = list(read_db("select * from test where Addr1 = ?;", db_config, params=["Fred"]))
+        self.assertEqual([tuple(x.values()) for x in rows], [data[1]])
+
+    def test_read_by_keys(self):
+        db_config = os.path.join(self.db_dir, "test_finalise_db.sqlite")
+        if os.path.isfile(db_config):
+            os.remove(db_config)
+        data = [(i, i % 3, "row {}".format(i)) for i in range(1, 21)]
+        configure_db(db_config, self.db_fields, tables="test")
+        write_to_db(data, db_config, self.db_fields, table="test")
+
+        keys = [2, 5, 7, 11, 99]
+        for use_temp_table in [False, True]:
+            rows = read_by_keys(
+                "test", db_config, "UPRN", keys, chunk_size=2, use_temp_table=use_temp_table
+            )
+            self.assertEqual(sorted([x["UPRN"] for x in rows]), [2, 5, 7, 11])
+
+        rows = read_by_keys(
+            "test", db_config, ["UPRN", "PropertyID"], [(2, 2), (5, 0), (7, 1)], columns=["Addr1"]
+        )
+        self.assertEqual(sorted([x["Addr1"] for x in rows]), ["row 2", "row 7"])
+
     def test_read_db_doesnot_create_database(self):
         db_filename = "nonexistent_db.sqlite"
         db_config = os.path.join(self.db_dir, db_filename)
@@ -482,3 +757,1075 @@ class DatabaseUtilitiesTests(unittest.TestCase):
             pass
 
         self.assertEqual(os.path.isfile(db_config), False)
+
+    def _flaky_sqlite_connect(self, failures):
+        real_connect = sqlite3.connect
+        attempts = []
+
+        def connect(*args, **kwargs):
+            attempts.append(1)
+            if len(attempts) <= failures:
+                raise sqlite3.OperationalError("database is locked")
+            return real_connect(*args, **kwargs)
+
+        return mock.patch("sqlite3.connect", side_effect=connect), attempts
+
+    def _retry_config(self, **policy):
+        db_config = db_config_template.copy()
+        db_config.update(
+            {
+                "db_type": "sqlite",
+                "db_path": os.path.join(self.db_dir, "test_write_db.sqlite"),
+                "retry_policy": dict({"base_wait": 0.0, "jitter": False}, **policy),
+            }
+        )
+        return db_config
+
+    def test_retry_on_locked_sqlite(self):
+        db_config = self._retry_config()
+        configure_db(db_config, self.db_fields, tables="test", force=True)
+        data = [(1, 2, "hello"), (2, 3, "Fred")]
+        reset_retry_metrics()
+
+        flaky_connect, attempts = self._flaky_sqlite_connect(2)
+        with flaky_connect:
+            write_to_db(data, db_config, self.db_fields, table="test")
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(len(list(read_db("SELECT * FROM test", db_config))), 2)
+        metrics = get_retry_metrics()
+        self.assertEqual(metrics["retries"], 2)
+        self.assertEqual(metrics["giveups"], 0)
+
+        self.assertRaises(
+            sqlite3.OperationalError, write_to_db, data, db_config, self.db_fields, table="missing"
+        )
+        self.assertEqual(get_retry_metrics()["retries"], 2)
+
+    def test_retry_write_columns_to_db(self):
+        db_config = self._retry_config()
+        configure_db(db_config, self.db_fields, tables="test", force=True)
+        columns = {"UPRN": [1, 2, 3], "PropertyID": [2, 3, 3], "Addr1": ["a", "b", "c"]}
+        reset_retry_metrics()
+
+        flaky_connect, attempts = self._flaky_sqlite_connect(2)
+        with flaky_connect:
+            self.assertEqual(write_columns_to_db(columns, db_config, self.db_fields, "test"), 3)
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(get_retry_metrics()["retries"], 2)
+        self.assertEqual(len(list(read_db("SELECT * FROM test", db_config))), 3)
+
+    def test_retry_read_by_keys_temp_table(self):
+        db_config = self._retry_config()
+        configure_db(db_config, self.db_fields, tables="test", force=True)
+        write_to_db(
+            [(i, i % 3, "row {}".format(i)) for i in range(1, 21)],
+            db_config,
+            self.db_fields,
+            table="test",
+        )
+        columns = get_table_columns(db_config, "test")
+        reset_retry_metrics()
+
+        flaky_connect, attempts = self._flaky_sqlite_connect(2)
+        with flaky_connect, mock.patch("wow.db_utils.get_table_columns", return_value=columns):
+            rows = list(
+                read_by_keys(
+                    "test", db_config, "UPRN", [2, 5, 99], chunk_size=2, use_temp_table=True
+                )
+            )
+        self.assertEqual(sorted([x["UPRN"] for x in rows]), [2, 5])
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(get_retry_metrics()["retries"], 2)
+
+    def test_retry_mysql_writes(self):
+        db_config = db_config_template.copy()
+        db_config["retry_policy"] = {
+            "base_wait": 0.0,
+            "jitter": False,
+            "max_attempts": 3,
+            "breaker_threshold": 100,
+        }
+        data = [(1, 2, "hello")]
+        lost = pymysql.err.OperationalError(CR_SERVER_LOST, "Lost connection")
+        refused = pymysql.err.OperationalError(CR_CONN_HOST_ERROR, "Can't connect")
+
+        # A lost connection may have left a MyISAM write partly applied, so is not retried
+        for engine, error, attempts in [
+            ("MYISAM", lost, 1),
+            ("INNODB", lost, 3),
+            ("MYISAM", refused, 3),
+        ]:
+            with mock.patch("wow.db_utils._mysql_table_engine", return_value=engine), mock.patch(
+                "wow.db_utils._make_connection", side_effect=error
+            ) as connect:
+                self.assertRaises(
+                    pymysql.err.OperationalError,
+                    write_to_db,
+                    data,
+                    db_config,
+                    self.db_fields,
+                    table="test",
+                )
+            self.assertEqual(connect.call_count, attempts)
+        reset_retry_metrics()
+
+    def test_retry_circuit_breaker(self):
+        db_config = self._retry_config(max_attempts=3, breaker_threshold=2, breaker_reset=60.0)
+        configure_db(db_config, self.db_fields, tables="test", force=True)
+        reset_retry_metrics()
+
+        # One call's own retries do not trip the breaker, two exhausted calls do
+        flaky_connect, attempts = self._flaky_sqlite_connect(100)
+        with flaky_connect:
+            self.assertRaises(sqlite3.OperationalError, list, read_db("SELECT 1", db_config))
+            self.assertEqual(len(attempts), 3)
+            self.assertEqual(get_retry_metrics()["breaker_trips"], 0)
+            self.assertRaises(sqlite3.OperationalError, list, read_db("SELECT 1", db_config))
+            self.assertRaises(CircuitBreakerOpen, list, read_db("SELECT 1", db_config))
+        self.assertEqual(len(attempts), 6)
+        metrics = get_retry_metrics()
+        self.assertEqual(metrics["breaker_trips"], 1)
+        self.assertEqual(metrics["breaker_rejections"], 1)
+        reset_retry_metrics()
+
+        # write_to_db with key_index recurses into write_to_db and read_db, which are only
+        # retried by the outer call
+        clear_metadata_cache()
+        flaky_connect, attempts = self._flaky_sqlite_connect(100)
+        with flaky_connect:
+            self.assertRaises(
+                sqlite3.OperationalError,
+                write_to_db,
+                [(1, 2, "hello")],
+                db_config,
+                self.db_fields,
+                table="test",
+                key_index=True,
+            )
+        self.assertEqual(len(attempts), 3)
+        reset_retry_metrics()
+
+    def test_metadata_cache(self):
+        db_filename = "test_config_db.sqlite"
+        db_file_path = os.path.join(self.db_dir, db_filename)
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+        self.assertEqual(check_table_exists(db_file_path, "test"), True)
+        self.assertEqual(
+            get_table_columns(db_file_path, "test"),
+            OrderedDict([("UPRN", "INTEGER"), ("PropertyID", "INT"), ("Addr1", "TEXT")]),
+        )
+
+        # list_tables and check_table_exists always query, so see a table created behind
+        # db_utils' back
+        with sqlite3.connect(db_file_path) as c:
+            c.execute("create table other (ID INT)")
+        self.assertEqual(check_table_exists(db_file_path, "other"), True)
+        self.assertEqual(list_tables(db_file_path), [("test",), ("other",)])
+
+        drop_db_tables(db_file_path, ["other"])
+        self.assertEqual(check_table_exists(db_file_path, "other"), False)
+        self.assertEqual(list_tables(db_file_path), [("test",)])
+
+    def test_read_db_partitioned(self):
+        db_filename = "test_finalise_db.sqlite"
+        db_config = os.path.join(self.db_dir, db_filename)
+        if os.path.isfile(db_config):
+            os.remove(db_config)
+        data = [(i, i % 7, "row {}".format(i)) for i in range(1, 101)]
+        configure_db(db_config, self.db_fields, tables="test")
+        write_to_db(data, db_config, self.db_fields, table="test")
+
+        expected = list(read_db("select * from test order by UPRN;", db_config))
+        rows = list(read_db_partitioned("test", db_config, key="UPRN", partition_size=7, workers=3))
+        self.assertEqual(rows, expected)
+
+        rows = list(
+            read_db_partitioned(
+                "test",
+                db_config,
+                columns=["UPRN", "Addr1"],
+                where="PropertyID = 3",
+                partition_size=11,
+                workers=2,
+                ordered=False,
+                executor="process",
+            )
+        )
+        self.assertEqual(sorted([x["UPRN"] for x in rows]), [x[0] for x in data if x[1] == 3])
+
+    def test_transfer_table(self):
+        source_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        dest_path = os.path.join(self.db_dir, "test_config_db.sqlite")
+        for db_file_path in [source_path, dest_path]:
+            if os.path.isfile(db_file_path):
+                os.remove(db_file_path)
+        data = [(i, i % 7, "row {}".format(i)) for i in range(1, 101)]
+        configure_db(source_path, self.db_fields, tables="test")
+        write_to_db(data, source_path, self.db_fields, table="test")
+
+        stats = transfer_table(
+            "test",
+            source_path,
+            dest_path,
+            dest_table="copy",
+            indexes=[("idx_propertyid", "PropertyID")],
+            batch_size=7,
+            queue_size=2,
+        )
+        self.assertEqual(stats["rows"], 100)
+
+        with sqlite3.connect(dest_path) as c:
+            cursor = c.cursor()
+            cursor.execute("select * from copy;")
+            self.assertEqual(data, cursor.fetchall())
+            cursor.execute("PRAGMA table_info(copy)")
+            self.assertEqual([x[5] for x in cursor.fetchall()], [1, 0, 0])
+            cursor.execute("PRAGMA index_list(copy)")
+            self.assertEqual([x[1] for x in cursor.fetchall()], ["idx_propertyid"])
+
+    def test_transfer_table_memory(self):
+        source_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        dest_path = os.path.join(self.db_dir, "test_config_db.sqlite")
+        for db_file_path in [source_path, dest_path]:
+            if os.path.isfile(db_file_path):
+                os.remove(db_file_path)
+        configure_db(source_path, self.db_fields, tables="test")
+        data = [(i, i % 7, "row {}".format(i) * 5) for i in range(20000)]
+        write_to_db(data, source_path, self.db_fields, table="test")
+        del data
+
+        tracemalloc.start()
+        try:
+            held = list(read_db("select * from test", source_path))
+            held_bytes = tracemalloc.get_traced_memory()[0]
+            del held
+            tracemalloc.reset_peak()
+            base_bytes = tracemalloc.get_traced_memory()[0]
+            stats = transfer_table("test", source_path, dest_path, batch_size=500, queue_size=2)
+            peak_bytes = tracemalloc.get_traced_memory()[1] - base_bytes
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(stats["rows"], 20000)
+        self.assertLess(peak_bytes, held_bytes / 4)
+
+    def test_export_query_to_csv(self):
+        db_config = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_config):
+            os.remove(db_config)
+        data = [(i, i % 7, "row {}".format(i)) for i in range(1, 26)]
+        configure_db(db_config, self.db_fields, tables="test")
+        write_to_db(data, db_config, self.db_fields, table="test")
+
+        output_root = os.path.join(self.db_dir, "test_export")
+        filenames = export_query_to_csv(
+            "select * from test;",
+            db_config,
+            output_root + ".csv",
+            compression="gzip",
+            max_rows=10,
+            batch_size=4,
+        )
+        self.assertEqual(filenames, [output_root + "_{:04d}.csv.gz".format(i) for i in range(1, 4)])
+        rows = []
+        for filename in filenames:
+            with gzip.open(filename, "rt", encoding="utf-8") as f:
+                rows.extend(list(csv.DictReader(f)))
+            os.remove(filename)
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[24], {"UPRN": "25", "PropertyID": "4", "Addr1": "row 25"})
+
+        # A query with no rows still writes the header
+        filenames = export_query_to_csv(
+            "select * from test where UPRN > 100;", db_config, output_root + ".csv"
+        )
+        self.assertEqual(filenames, [output_root + ".csv"])
+        with open(filenames[0], encoding="utf-8") as f:
+            self.assertEqual(f.read(), "UPRN,PropertyID,Addr1\n")
+        os.remove(filenames[0])
+
+    def test_file_unchanged_since_load(self):
+        db_config = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_config):
+            os.remove(db_config)
+        configure_db(db_config, self.db_fields, tables="test")
+
+        self.assertEqual(file_unchanged_since_load(self.sha_test_file, db_config), False)
+        fingerprint = record_file_load(self.sha_test_file, db_config)
+        self.assertEqual(
+            fingerprint["sha256"],
+            "a883dafc480d466ee04e0d6da986bd78eb1fdd2178d04693723da3a8f95d42f4",
+        )
+        self.assertEqual(fingerprint["size"], 5)
+        self.assertEqual(file_unchanged_since_load(self.sha_test_file, db_config), True)
+
+        # A touched file is hashed once, then its new modification time is recorded
+        stat = os.stat(self.sha_test_file)
+        try:
+            os.utime(self.sha_test_file, (stat.st_atime, stat.st_mtime + 10))
+            self.assertEqual(file_unchanged_since_load(self.sha_test_file, db_config), True)
+            rows = list(read_db("select mtime from wow_file_fingerprints", db_config))
+            self.assertEqual(rows[0]["mtime"], stat.st_mtime + 10)
+        finally:
+            os.utime(self.sha_test_file, (stat.st_atime, stat.st_mtime))
+
+    def test_write_changed_rows(self):
+        db_config = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_config):
+            os.remove(db_config)
+        configure_db(db_config, self.db_fields, tables="test")
+        # A row already in the table, written before change detection was used
+        write_to_db([(1, 2, "hello")], db_config, self.db_fields, table="test")
+
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        counts = write_changed_rows(data, db_config, self.db_fields, table="test", key="UPRN")
+        self.assertEqual(counts, {"new": 2, "changed": 1, "unchanged": 0})
+
+        data = [(1, 2, "hello"), (2, 3, "Frederick"), (3, 3, "Beans"), (4, 5, "Peas")]
+        counts = write_changed_rows(
+            data, db_config, self.db_fields, table="test", key="UPRN", chunk_size=3
+        )
+        self.assertEqual(counts, {"new": 1, "changed": 1, "unchanged": 2})
+
+        with sqlite3.connect(db_config) as c:
+            cursor = c.cursor()
+            cursor.execute("select * from test;")
+            self.assertEqual(data, cursor.fetchall())
+
+    def test_staged_sqlite_db(self):
+        db_file_path = os.path.join(self.db_dir, "test_finalise_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        db_config = {"db_type": "sqlite", "db_path": db_file_path, "db_staging": True}
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        configure_db(db_config, self.db_fields, tables="test")
+        write_to_db(data, db_file_path, self.db_fields, table="test")
+
+        # Everything so far is in memory
+        self.assertEqual(os.path.isfile(db_file_path), False)
+        self.assertEqual(len(list(read_db("select * from test;", db_file_path))), 3)
+
+        finalise_db(db_file_path, index_name="idx_addr1", table="test", colname="Addr1")
+        with sqlite3.connect(db_file_path) as c:
+            cursor = c.cursor()
+            cursor.execute("select * from test;")
+            self.assertEqual(data, cursor.fetchall())
+            cursor.execute("PRAGMA index_list(test)")
+            self.assertEqual([x[1] for x in cursor.fetchall()], ["idx_addr1"])
+        self.assertEqual(commit_staged_db(db_file_path), False)
+
+    def test_staged_sqlite_db_over_budget(self):
+        db_file_path = os.path.join(self.db_dir, "test_finalise_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        db_config = {
+            "db_type": "sqlite",
+            "db_path": db_file_path,
+            "db_staging": True,
+            "db_staging_budget": 1,
+        }
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        configure_db(db_config, self.db_fields, tables="test")
+        write_to_db(data, db_file_path, self.db_fields, table="test")
+
+        # The staged database spilled to disk as soon as it had any content
+        self.assertEqual(commit_staged_db(db_file_path), False)
+        with sqlite3.connect(db_file_path) as c:
+            cursor = c.cursor()
+            cursor.execute("select * from test;")
+            self.assertEqual(data, cursor.fetchall())
+
+        # A single write larger than the budget spills part way rather than overshooting it
+        os.remove(db_file_path)
+        db_config["db_staging_budget"] = 64 * 1024
+        data = [(i, i % 7, "row {}".format(i) * 20) for i in range(1, 2001)]
+        configure_db(db_config, self.db_fields, tables="test")
+        self.assertEqual(os.path.isfile(db_file_path), False)
+        write_to_db(data, db_file_path, self.db_fields, table="test")
+        self.assertEqual(commit_staged_db(db_file_path), False)
+        with sqlite3.connect(db_file_path) as c:
+            self.assertEqual(c.execute("select count(*) from test;").fetchone()[0], 2000)
+
+    def test_staged_sqlite_db_at_exit(self):
+        db_file_path = os.path.join(self.db_dir, "test_finalise_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        script = (
+            "from collections import OrderedDict\n"
+            "from wow.db_utils import configure_db, write_to_db\n"
+            "db_fields = OrderedDict([('UPRN', 'INTEGER PRIMARY KEY'), ('Addr1', 'TEXT')])\n"
+            "db_config = {{'db_type': 'sqlite', 'db_path': {!r}, 'db_staging': True}}\n"
+            "configure_db(db_config, db_fields, tables='test')\n"
+            "write_to_db([(1, 'hello'), (2, 'Fred')], {!r}, db_fields, table='test')\n"
+        ).format(db_file_path, db_file_path)
+        subprocess.run([sys.executable, "-c", script], check=True)
+
+        # The process exited without finalise_db, the staged database was written at exit
+        with sqlite3.connect(db_file_path) as c:
+            self.assertEqual(c.execute("select count(*) from test;").fetchone()[0], 2)
+
+    def test_sharded_sqlite_db(self):
+        db_file_path = os.path.join(self.db_dir, "test_sharded_db.sqlite")
+        db_config = {"db_type": "sqlite", "db_path": db_file_path, "db_shards": 3}
+        data = [(i, i % 4, "row {}".format(i)) for i in range(1, 31)]
+        configure_db(db_config, self.db_fields, tables="test", force=True)
+        write_to_db(data, db_config, self.db_fields, table="test")
+
+        shard_counts = []
+        for i in range(3):
+            shard_path = os.path.join(self.db_dir, "test_sharded_db_shard{:02d}.sqlite".format(i))
+            with sqlite3.connect(shard_path) as c:
+                shard_counts.append(c.execute("select count(*) from test").fetchone()[0])
+        self.assertEqual(sum(shard_counts), 30)
+        self.assertEqual(min(shard_counts) > 0, True)
+
+        rows = list(read_db("select * from test order by UPRN;", db_config))
+        self.assertEqual([tuple(x.values()) for x in rows], data)
+
+        rows = list(
+            read_db(
+                "select PropertyID, count(*) as n, avg(UPRN) as mean from test "
+                "group by PropertyID order by PropertyID;",
+                db_config,
+            )
+        )
+        self.assertEqual([x["n"] for x in rows], [7, 8, 8, 7])
+        self.assertEqual(rows[0]["mean"], 16.0)
+
+        delete_from_db("delete from test where PropertyID = 0", db_config)
+        rows = list(read_db("select count(*) as n from test;", db_config))
+        self.assertEqual(rows[0]["n"], 23)
+
+        # Entry points which cannot work on the UNION ALL views are applied to each shard
+        rows = list(read_db_partitioned("test", db_config, partition_size=7))
+        self.assertEqual(len(rows), 23)
+        self.assertEqual(len(sample_db("test", db_config, n=5, seed=1)), 5)
+        self.assertEqual(
+            delete_from_db_chunked("test", db_config, where="PropertyID = 1", chunk_size=2), 8
+        )
+        self.assertEqual(delete_keys_from_db("test", db_config, "UPRN", [2, 3, 4]), 2)
+        rows = list(read_db("select count(*) as n from test;", db_config))
+        self.assertEqual(rows[0]["n"], 13)
+        self.assertRaises(
+            ValueError, write_changed_rows, data, db_config, self.db_fields, table="test"
+        )
+
+        finalise_db(db_config, index_name="idx_addr1", table="test", colname="Addr1")
+        shard_paths = [
+            os.path.join(self.db_dir, "test_sharded_db_shard{:02d}.sqlite".format(i))
+            for i in range(3)
+        ]
+        for shard_path in shard_paths:
+            with sqlite3.connect(shard_path) as c:
+                indexes = c.execute("PRAGMA index_list(test)").fetchall()
+            self.assertEqual([x[1] for x in indexes], ["idx_addr1"])
+        drop_db_tables(db_config, ["test"])
+        for shard_path in shard_paths:
+            with sqlite3.connect(shard_path) as c:
+                self.assertEqual(c.execute("select name from sqlite_master").fetchall(), [])
+            os.remove(shard_path)
+
+    def test_buffered_writer(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        data = [(i, i % 3, "row {}".format(i)) for i in range(1, 26)]
+        configure_db(db_file_path, self.db_fields, tables="test")
+
+        with BufferedWriter(db_file_path, self.db_fields, max_rows=10, max_seconds=60) as writer:
+            for row in data[0:10]:
+                writer.write([row], table="test")
+            writer.flush()
+            for row in data[10:20]:
+                writer.write([row], table="test")
+            writer.flush()
+            for row in data[20:]:
+                writer.write([row], table="test")
+        metrics = writer.metrics()
+        self.assertEqual(metrics["rows_written"], 25)
+        self.assertEqual(metrics["batches"], 3)
+        self.assertEqual(metrics["flush_reasons"]["rows"], 2)
+        self.assertEqual(metrics["flush_reasons"]["explicit"], 1)
+
+        with sqlite3.connect(db_file_path) as c:
+            self.assertEqual(data, c.execute("select * from test;").fetchall())
+
+    def test_buffered_writer_time_threshold(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+        now = [1000.0]
+
+        writer = BufferedWriter(
+            db_file_path, {"test": self.db_fields}, max_seconds=5, clock=lambda: now[0]
+        )
+        writer.write([(1, 2, "hello")], table="test")
+        self.assertEqual(writer.metrics()["rows_written"], 0)
+        now[0] = now[0] + 6
+        writer.flush()
+        with sqlite3.connect(db_file_path) as c:
+            self.assertEqual([(1, 2, "hello")], c.execute("select * from test;").fetchall())
+        self.assertEqual(writer.metrics()["flush_reasons"]["time"], 1)
+        self.assertEqual(writer.metrics()["flush_reasons"]["explicit"], 0)
+        writer.close()
+
+    def test_buffered_writer_error(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+
+        # Errors on the background thread are raised in the caller and rows not written,
+        # including other tables' rows, stay buffered for the next flush
+        writer = BufferedWriter(db_file_path, self.db_fields, max_seconds=60)
+        writer.write([(1, 2, "hello")], table="missing")
+        writer.write([(3, 4, "world")], table="test")
+        self.assertRaises(sqlite3.OperationalError, writer.flush)
+        with sqlite3.connect(db_file_path) as c:
+            self.assertEqual([], c.execute("select * from test;").fetchall())
+
+        configure_db(db_file_path, self.db_fields, tables="missing")
+        writer.flush()
+        with sqlite3.connect(db_file_path) as c:
+            self.assertEqual([(1, 2, "hello")], c.execute("select * from missing;").fetchall())
+            self.assertEqual([(3, 4, "world")], c.execute("select * from test;").fetchall())
+
+        # Rows which close cannot write are attached to the error
+        writer.write([(5, 6, "again")], table="absent")
+        with self.assertRaises(sqlite3.OperationalError) as cm:
+            writer.close()
+        self.assertEqual(cm.exception.unwritten_rows, {"absent": [(5, 6, "again")]})
+
+    def test_buffered_writer_error_age_flush(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+
+        # Once the error has been raised the age threshold flushes the kept rows again
+        failure = [sqlite3.OperationalError("disk I/O error")]
+
+        def flaky_write(*args, **kwargs):
+            if len(failure) != 0:
+                raise failure.pop()
+            return write_to_db(*args, **kwargs)
+
+        with mock.patch("wow.db_utils.write_to_db", side_effect=flaky_write):
+            writer = BufferedWriter(db_file_path, self.db_fields, max_seconds=0.05)
+            writer.write([(1, 2, "hello")], table="test")
+            self.assertRaises(sqlite3.OperationalError, writer.flush)
+            with writer._condition:
+                writer._condition.wait_for(lambda: writer._metrics["rows_written"] == 1, 10)
+            self.assertEqual(writer.metrics()["flush_reasons"]["time"], 1)
+            writer.close()
+
+    def test_buffered_writer_error_at_exit(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        script = (
+            "from collections import OrderedDict\n"
+            "from wow.db_utils import BufferedWriter\n"
+            "db_fields = OrderedDict([('UPRN', 'INTEGER PRIMARY KEY'), ('Addr1', 'TEXT')])\n"
+            "writer = BufferedWriter({!r}, db_fields)\n"
+            "writer.write([(1, 'hello'), (2, 'Fred')], table='missing')\n"
+        ).format(db_file_path)
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True)
+
+        # The failed flush at exit is logged rather than raised
+        self.assertEqual(result.returncode, 0)
+        self.assertNotIn("Traceback", result.stderr)
+        self.assertIn("rows unwritten: {'missing': 2}", result.stderr)
+
+    def test_write_to_db_batch_bytes(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+        data = [
+            OrderedDict([("Addr1", "row {}".format(i) * 10), ("UPRN", i), ("PropertyID", i % 7)])
+            for i in range(1, 501)
+        ]
+
+        self.assertEqual(get_batch_stats(db_file_path, "test"), None)
+        tracemalloc.start()
+        try:
+            write_to_db(data, db_file_path, self.db_fields, table="test", batch_bytes=4096)
+        finally:
+            tracemalloc.stop()
+
+        with sqlite3.connect(db_file_path) as c:
+            rows = c.execute("select UPRN, PropertyID, Addr1 from test order by UPRN;").fetchall()
+        self.assertEqual(rows, [(x["UPRN"], x["PropertyID"], x["Addr1"]) for x in data])
+
+        batch_stats = get_batch_stats(db_file_path, "test")
+        self.assertEqual(batch_stats["batches"], len(batch_stats["batch_sizes"]))
+        self.assertEqual(sum(batch_stats["batch_sizes"]), 500)
+        self.assertEqual(batch_stats["batches"] > 1, True)
+        self.assertEqual(batch_stats["max_batch_bytes"] <= 4096, True)
+        # The first batch is sized from a guess, the measured overhead then shrinks the rest
+        self.assertEqual(batch_stats["overhead"] > 1.0, True)
+        self.assertEqual(max(batch_stats["batch_sizes"][1:]) < batch_stats["batch_sizes"][0], True)
+        # and small batches, which mostly measure the fixed cost per call, do not shrink it
+        self.assertEqual(batch_stats["batches"] < 250, True)
+
+        # The traced peak, which write_profile reports, is left as it is
+        tracemalloc.start()
+        try:
+            block = bytearray(8 * 1024 * 1024)
+            del block
+            peak = tracemalloc.get_traced_memory()[1]
+            more = [(i, i % 7, "row {}".format(i)) for i in range(501, 1001)]
+            write_to_db(more, db_file_path, self.db_fields, table="test", batch_bytes=4096)
+            self.assertEqual(tracemalloc.get_traced_memory()[1] >= peak, True)
+        finally:
+            tracemalloc.stop()
+
+    def test_write_columns_to_db(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+        columns = {
+            "Addr1": ["row {}".format(i) for i in range(1, 26)],
+            "UPRN": range(1, 26),
+            "PropertyID": array.array("i", [i % 3 for i in range(1, 26)]),
+        }
+
+        n_rows = write_columns_to_db(columns, db_file_path, self.db_fields, "test", batch_size=7)
+        self.assertEqual(n_rows, 25)
+
+        with sqlite3.connect(db_file_path) as c:
+            rows = c.execute("select * from test order by UPRN;").fetchall()
+        self.assertEqual(rows, [(i, i % 3, "row {}".format(i)) for i in range(1, 26)])
+
+        columns["UPRN"] = range(1, 10)
+        self.assertRaises(
+            ValueError, write_columns_to_db, columns, db_file_path, self.db_fields, "test"
+        )
+
+    def test_read_db_prefetch(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+        data = [(i, i % 3, "row {}".format(i)) for i in range(1, 101)]
+        write_to_db(data, db_file_path, self.db_fields, table="test")
+
+        sql_query = "select * from test order by UPRN;"
+        expected = list(read_db(sql_query, db_file_path))
+        rows = list(read_db(sql_query, db_file_path, prefetch=2, prefetch_batch_size=7))
+        self.assertEqual(rows, expected)
+
+        # Stopping early closes the background thread
+        reader = read_db(sql_query, db_file_path, prefetch=1, prefetch_batch_size=5)
+        self.assertEqual(next(reader)["UPRN"], 1)
+        reader.close()
+        self.assertEqual([x.name for x in threading.enumerate() if "prefetch" in x.name], [])
+
+        # Errors in the background thread are raised in the caller
+        reader = read_db("select * from missing;", db_file_path, prefetch=2)
+        self.assertRaises(sqlite3.OperationalError, list, reader)
+
+    def test_read_db_cached(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        cache_dir = os.path.join(self.db_dir, "result_cache")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+        data = [(1, 2, "hello"), (2, 3, None), (3, 3, "Beans")]
+        write_to_db(data, db_file_path, self.db_fields, table="test")
+
+        sql_query = "select UPRN, Addr1, UPRN * 1.5 as half, count(*) as n from test group by UPRN;"
+        expected = list(read_db(sql_query, db_file_path))
+        self.assertEqual(list(read_db_cached(sql_query, db_file_path, cache_dir)), expected)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        stale_path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+        self.assertEqual(list(read_db_cached(sql_query, db_file_path, cache_dir)), expected)
+
+        # Changing the database changes its version so the query runs again
+        write_to_db([(4, 4, "Fred")], db_file_path, self.db_fields, table="test")
+        rows = list(read_db_cached(sql_query, db_file_path, cache_dir))
+        self.assertEqual(len(rows), 4)
+
+        # The least recently used result set is evicted to keep within max_bytes
+        os.utime(stale_path, (0, 0))
+        total = sum(os.path.getsize(os.path.join(cache_dir, x)) for x in os.listdir(cache_dir))
+        list(read_db_cached("select UPRN from test;", db_file_path, cache_dir, max_bytes=total))
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        self.assertEqual(os.path.exists(stale_path), False)
+
+        # An empty result set is cached as its column names alone
+        empty_query = "select UPRN from test where UPRN > 10;"
+        self.assertEqual(list(read_db_cached(empty_query, db_file_path, cache_dir)), [])
+        self.assertEqual(len(os.listdir(cache_dir)), 3)
+        with mock.patch("wow.db_utils._read_db_cursor") as read_cursor:
+            self.assertEqual(list(read_db_cached(empty_query, db_file_path, cache_dir)), [])
+        read_cursor.assert_not_called()
+
+        for name in os.listdir(cache_dir):
+            os.remove(os.path.join(cache_dir, name))
+        os.rmdir(cache_dir)
+
+    def test_recommend_indexes(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+        data = [(i, i % 3, "row {}".format(i)) for i in range(1, 101)]
+        write_to_db(data, db_file_path, self.db_fields, table="test")
+
+        db_config = db_config_template.copy()
+        db_config.update({"db_type": "sqlite", "db_path": db_file_path, "db_index_advisor": True})
+        clear_query_log(db_config)
+        for _ in range(3):
+            list(read_db("select * from test where PropertyID = ? order by Addr1;", db_config, [1]))
+        list(read_db("select * from test where UPRN = 3;", db_config))
+        delete_from_db("delete from test where Addr1 = 'row 7';", db_config)
+
+        recommendations = recommend_indexes(db_config)
+        self.assertEqual(
+            [(x["table"], x["columns"], x["executions"]) for x in recommendations],
+            [("test", ["PropertyID", "Addr1"], 3), ("test", ["Addr1"], 1)],
+        )
+        self.assertEqual(recommendations[0]["table_rows"], 99)
+        self.assertEqual(recommendations[0]["write_overhead"], 1.0)
+
+        recommend_indexes(db_config, create=True, limit=1)
+        self.assertEqual(
+            [x["columns"] for x in recommend_indexes(db_config)],
+            [["Addr1"]],
+        )
+        clear_query_log(db_config)
+
+        # A delete which is retried is still recorded once
+        flaky_connect, attempts = self._flaky_sqlite_connect(1)
+        with flaky_connect:
+            delete_from_db("delete from test where Addr1 = 'row 8';", db_config)
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual([x["executions"] for x in recommend_indexes(db_config)], [1])
+        clear_query_log(db_config)
+
+    def test_recommend_indexes_names(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        db_fields = OrderedDict(
+            [("code", "TEXT PRIMARY KEY"), ("a", "INT"), ("b", "INT"), ("a_b", "INT")]
+        )
+        configure_db(db_file_path, db_fields, tables="test")
+        write_to_db(
+            [("c{}".format(i), i % 3, i % 5, i % 7) for i in range(100)],
+            db_file_path,
+            db_fields,
+            table="test",
+        )
+
+        db_config = db_config_template.copy()
+        db_config.update({"db_type": "sqlite", "db_path": db_file_path, "db_index_advisor": True})
+        clear_query_log(db_config)
+        list(read_db("select * from test where a = 1 and b = 2;", db_config))
+        list(read_db("select * from test where a_b = 1;", db_config))
+
+        recommendations = recommend_indexes(db_config)
+        self.assertEqual(sorted([x["columns"] for x in recommendations]), [["a", "b"], ["a_b"]])
+        index_names = [x["index_name"] for x in recommendations]
+        self.assertEqual(len(set(index_names)), 2)
+        self.assertIn("idx_test_a_b", index_names)
+        # The TEXT primary key has its own automatic index, written alongside the table
+        self.assertEqual(recommendations[0]["write_overhead"], 0.5)
+
+        recommend_indexes(db_config, create=True)
+        self.assertEqual(recommend_indexes(db_config), [])
+        clear_query_log(db_config)
+
+    def test_write_to_db_key_index(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+        data = [(i, i % 3, "row {}".format(i)) for i in range(1, 11)]
+        write_to_db(data, db_file_path, self.db_fields, table="test")
+
+        reload = [(i, i % 3, "row {}".format(i)) for i in range(5, 16)] + [(15, 0, "again")]
+        rejected = write_to_db(reload, db_file_path, self.db_fields, table="test", key_index=True)
+        self.assertEqual(rejected, reload[0:6] + [(15, 0, "again")])
+
+        # Dictionary rows and the index kept from the previous call
+        rejected = write_to_db(
+            [
+                {"UPRN": 15, "PropertyID": 1, "Addr1": "x"},
+                {"UPRN": 16, "PropertyID": 1, "Addr1": "y"},
+            ],
+            db_file_path,
+            self.db_fields,
+            table="test",
+            key_index=True,
+        )
+        self.assertEqual([x["UPRN"] for x in rejected], [15])
+
+        # Deleted keys are forgotten so can be written again
+        delete_from_db("delete from test where UPRN = 1;", db_file_path)
+        rejected = write_to_db(
+            [(1, 1, "back")], db_file_path, self.db_fields, "test", key_index=True
+        )
+        self.assertEqual(rejected, [])
+
+        with sqlite3.connect(db_file_path) as c:
+            self.assertEqual(c.execute("select count(*) from test;").fetchone()[0], 16)
+
+    def test_write_to_db_key_index_other_writes(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        copy_path = os.path.join(self.db_dir, "test_finalise_db.sqlite")
+        for path in [db_file_path, copy_path]:
+            if os.path.isfile(path):
+                os.remove(path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+        write_to_db([(1, 1, "one")], db_file_path, self.db_fields, "test", key_index=True)
+
+        # Rows written without key_index, directly or through BufferedWriter, are added to
+        # the index built by the first call
+        write_to_db([(2, 2, "two")], db_file_path, self.db_fields, "test")
+        with BufferedWriter(db_file_path, self.db_fields) as writer:
+            writer.write([(3, 3, "three")], table="test")
+        rejected = write_to_db(
+            [(2, 0, "x"), (3, 0, "x")], db_file_path, self.db_fields, "test", key_index=True
+        )
+        self.assertEqual(rejected, [(2, 0, "x"), (3, 0, "x")])
+
+        # write_columns_to_db and transfer_table drop it, so it is read again
+        columns = {"UPRN": [4], "PropertyID": [4], "Addr1": ["four"]}
+        write_columns_to_db(columns, db_file_path, self.db_fields, "test")
+        rejected = write_to_db([(4, 0, "x")], db_file_path, self.db_fields, "test", key_index=True)
+        self.assertEqual(rejected, [(4, 0, "x")])
+
+        configure_db(copy_path, self.db_fields, tables="test")
+        write_to_db([(9, 9, "nine")], copy_path, self.db_fields, "test", key_index=True)
+        transfer_table("test", db_file_path, copy_path, force=True)
+        rejected = write_to_db([(1, 0, "x")], copy_path, self.db_fields, "test", key_index=True)
+        self.assertEqual(rejected, [(1, 0, "x")])
+
+    def test_keyset_scan(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+        data = [(i, i % 3, "row {}".format(i)) for i in range(1, 26)]
+        write_to_db(data, db_file_path, self.db_fields, table="test")
+
+        scan = KeysetScan("test", db_file_path, page_size=7)
+        self.assertEqual([tuple(x.values()) for x in scan], data)
+        self.assertEqual(scan.pages, 4)
+
+        # Stop part way through and resume from the token in a new scan
+        scan = KeysetScan(
+            "test", db_file_path, columns=["Addr1"], where="PropertyID = 1", page_size=3
+        )
+        rows = list(itertools.islice(scan, 4))
+        resumed = KeysetScan(
+            "test",
+            db_file_path,
+            columns=["Addr1"],
+            where="PropertyID = 1",
+            page_size=3,
+            token=scan.token,
+        )
+        rows = rows + list(resumed)
+        self.assertEqual([x["Addr1"] for x in rows], [x[2] for x in data if x[1] == 1])
+
+        # A compound key
+        scan = KeysetScan("test", db_file_path, key=["PropertyID", "UPRN"], page_size=4)
+        self.assertEqual(
+            [tuple(x.values()) for x in scan], sorted(data, key=lambda x: (x[1], x[0]))
+        )
+
+    def test_sample_db(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+        data = [(i, i % 3, "row {}".format(i)) for i in range(1, 401) if i % 5 != 0]
+        write_to_db(data, db_file_path, self.db_fields, table="test")
+
+        sample = sample_db("test", db_file_path, n=20, seed=1)
+        self.assertEqual(len(sample), 20)
+        self.assertEqual(len(set(x["UPRN"] for x in sample)), 20)
+        self.assertEqual(set(tuple(x.values()) for x in sample) <= set(data), True)
+        self.assertEqual(sample, sample_db("test", db_file_path, n=20, seed=1))
+
+        sample = sample_db("test", db_file_path, fraction=0.1, columns=["Addr1"], seed=2)
+        self.assertEqual(len(sample), 32)
+        self.assertEqual(list(sample[0].keys()), ["Addr1"])
+
+        sample = sample_db("test", db_file_path, n=20, seed=3, method="scan")
+        self.assertEqual(len(sample), 20)
+        self.assertEqual(sample, sample_db("test", db_file_path, n=20, seed=3, method="scan"))
+
+    def test_close_bulk_load(self):
+        # A failed cleanup is logged so the exception which stopped the load is raised, and
+        # the session settings are restored even if the indexes cannot be rebuilt
+        conn = mock.Mock()
+        conn.rollback.side_effect = pymysql.err.OperationalError(CR_SERVER_LOST, "lost")
+        cursor = mock.Mock()
+        cursor.execute.side_effect = [pymysql.err.OperationalError(1030, "enable keys"), None]
+        bulk_settings = {
+            "unique_checks": 1,
+            "foreign_key_checks": 1,
+            "autocommit": 1,
+            "disable_keys": True,
+        }
+        with self.assertLogs("wow.db_utils", level="WARNING") as logs:
+            _close_bulk_load(conn, cursor, "test", bulk_settings, committed=False)
+        self.assertEqual(len(logs.output), 2)
+        self.assertEqual(cursor.execute.call_args[0][1], (1, 1, 1))
+
+        # After a committed load a failure to end it is raised
+        cursor.execute.side_effect = [None, pymysql.err.OperationalError(1030, "set")]
+        with self.assertLogs("wow.db_utils", level="WARNING"):
+            self.assertRaises(
+                pymysql.err.OperationalError,
+                _close_bulk_load,
+                conn,
+                cursor,
+                "test",
+                bulk_settings,
+                committed=True,
+            )
+
+    def test_write_to_db_bulk_load(self):
+        # bulk_load only changes MariaDB/MySQL session settings, sqlite writes as usual
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        write_to_db(data, db_file_path, self.db_fields, table="test", bulk_load=True)
+
+        with sqlite3.connect(db_file_path) as c:
+            self.assertEqual(data, c.execute("select * from test;").fetchall())
+        self.assertRaises(
+            sqlite3.IntegrityError,
+            write_to_db,
+            data,
+            db_file_path,
+            self.db_fields,
+            table="test",
+            bulk_load=True,
+        )
+
+    def test_configure_sqlite_table_options(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        db_fields = OrderedDict(
+            [
+                ("ID", "INT PRIMARY KEY"),
+                ("Letter", "TEXT PRIMARY KEY"),
+                ("Name", "VARCHAR(64)"),
+                ("Score", "FLOAT"),
+            ]
+        )
+        db_config = db_config_template.copy()
+        db_config.update(
+            {
+                "db_type": "sqlite",
+                "db_path": db_file_path,
+                "db_sqlite_table_options": ["WITHOUT ROWID", "STRICT", "FIXED WIDTH FIRST"],
+            }
+        )
+        configure_db(db_config, db_fields, tables="test")
+
+        with sqlite3.connect(db_file_path) as c:
+            sql = c.execute("select sql from sqlite_master where name = 'test';").fetchone()[0]
+            columns = [x[1:3] for x in c.execute("PRAGMA table_info(test);").fetchall()]
+        self.assertEqual(sql.endswith(") WITHOUT ROWID, STRICT"), True)
+        self.assertEqual(
+            columns, [("ID", "INTEGER"), ("Score", "REAL"), ("Letter", "TEXT"), ("Name", "TEXT")]
+        )
+
+        data = [(i // 3, chr(65 + i % 3), "name {}".format(i), i / 2) for i in range(9)]
+        write_to_db(data, db_config, db_fields, table="test")
+        self.assertRaises(
+            sqlite3.IntegrityError,
+            write_to_db,
+            [("not an int", "A", "x", 1.0)],
+            db_config,
+            db_fields,
+            table="test",
+        )
+
+        rows = list(read_db_partitioned("test", db_config, partition_size=2))
+        self.assertEqual(len(rows), 9)
+        self.assertEqual(delete_from_db_chunked("test", db_config, where="ID > 0", chunk_size=2), 6)
+
+    def test_configure_sqlite_strict_types(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        db_fields = OrderedDict(
+            [
+                ("Code", "VARCHAR (255) NOT NULL PRIMARY KEY"),
+                ("Price", "DECIMAL(10, 2) DEFAULT 0"),
+                ("Count", "UNSIGNED BIG INT"),
+                ("Ratio", "DOUBLE PRECISION"),
+            ]
+        )
+        db_config = db_config_template.copy()
+        db_config.update(
+            {"db_type": "sqlite", "db_path": db_file_path, "db_sqlite_table_options": ["STRICT"]}
+        )
+        configure_db(db_config, db_fields, tables="test")
+
+        with sqlite3.connect(db_file_path) as c:
+            columns = [x[1:6] for x in c.execute("PRAGMA table_info(test);").fetchall()]
+        self.assertEqual(
+            columns,
+            [
+                ("Code", "TEXT", 1, None, 1),
+                ("Price", "ANY", 0, "0", 0),
+                ("Count", "INTEGER", 0, None, 0),
+                ("Ratio", "REAL", 0, None, 0),
+            ],
+        )
+
+    def test_sqlite_rtree_bbox(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        db_fields = OrderedDict([("ID", "INTEGER PRIMARY KEY"), ("geom", "GEOMETRY")])
+        configure_db(db_file_path, db_fields, tables="test", force=True)
+
+        data = [
+            (1, "POINT(0 10)"),
+            (2, "POLYGON((0 0, 4 0, 4 4, 0 4, 0 0))"),
+            (3, "LINESTRING(20 20, 30 25)"),
+        ]
+        write_to_db(data, db_file_path, db_fields, table="test")
+        self.assertEqual(
+            list(read_db("SELECT geom FROM test WHERE ID = 1", db_file_path))[0]["geom"],
+            geometry_to_wkb("POINT", (0, 10)),
+        )
+        self.assertRaises(ValueError, read_db_bbox, "test", db_file_path, (0, 0, 1, 1))
+
+        finalise_db(db_file_path, table="test", colname="geom", spatial=True)
+        rows = read_db_bbox("test", db_file_path, (3, 3, 25, 22))
+        self.assertEqual(sorted(row["ID"] for row in rows), [2, 3])
+
+        write_to_db([(4, geometry_to_wkb("POINT", (5, 5)))], db_file_path, db_fields, table="test")
+        rows = read_db_bbox("test", db_file_path, (4.5, 4.5, 6, 6), columns=["ID"])
+        self.assertEqual([row["ID"] for row in rows], [4])
+
+        # Updated geometries are stored as WKB and move in the R*Tree
+        update_to_db([(1, "POINT(50 50)")], db_file_path, ["ID", "geom"], table="test", key="ID")
+        self.assertEqual(
+            list(read_db("SELECT geom FROM test WHERE ID = 1", db_file_path))[0]["geom"],
+            geometry_to_wkb("POINT", (50, 50)),
+        )
+        rows = read_db_bbox("test", db_file_path, (49, 49, 51, 51), columns=["ID"])
+        self.assertEqual([row["ID"] for row in rows], [1])
+        rows = read_db_bbox("test", db_file_path, (-1, 9, 1, 11), columns=["ID"])
+        self.assertEqual([row["ID"] for row in rows], [])
+
+        # Dropping the table drops its R*Tree
+        drop_db_tables(db_file_path, ["test"])
+        self.assertEqual(list_tables(db_file_path), [])
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import csv
+import gzip
+import os
+import unittest
+
+from wow.utils import start_profiling, write_profile, write_dictionaries_streaming
+
+
+class TestUtils(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        test_root = os.path.dirname(__file__)
+        cls.output_dir = os.path.join(test_root, "fixtures")
+
+    def test_write_profile(self):
+        prefix = os.path.join(self.output_dir, "test_profile")
+        output_filename = os.path.join(self.output_dir, "test_profile_output.csv")
+
+        profiler = start_profiling()
+        write_dictionaries_streaming(output_filename, ({"a": i} for i in range(1000)))
+        filenames = write_profile(profiler, prefix, top=5)
+
+        self.assertEqual(filenames, [prefix + ".pstats", prefix + ".collapsed", prefix + ".txt"])
+        with open(prefix + ".collapsed", encoding="utf-8") as collapsed_file:
+            stacks = collapsed_file.read()
+        self.assertIn("utils.py:write_dictionaries_streaming", stacks)
+        with open(prefix + ".txt", encoding="utf-8") as summary_file:
+            summary = summary_file.read()
+        self.assertIn("db_utils and utils functions by internal time", summary)
+        self.assertIn("(write_dictionaries_streaming)", summary)
+
+        for filename in filenames + [output_filename]:
+            os.remove(filename)
+
+    def test_write_dictionaries_streaming(self):
+        output_filename = os.path.join(self.output_dir, "test_streaming.csv")
+        data = ({"a": i, "b": "row {}".format(i)} for i in range(25))
+
+        filenames = write_dictionaries_streaming(
+            output_filename, data, compression="gzip", max_rows=10, batch_size=4
+        )
+        expected = [
+            os.path.join(self.output_dir, "test_streaming_{:04d}.csv.gz".format(i))
+            for i in range(1, 4)
+        ]
+        self.assertEqual(filenames, expected)
+        rows = []
+        for filename in filenames:
+            with gzip.open(filename, "rt", encoding="utf-8") as f:
+                part = list(csv.DictReader(f))
+            self.assertLessEqual(len(part), 10)
+            rows.extend(part)
+            os.remove(filename)
+        self.assertEqual(rows[24], {"a": "24", "b": "row 24"})
+
+        self.assertEqual(write_dictionaries_streaming(output_filename, []), [])
+        self.assertEqual(os.path.isfile(output_filename), False)
+        filenames = write_dictionaries_streaming(output_filename, [], fieldnames=["a", "b"])
+        self.assertEqual(filenames, [output_filename])
+        with open(output_filename, encoding="utf-8") as f:
+            self.assertEqual(f.read(), "a,b\n")
+        os.remove(output_filename)